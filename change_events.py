@@ -0,0 +1,40 @@
+""" Broadcast ToDo file changes to any number of listeners (eg web clients on a server-sent events
+stream). Listeners don't get a queue each: they wait until the revision moves past the one they
+have, so a slow listener just skips intermediate revisions """
+
+import threading
+
+
+class ChangeNotifier:
+    """ Holds the latest known revision and wakes up listeners waiting for a newer one """
+
+    def __init__(self, revision=None):
+        self._cond = threading.Condition()
+        self._revision = revision
+
+    @property
+    def revision(self):
+        """ Latest known revision """
+        with self._cond:
+            return self._revision
+
+    def notify(self, revision):
+        """ Publish a new revision. Revisions that aren't newer than the current one are ignored """
+        with self._cond:
+            if self._revision is not None and revision <= self._revision:
+                return
+            self._revision = revision
+            self._cond.notify_all()
+
+    def wait(self, known_revision, timeout):
+        """ Wait until there is a revision newer than known_revision. Returns it, or None on
+        timeout """
+        def has_newer():
+            if self._revision is None:
+                return False
+            return known_revision is None or self._revision > known_revision
+
+        with self._cond:
+            if self._cond.wait_for(has_newer, timeout):
+                return self._revision
+            return None
@@ -0,0 +1,180 @@
+""" Append-only archive of completed ToDos. Records are stored as JSON lines in a log file, and a
+side index file holds the byte offset of each record (as little-endian uint64s), so the N most
+recent completions can be read by mmap'ing the index and slicing the log, without scanning it """
+
+from datetime import datetime
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+_OFFSET = struct.Struct('<Q')
+
+
+def index_path(log_path):
+    """ Path of the index for an archive's log: todo.done.jsonl -> todo.done.idx """
+    return os.path.splitext(log_path)[0] + '.idx'
+
+
+def archive_paths(md_path):
+    """ (log path, index path) of the archive kept next to a ToDo file: todo.md ->
+    todo.done.jsonl """
+    log_path = os.path.splitext(md_path)[0] + '.done.jsonl'
+    return log_path, index_path(log_path)
+
+
+def format_done(rec):
+    """ One line description of an archived ToDo """
+    when = datetime.fromtimestamp(rec['ts']).strftime('%Y-%m-%d %H:%M')
+    section = f" [{rec['section']}]" if rec['section'] is not None else ''
+    return f"{when}{section} {rec['text']}"
+
+
+def _offset_at(idx, i):
+    """ Offset of the i-th record, read from the contents of an index """
+    return _OFFSET.unpack_from(idx, i * _OFFSET.size)[0]
+
+
+def _mmap_read(fp):
+    """ Read-only mmap of an open file, or None if it's empty (empty files can't be mapped) """
+    if os.fstat(fp.fileno()).st_size == 0:
+        return None
+    return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class DoneArchive:
+    """ Archive for one ToDo file. Appends are serialized by a thread lock; callers that may race
+    with other processes should also hold the ToDo file's write lock (md_apply does). Readers need
+    no lock: the log is always written before the index, so indexed records are complete. """
+
+    def __init__(self, log_path, idx_path):
+        self._log_path = log_path
+        self._idx_path = idx_path
+        self._lock = threading.Lock()
+        # False until the index was checked against the log in this process, see _sync_index
+        self._synced = False
+
+    def append(self, entries, fsync=True):
+        """ Archive a list of (section, text) completed now """
+        if not entries:
+            return
+        now = int(time.time())
+        with self._lock:
+            self._sync_index()
+            with open(self._log_path, 'ab') as log_fp, open(self._idx_path, 'ab') as idx_fp:
+                offset = log_fp.tell()
+                records = []
+                offsets = []
+                for section, text in entries:
+                    rec = json.dumps({'ts': now, 'section': section, 'text': text},
+                                     ensure_ascii=False, separators=(',', ':'))
+                    rec = rec.encode('utf-8') + b'\n'
+                    offsets.append(_OFFSET.pack(offset))
+                    records.append(rec)
+                    offset += len(rec)
+                log_fp.write(b''.join(records))
+                log_fp.flush()
+                if fsync:
+                    os.fsync(log_fp.fileno())
+                idx_fp.write(b''.join(offsets))
+                idx_fp.flush()
+                if fsync:
+                    os.fsync(idx_fp.fileno())
+
+    def _sync_index(self):
+        """ Make the index match the log after a crash between the two writes (or a log written
+        by something else): drop index entries past the end of the log, truncate a torn last
+        record and index any records the index is missing """
+        if self._synced:
+            return
+        try:
+            log_fp = open(self._log_path, 'r+b')  # pylint: disable=consider-using-with
+        except FileNotFoundError:
+            # No archive yet: a stale index would point into the log we're about to create
+            with open(self._idx_path, 'wb'):
+                pass
+            self._synced = True
+            return
+
+        with log_fp, open(self._idx_path, 'a+b') as idx_fp:
+            log_size = os.fstat(log_fp.fileno()).st_size
+            idx_fp.seek(0)
+            idx = idx_fp.read()
+            n_indexed = len(idx) // _OFFSET.size
+            while n_indexed > 0 and _offset_at(idx, n_indexed - 1) >= log_size:
+                n_indexed -= 1
+
+            if n_indexed == 0:
+                tail_start = 0
+            else:
+                last = _offset_at(idx, n_indexed - 1)
+                log_fp.seek(last)
+                log_fp.readline()
+                tail_start = log_fp.tell()
+
+            log_fp.seek(tail_start)
+            new_offsets = []
+            offset = tail_start
+            for line in log_fp:
+                if not line.endswith(b'\n'):
+                    log.warning("Done archive %s ends with a partial record, dropping it",
+                                self._log_path)
+                    log_fp.truncate(offset)
+                    break
+                new_offsets.append(_OFFSET.pack(offset))
+                offset += len(line)
+
+            if n_indexed * _OFFSET.size != len(idx):
+                idx_fp.truncate(n_indexed * _OFFSET.size)
+            if new_offsets:
+                log.info("Indexed %d records missing from done archive index %s",
+                         len(new_offsets), self._idx_path)
+                idx_fp.seek(0, os.SEEK_END)
+                idx_fp.write(b''.join(new_offsets))
+        self._synced = True
+
+    def count(self):
+        """ Number of archived ToDos """
+        try:
+            return os.stat(self._idx_path).st_size // _OFFSET.size
+        except FileNotFoundError:
+            return 0
+
+    def recent(self, limit, skip=0):
+        """ Up to limit archived ToDos, most recent first, skipping the skip most recent. Each is a
+        dict with 'ts' (unix time it was completed), 'section' and 'text'. Only reads the index
+        entries and records returned """
+        try:
+            idx_fp = open(self._idx_path, 'rb')  # pylint: disable=consider-using-with
+        except FileNotFoundError:
+            return []
+
+        with idx_fp:
+            idx = _mmap_read(idx_fp)
+            if idx is None:
+                return []
+            # Map the log after the index, so every indexed record is within the mapping
+            with idx, open(self._log_path, 'rb') as log_fp:
+                log_map = _mmap_read(log_fp)
+                if log_map is None:
+                    return []
+                with log_map:
+                    n_records = len(idx) // _OFFSET.size
+                    end = max(0, n_records - skip)
+                    start = max(0, end - limit)
+                    offsets = [_offset_at(idx, i) for i in range(start, end)]
+                    records = []
+                    for offset in reversed(offsets):
+                        if offset >= len(log_map):
+                            # Stale index for a truncated log, fixed on the next append
+                            continue
+                        rec_end = log_map.find(b'\n', offset)
+                        if rec_end < 0:
+                            rec_end = len(log_map)
+                        records.append(json.loads(log_map[offset:rec_end]))
+                    return records
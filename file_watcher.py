@@ -0,0 +1,165 @@
+""" Watch a file for changes made by other programs. Uses inotify where available (Linux), and
+falls back to polling the file's signature elsewhere """
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+_IN_MODIFY = 0x00000002
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+# Watch the directory, not the file: editors and atomic writers replace the file with a rename,
+# which would leave a watch on the file itself pointing to the old inode
+_WATCH_MASK = (_IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO |
+               _IN_CREATE | _IN_DELETE)
+_EVENT_HDR = struct.Struct('iIII')
+
+
+def _inotify_libc():
+    """ libc, if it supports inotify, or None """
+    libc_name = ctypes.util.find_library('c')
+    if libc_name is None:
+        return None
+    try:
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            return None
+    except OSError:
+        return None
+    return libc
+
+
+def _file_sig(file_path):
+    try:
+        st = os.stat(file_path)
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+    except FileNotFoundError:
+        return None
+
+
+class FileWatcher:
+    """ Calls on_change() from a background thread when file_path changes. Bursts of changes (eg an
+    editor saving, or a git pull) are debounced: on_change() is only called once the file has been
+    quiet for debounce_secs. on_change() should be cheap to call for spurious notifications. """
+
+    def __init__(self, file_path, on_change, debounce_secs=1, poll_interval_secs=5,
+                 use_inotify=True):
+        self._file_path = os.path.abspath(file_path)
+        self._dir_path = os.path.dirname(self._file_path)
+        self._file_name = os.path.basename(self._file_path).encode('utf-8')
+        self._on_change = on_change
+        self._debounce_secs = debounce_secs
+        self._poll_interval_secs = poll_interval_secs
+        self._libc = _inotify_libc() if use_inotify else None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """ Start watching in a background thread """
+        if self._libc is not None:
+            try:
+                inotify_fd = self._inotify_open()
+            except OSError as ex:
+                log.warning("Can't watch %s with inotify, will poll it: %s", self._file_path, ex)
+                inotify_fd = None
+        else:
+            inotify_fd = None
+
+        if inotify_fd is None:
+            self._thread = threading.Thread(
+                target=self._poll_loop, daemon=True, name='file_watcher')
+        else:
+            self._thread = threading.Thread(
+                target=self._inotify_loop, args=[inotify_fd], daemon=True, name='file_watcher')
+        self._thread.start()
+        log.info("Watching %s for changes (%s)",
+                 self._file_path, 'polling' if inotify_fd is None else 'inotify')
+
+    def stop(self):
+        """ Stop watching and wait for the watcher thread to exit """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _notify(self):
+        try:
+            self._on_change()
+        except Exception:  # pylint: disable=broad-exception-caught
+            log.error("File change callback failed for %s", self._file_path, exc_info=True)
+
+    def _inotify_open(self):
+        fd = self._libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        wd = self._libc.inotify_add_watch(fd, self._dir_path.encode('utf-8'), _WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(errno, os.strerror(errno))
+        return fd
+
+    def _is_our_file(self, buf):
+        """ True if any inotify event in buf is about the watched file """
+        offset = 0
+        while offset + _EVENT_HDR.size <= len(buf):
+            _, _, _, name_len = _EVENT_HDR.unpack_from(buf, offset)
+            offset += _EVENT_HDR.size
+            name = buf[offset:offset + name_len].rstrip(b'\0')
+            offset += name_len
+            if name == self._file_name:
+                return True
+        return False
+
+    def _inotify_loop(self, inotify_fd):
+        # When to call on_change(), if the watched file changed and is now waiting to settle down
+        deadline = None
+        try:
+            while not self._stop.is_set():
+                # Wake up periodically to check if we should stop, or when the debounce expires
+                if deadline is None:
+                    timeout = self._poll_interval_secs
+                else:
+                    timeout = max(0, deadline - time.monotonic())
+                readable, _, _ = select.select([inotify_fd], [], [], timeout)
+                if readable:
+                    try:
+                        buf = os.read(inotify_fd, 64 * 1024)
+                    except BlockingIOError:
+                        buf = b''
+                    # Files next to the watched one (eg the done archive) may change all the time:
+                    # they neither delay on_change() nor keep it from being called
+                    if self._is_our_file(buf):
+                        deadline = time.monotonic() + self._debounce_secs
+                if deadline is not None and time.monotonic() >= deadline:
+                    deadline = None
+                    self._notify()
+        finally:
+            os.close(inotify_fd)
+
+    def _poll_loop(self):
+        last_sig = _file_sig(self._file_path)
+        while not self._stop.wait(self._poll_interval_secs):
+            sig = _file_sig(self._file_path)
+            if sig == last_sig:
+                continue
+            # Wait for the file to settle down
+            while not self._stop.wait(self._debounce_secs):
+                last_sig, sig = sig, _file_sig(self._file_path)
+                if sig == last_sig:
+                    break
+            last_sig = sig
+            self._notify()
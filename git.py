@@ -1,31 +1,245 @@
 """ Git integration: will commit and push a file to git once a callback is triggered """
 
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.cron import CronTrigger
+from contextlib import nullcontext
 from datetime import datetime, timedelta
+from scheduler import get_scheduler
+import metrics
+import profiling
 
+import io
 import logging
+import os
 import pathlib
 import subprocess
+import threading
+import time
 
 log = logging.getLogger(__name__)
 
+COMMIT_MSG = "ToDo file updated by GitToDo"
+_COMMIT_JOB_ID = 'coalesced_commit'
+
+_GIT_SECONDS = metrics.histogram('gittodo_git_op_seconds', 'Time taken by each git op', ('op',))
+_GIT_FAILURES = metrics.counter('gittodo_git_op_failures_total', 'Failed git ops', ('op',))
+
+
+def _op_name(cmd):
+    """ Metrics label for a command: the git subcommand (eg 'pull') """
+    argv = cmd.split() if isinstance(cmd, str) else cmd
+    return argv[1] if len(argv) > 1 and argv[0] == 'git' else argv[0]
+
 
 def _run(cwd, cmd):
-    result = subprocess.run(
-        cmd,
-        cwd=cwd,
-        shell=True,
-        check=False,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE)
+    """ Run a command and return its stdout; cmd may be a shell string or an argv list (which skips
+    the shell) """
+    op = _op_name(cmd)
+    with _GIT_SECONDS.time(op):
+        result = subprocess.run(
+            cmd,
+            cwd=cwd,
+            shell=isinstance(cmd, str),
+            check=False,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
     log.debug('Exec %s', cmd)
     if result.returncode != 0:
+        _GIT_FAILURES.inc(op)
         stdout = result.stdout.decode('utf-8')
         stderr = result.stderr.decode('utf-8')
         raise RuntimeError(
             f'Failed to exec {cmd} cwd={cwd}' +
             f'\nstderr:\n{stderr}\nstdout\n{stdout}')
+    return result.stdout.decode('utf-8')
+
+
+class GitCliBackend:
+    """ Run git ops by spawning the git binary """
+
+    def __init__(self, git_path):
+        self._git_path = git_path
+
+    def add(self, filename):
+        """ Stage filename """
+        _run(self._git_path, ['git', 'add', filename])
+
+    def commit(self, msg):
+        """ Commit staged changes """
+        _run(self._git_path, ['git', 'commit', '-m', msg])
+
+    def pull(self):
+        """ Pull from upstream (rebase or merge, as configured for the repo) """
+        _run(self._git_path, ['git', 'pull'])
+
+    def push(self):
+        """ Push to upstream """
+        _run(self._git_path, ['git', 'push'])
+
+    def has_changes(self, filename):
+        """ True if filename has staged or unstaged changes """
+        return _run(self._git_path, ['git', 'status', '--porcelain', '--', filename]).strip() != ''
+
+    def has_unpushed(self):
+        """ True if there are local commits that aren't in the upstream branch """
+        return _run(self._git_path, ['git', 'rev-list', '--count', '@{u}..HEAD']).strip() != '0'
+
+    def upstream_changed(self):
+        """ True if the upstream branch moved since the last fetch. Only asks the remote for the
+        branch head, without fetching anything """
+        upstream = _run(self._git_path, ['git', 'rev-parse', '--abbrev-ref', '@{u}']).strip()
+        remote, branch = upstream.split('/', 1)
+        local_sha = _run(self._git_path, ['git', 'rev-parse', '@{u}']).strip()
+        remote_refs = _run(self._git_path,
+                           ['git', 'ls-remote', remote, f'refs/heads/{branch}']).split()
+        return bool(remote_refs) and remote_refs[0] != local_sha
+
+
+class GitDulwichBackend:
+    """ Run git ops in process, using dulwich. Local commits are rebased on top of upstream ones
+    when pulling diverged branches """
+
+    def __init__(self, git_path):
+        # Optional dependency, only needed if this backend is selected
+        from dulwich import porcelain  # pylint: disable=import-outside-toplevel
+        try:
+            # Not a hard dependency of dulwich, but needed to rebase diverged branches: fail now
+            # rather than on the first pull after a concurrent edit
+            import merge3  # pylint: disable=import-outside-toplevel,unused-import
+        except ImportError as ex:
+            raise ImportError('The dulwich git backend needs merge3 to rebase diverged branches, '
+                              'install python3-merge3 (or pip install merge3)') from ex
+        self._porcelain = porcelain
+        self._git_path = str(git_path)
+
+    def _op(self, name, func, text_outstream=False, **kwargs):
+        """ Run a porcelain op, capturing its output and wrapping errors in a RuntimeError """
+        out = io.StringIO() if text_outstream else io.BytesIO()
+        err = io.BytesIO()
+        try:
+            with _GIT_SECONDS.time(name):
+                return func(self._git_path, outstream=out, errstream=err, **kwargs)
+        except Exception as ex:  # pylint: disable=broad-exception-caught
+            _GIT_FAILURES.inc(name)
+            raise RuntimeError(
+                f'Failed to {name} cwd={self._git_path}: {ex}\n'
+                f'stderr:\n{err.getvalue().decode("utf-8", "replace")}') from ex
+
+    def add(self, filename):
+        """ Stage filename """
+        try:
+            self._porcelain.add(self._git_path, [os.path.join(self._git_path, filename)])
+        except Exception as ex:  # pylint: disable=broad-exception-caught
+            raise RuntimeError(f'Failed to add {filename} cwd={self._git_path}: {ex}') from ex
+
+    def commit(self, msg):
+        """ Commit staged changes. Like the git CLI, fails if there is nothing to commit """
+        # pylint: disable=import-outside-toplevel
+        from dulwich.repo import Repo
+        with Repo(self._git_path) as repo:
+            staged_tree = repo.open_index().commit(repo.object_store)
+            if repo[repo.head()].tree == staged_tree:
+                raise RuntimeError(f'Failed to commit cwd={self._git_path}: nothing to commit')
+        try:
+            self._porcelain.commit(self._git_path, message=msg)
+        except Exception as ex:  # pylint: disable=broad-exception-caught
+            raise RuntimeError(f'Failed to commit cwd={self._git_path}: {ex}') from ex
+
+    def pull(self):
+        """ Fetch, then fast-forward or rebase local commits on upstream """
+        self._op('fetch', self._porcelain.fetch, text_outstream=True)
+        try:
+            self._op('pull', self._porcelain.pull, fast_forward=True)
+        except RuntimeError as ex:
+            if not isinstance(ex.__cause__, self._porcelain.DivergedBranches):
+                raise
+            # pylint: disable=import-outside-toplevel
+            from dulwich.repo import Repo
+            with Repo(self._git_path) as repo:
+                upstream_ref, _ = self._upstream_ref(repo)
+            upstream = upstream_ref.decode('utf-8').removeprefix('refs/remotes/')
+            # The work tree is reset to the rebased commits below, uncommitted changes would be lost
+            if self._has_tracked_changes():
+                raise RuntimeError(
+                    f'Failed to pull cwd={self._git_path}: local and upstream diverged, and '
+                    'there are uncommitted changes; commit them first') from ex
+            log.info("Local and upstream diverged, will rebase on %s", upstream)
+            try:
+                self._porcelain.rebase(self._git_path, upstream_ref)
+                # Rebase only moves HEAD: check out the rebased tree, or the next commit would
+                # revert whatever upstream changed
+                self._porcelain.reset(self._git_path, 'hard')
+            except Exception as rebase_ex:  # pylint: disable=broad-exception-caught
+                raise RuntimeError(f'Failed to rebase on {upstream} cwd={self._git_path}: '
+                                   f'{rebase_ex}') from rebase_ex
+
+    def _upstream_ref(self, repo):
+        """ Remote tracking ref of the active branch, and the URL of its remote """
+        branch = self._porcelain.active_branch(repo)
+        remote_name, remote_url = self._porcelain.get_remote_repo(repo)
+        return b'refs/remotes/' + remote_name.encode('utf-8') + b'/' + branch, remote_url
+
+    def _has_tracked_changes(self):
+        status = self._porcelain.status(self._git_path, untracked_files='no')
+        return bool(status.unstaged) or any(status.staged.values())
+
+    def push(self):
+        """ Push to upstream """
+        self._op('push', self._porcelain.push)
+
+    def has_changes(self, filename):
+        """ True if filename has staged or unstaged changes """
+        path = filename.encode('utf-8')
+        status = self._porcelain.status(self._git_path, untracked_files='no')
+        return path in status.unstaged or any(path in paths for paths in status.staged.values())
+
+    def has_unpushed(self):
+        """ True if there are local commits that aren't in the upstream branch """
+        # pylint: disable=import-outside-toplevel
+        from dulwich.repo import Repo
+        with Repo(self._git_path) as repo:
+            upstream_ref, _ = self._upstream_ref(repo)
+            if upstream_ref not in repo.refs:
+                # Never pushed
+                return True
+            head = repo.head()
+            upstream = repo.refs[upstream_ref]
+            # Like rev-list upstream..HEAD
+            return head != upstream and \
+                any(True for _ in repo.get_walker(include=[head], exclude=[upstream]))
+
+    def upstream_changed(self):
+        """ True if the upstream branch moved since the last fetch. Only asks the remote for the
+        branch head, without fetching anything """
+        # pylint: disable=import-outside-toplevel
+        from dulwich.repo import Repo
+        branch = self._porcelain.active_branch(self._git_path)
+        with Repo(self._git_path) as repo:
+            upstream_ref, remote_url = self._upstream_ref(repo)
+            local_sha = repo.refs[upstream_ref]
+        try:
+            result = self._porcelain.ls_remote(remote_url)
+        except Exception as ex:  # pylint: disable=broad-exception-caught
+            raise RuntimeError(
+                f'Failed to ls-remote {remote_url} cwd={self._git_path}: {ex}') from ex
+        # Older dulwich versions return the refs dict directly
+        remote_refs = getattr(result, 'refs', result)
+        remote_sha = remote_refs.get(b'refs/heads/' + branch)
+        return remote_sha is not None and remote_sha != local_sha
+
+
+_repo_locks = {}
+_repo_locks_lock = threading.Lock()
+
+
+def _repo_lock(git_path):
+    """ Lock shared by all GitIntegrations working on the same repo """
+    with _repo_locks_lock:
+        return _repo_locks.setdefault(str(git_path), threading.RLock())
+
+
+GIT_BACKENDS = {
+    'cli': GitCliBackend,
+    'dulwich': GitDulwichBackend,
+}
 
 
 class GitIntegration:
@@ -33,70 +247,219 @@ class GitIntegration:
     schedule a commit a todo_filepath and push it to a remote repo. The commit
     and push are scheduled in $commit_delay_secs, so that multiple changes to
     todo_filepath may be coalesced into a single commit. A new call to
-    on_todo_file_updated() will reset the commit schedule. """
+    on_todo_file_updated() will reset the commit schedule, but never past
+    $max_commit_latency_secs after the first uncommitted change, so that a
+    steady trickle of changes still gets pushed.
 
-    def __init__(self, todo_filepath, commit_delay_secs=300):
+    Every $remote_poll_interval_secs the upstream branch is checked for new commits (a cheap
+    ls-remote), and pulled only if it changed.
+
+    If file_lock is set, it will be held while git may read or change todo_filepath, so that git
+    ops don't race with other writers of the file.
+
+    Several instances may share a scheduler (and a repo) if each has a different name, which is
+    used to tell their scheduled jobs apart. """
+
+    def __init__(self, todo_filepath, commit_delay_secs=300, file_lock=None, backend='cli',
+                 max_commit_latency_secs=None, remote_poll_interval_secs=300, scheduler=None,
+                 name=None):
         path = pathlib.Path(todo_filepath)
         self._todo_filename = path.name
         self._git_path = path.parent.resolve()
+        if backend not in GIT_BACKENDS:
+            raise ValueError(
+                f"Unknown git backend '{backend}', expected one of {list(GIT_BACKENDS)}")
+        self._git = GIT_BACKENDS[backend](self._git_path)
+        self._file_lock = file_lock if file_lock is not None else nullcontext()
         self._on_failed_git_op_cb = None
         # Don't commit changes immediately, wait a while to give the user the opportunity to
         # make multiple changes in a single commit
         self._commit_delay_secs = commit_delay_secs
-        self._scheduler = BackgroundScheduler()
-        self._scheduler.start()
+        self._max_commit_latency_secs = max_commit_latency_secs
+        # Protects the pending edits bookkeeping and stats
+        self._pending_lock = threading.Lock()
+        self._pending_edits = 0
+        self._first_pending_edit = None
+        self._stats = {
+            'commits': 0,
+            'failed_commits': 0,
+            'edits_committed': 0,
+            'max_edits_per_commit': 0,
+            'forced_by_max_latency': 0,
+            'last_commit_latency_secs': None,
+            'max_commit_latency_secs': 0,
+        }
+        # Only one commit may run at a time, eg a scheduled one and a user-forced one
+        self._commit_lock = threading.Lock()
+        # Only import apscheduler if commits are scheduled, the backends don't need it
+        # pylint: disable=import-outside-toplevel
+        from apscheduler.jobstores.base import JobLookupError
+        self._job_lookup_error = JobLookupError
+        self._scheduler = scheduler if scheduler is not None else get_scheduler()
+        self._commit_job_id = _COMMIT_JOB_ID if name is None else f'{_COMMIT_JOB_ID}:{name}'
+        # Suffix of this instance's profiling targets, see profiling.py
+        self._profile_suffix = '' if name is None else f':{name}'
+        # Lists in the same repo would otherwise race for its index (git fails if index.lock exists)
+        self._repo_lock = _repo_lock(self._git_path)
 
-        self._scheduler.add_job(
-            self.pull,
-            trigger=CronTrigger(hour=8, minute=0, second=0),
-            id='morning_pull'
-        )
-        self._scheduler.add_job(
-            self.pull,
-            trigger=CronTrigger(hour=21, minute=0, second=0),
-            id='night_pull'
-        )
+        if remote_poll_interval_secs is not None:
+            self._scheduler.add_job(
+                self.sync_remote,
+                'interval',
+                seconds=remote_poll_interval_secs,
+                id='remote_sync' if name is None else f'remote_sync:{name}')
 
     def pull(self):
         """ Pull changes from remote """
         try:
             log.info("Pulling git...")
-            _run(self._git_path, 'git pull')
+            with profiling.maybe_profile('job:pull' + self._profile_suffix), \
+                    self._repo_lock, self._file_lock:
+                self._git.pull()
         except (subprocess.CalledProcessError, RuntimeError) as ex:
             if self._on_failed_git_op_cb is not None:
                 self._on_failed_git_op_cb(str(ex))
             raise
 
+    def sync_remote(self):
+        """ Pull if upstream has new commits """
+        with profiling.maybe_profile('job:remote_sync' + self._profile_suffix):
+            self._sync_remote()
+
+    def _sync_remote(self):
+        try:
+            changed = self._git.upstream_changed()
+        except (subprocess.CalledProcessError, RuntimeError, ValueError, KeyError) as ex:
+            # Probably offline; not worth bothering the user, the next check will retry
+            log.warning("Can't check upstream for changes: %s", ex)
+            return
+        if not changed:
+            return
+        log.info("Upstream has new commits")
+        try:
+            self.pull()
+        except (subprocess.CalledProcessError, RuntimeError):
+            # Already reported by pull()
+            log.error("Failed to pull upstream changes", exc_info=True)
+
     def register_failed_git_op_cb(self, fail_git_op_cb):
         """ Callback to be invoked when a git operation fails """
         self._on_failed_git_op_cb = fail_git_op_cb
 
     def on_todo_file_updated(self):
         """ Callback to notify the file under monitoring was changed """
+        now = time.monotonic()
+        with self._pending_lock:
+            self._pending_edits += 1
+            if self._first_pending_edit is None:
+                self._first_pending_edit = now
+            first_pending_edit = self._first_pending_edit
+            pending_edits = self._pending_edits
+
         if self._commit_delay_secs is None:
             self.commit()
-        else:
-            log.info(
-                "ToDo change notification, will schedule a commit in %s seconds",
-                self._commit_delay_secs)
-            self._scheduler.remove_all_jobs()
-            self._scheduler.add_job(
-                self.commit,
-                'date',
-                run_date=datetime.now() +
-                timedelta(
-                    seconds=self._commit_delay_secs))
+            return
 
-    def commit(self):
-        """ Commit and push changes to managed repo """
+        delay = self._commit_delay_secs
+        forced = False
+        if self._max_commit_latency_secs is not None:
+            deadline = first_pending_edit + self._max_commit_latency_secs - now
+            if deadline < delay:
+                delay = max(0, deadline)
+                forced = True
+        log.info(
+            "ToDo change notification, will schedule a commit in %.0f seconds (%d pending edits%s)",
+            delay, pending_edits, ', max latency reached' if forced else '')
+        # Only replace the commit job: the scheduler also holds the periodic pulls
+        self._scheduler.add_job(
+            self._scheduled_commit,
+            'date',
+            run_date=datetime.now() + timedelta(seconds=delay),
+            args=[forced],
+            id=self._commit_job_id,
+            replace_existing=True)
+
+    def _scheduled_commit(self, forced_by_max_latency):
+        if forced_by_max_latency:
+            with self._pending_lock:
+                self._stats['forced_by_max_latency'] += 1
         try:
-            log.info("Will commit and push changes to ToDo file")
-            # This order will only work with rebase
-            _run(self._git_path, f'git add {self._todo_filename}')
-            _run(self._git_path, 'git commit -m "ToDo file updated by GitToDo"')
-            _run(self._git_path, 'git pull')
-            _run(self._git_path, 'git push')
-        except (subprocess.CalledProcessError, RuntimeError) as ex:
-            if self._on_failed_git_op_cb is not None:
-                self._on_failed_git_op_cb(str(ex))
-            raise
+            with profiling.maybe_profile('job:commit' + self._profile_suffix):
+                self.commit()
+        except (subprocess.CalledProcessError, RuntimeError):
+            # Already reported by commit(), nothing else to do from a scheduler thread
+            log.error("Scheduled commit failed", exc_info=True)
+
+    def stats(self):
+        """ Commit coalescing stats: how many edits went into each commit, and how long they
+        waited """
+        with self._pending_lock:
+            stats = dict(self._stats)
+            stats['pending_edits'] = self._pending_edits
+            stats['edits_per_commit'] = \
+                stats['edits_committed'] / stats['commits'] if stats['commits'] else None
+        return stats
+
+    def commit(self):
+        """ Commit and push changes to managed repo, including earlier commits that failed to be
+        pushed. Returns False if there was nothing to push """
+        with self._commit_lock:
+            # Any edit from now on will need a new commit. The scheduled commit is removed in the
+            # same critical section: an edit counted after it will schedule its own, which
+            # mustn't be removed
+            with self._pending_lock:
+                edits = self._pending_edits
+                first_pending_edit = self._first_pending_edit
+                self._pending_edits = 0
+                self._first_pending_edit = None
+                try:
+                    # The commit may have been forced, no need for the scheduled one to run too
+                    self._scheduler.remove_job(self._commit_job_id)
+                except self._job_lookup_error:
+                    pass
+
+            try:
+                with self._repo_lock:
+                    with self._file_lock:
+                        # The file may have been reported as changed by a pull, or changed and
+                        # reverted
+                        has_changes = self._git.has_changes(self._todo_filename)
+                        # A previous push may have failed after its commit succeeded
+                        if not has_changes and not self._git.has_unpushed():
+                            log.info("ToDo file has no changes, nothing to commit")
+                            return False
+                        if has_changes:
+                            log.info("Will commit and push %d changes to ToDo file", edits)
+                            # This order will only work with rebase
+                            self._git.add(self._todo_filename)
+                            self._git.commit(COMMIT_MSG)
+                        else:
+                            log.info("No changes to commit, will push earlier commits")
+                        self._git.pull()
+                    # Push doesn't touch the work tree, no need to block writers while it runs
+                    self._git.push()
+            except (subprocess.CalledProcessError, RuntimeError) as ex:
+                with self._pending_lock:
+                    # Changes are still in the work tree, they'll go in the next commit
+                    self._pending_edits += edits
+                    if first_pending_edit is not None and \
+                            (self._first_pending_edit is None or
+                             first_pending_edit < self._first_pending_edit):
+                        self._first_pending_edit = first_pending_edit
+                    self._stats['failed_commits'] += 1
+                if self._on_failed_git_op_cb is not None:
+                    self._on_failed_git_op_cb(str(ex))
+                raise
+
+            with self._pending_lock:
+                self._stats['commits'] += 1
+                self._stats['edits_committed'] += edits
+                self._stats['max_edits_per_commit'] = max(
+                    self._stats['max_edits_per_commit'], edits)
+                if first_pending_edit is not None:
+                    latency = time.monotonic() - first_pending_edit
+                    self._stats['last_commit_latency_secs'] = latency
+                    self._stats['max_commit_latency_secs'] = max(
+                        self._stats['max_commit_latency_secs'], latency)
+            log.info("Pushed ToDo changes, commit stats: %s", self.stats())
+            return True
@@ -0,0 +1,148 @@
+""" Logging setup for the service. Threads that log only put records in a bounded queue, and a
+single background thread formats and writes them, so a slow stdout (eg journald applying
+back-pressure) never blocks web, bot or scheduler threads; if the queue fills up, records are
+dropped (and counted in /metrics) rather than waited on. Records are written as JSON lines, or as
+plain text """
+
+import atexit
+from datetime import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+import metrics
+
+# Records waiting to be written; past this, new records are dropped
+_QUEUE_SIZE = 10000
+# Seconds to wait for queued records to be written on exit
+_FLUSH_TIMEOUT_SECS = 5
+
+_DROPPED = metrics.counter(
+    'gittodo_log_records_dropped_total', 'Log records dropped because the log queue was full')
+_SUPPRESSED = metrics.counter(
+    'gittodo_log_records_suppressed_total', 'Log records dropped by a rate limit', ('logger',))
+
+_TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+class JsonFormatter(logging.Formatter):
+    """ One JSON object per record, with its time, level, logger, thread and message (and the
+    traceback, if any) """
+
+    def format(self, record):
+        created = datetime.fromtimestamp(record.created).astimezone()
+        entry = {
+            'ts': created.isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'msg': record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        if record.stack_info:
+            entry['stack'] = record.stack_info
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class _NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Like QueueHandler.prepare, but keep the traceback apart from the message so that the
+        # formatter can tell them apart (QueueHandler merges them)
+        msg = record.getMessage()
+        exc_text = record.exc_text
+        if record.exc_info and not exc_text:
+            exc_text = logging.Formatter().formatException(record.exc_info)
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = msg
+        record.args = None
+        record.exc_info = None
+        record.exc_text = exc_text
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _DROPPED.inc()
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # The queue may be full on exit: wait for room, but not forever
+        try:
+            self.queue.put(self._sentinel, timeout=_FLUSH_TIMEOUT_SECS)
+        except queue.Full:
+            pass
+
+    def stop(self):
+        self.enqueue_sentinel()
+        self._thread.join(_FLUSH_TIMEOUT_SECS)
+        self._thread = None
+
+
+class RateLimitFilter(logging.Filter):
+    """ Logger filter for hot paths: lets through up to max_per_min DEBUG and INFO records a minute
+    for each message (format string) of a logger, and drops the rest. The first record let through
+    after some were dropped says how many. Warnings and errors are never dropped """
+
+    def __init__(self, max_per_min):
+        super().__init__()
+        self._max_per_min = max_per_min
+        self._lock = threading.Lock()
+        # Message -> [start of the current minute, records let through, records dropped]
+        self._windows = {}
+
+    def filter(self, record):
+        if record.levelno > logging.INFO or not isinstance(record.msg, str):
+            return True
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(record.msg)
+            if window is None or now - window[0] >= 60:
+                suppressed = 0 if window is None else window[2]
+                self._windows[record.msg] = [now, 1, 0]
+            elif window[1] < self._max_per_min:
+                window[1] += 1
+                suppressed = 0
+            else:
+                window[2] += 1
+                _SUPPRESSED.inc(record.name)
+                return False
+        if suppressed:
+            record.msg = f'{record.msg} [{suppressed} similar messages suppressed]'
+        return True
+
+
+def setup_logging(cfg):
+    """ Route all logging through a queue to stdout, with the levels, format and rate limits
+    configured in cfg (log_level, log_levels, log_format and log_rate_limits). Returns the
+    listener writing the records; it's stopped (flushing queued records) on exit """
+    log_format = cfg.get('log_format', 'json')
+    if log_format not in ('json', 'text'):
+        raise ValueError(f"Unknown log_format '{log_format}', expected 'json' or 'text'")
+    handler = logging.StreamHandler(sys.stdout)
+    if log_format == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(_TEXT_FORMAT))
+
+    log_queue = queue.Queue(_QUEUE_SIZE)
+    root = logging.getLogger()
+    root.setLevel(cfg.get('log_level', 'INFO'))
+    root.addHandler(_NonBlockingQueueHandler(log_queue))
+    for name, level in cfg.get('log_levels', {}).items():
+        logging.getLogger(name).setLevel(level)
+    for name, max_per_min in cfg.get('log_rate_limits', {'git': 60, 'telegram': 60}).items():
+        logging.getLogger(name).addFilter(RateLimitFilter(max_per_min))
+
+    listener = _QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -1,302 +1,386 @@
 """ Manage a git repo as a ToDo list with Telegram integration """
 
+import argparse
 import json
 import logging
 import os
 import pathlib
+import re
 import sys
 import threading
 import time
 
-from flask import Flask, Response, request, send_from_directory
-
-sys.path.append(os.path.join(pathlib.Path(__file__).parent.resolve(), "./PyTelegramBot"))
-
-from telegram import TelBot
-from reminders import ReminderScheduler, guess_reminder_date, mark_for_reminder_date, normalize_reminder_token
-from git import GitIntegration
-from md_helpers import (md_get_all,
-                        md_get_sections,
-                        md_get_section_contents,
-                        md_add_to_section,
-                        md_mark_done,
-                        md_move_todo)
-
-root = logging.getLogger()
-root.setLevel(logging.DEBUG)
-handler = logging.StreamHandler(sys.stdout)
-handler.setLevel(logging.DEBUG)
-handler.setFormatter(logging.Formatter(
-    '%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
-root.addHandler(handler)
+from change_events import ChangeNotifier
+from log_pipeline import setup_logging
+from md_helpers import (md_cache_stats, md_load, md_changed_externally, md_set_archive_path,
+                        md_set_durability, md_write_lock)
+import metrics
 
 log = logging.getLogger(__name__)
 
-
-with open('config.json', 'r', encoding="utf-8") as fp:
-    cfg = json.loads(fp.read())
-
-# Create todo file if it doesn't exist
-pathlib.Path(cfg['todo_filepath']).touch(exist_ok=True)
-
-# Throw on any missing cfg key
-commit_delay = cfg['commit_delay_secs'] if 'commit_delay_secs' in cfg else None
-git = GitIntegration(cfg['todo_filepath'], commit_delay)
-reminders = ReminderScheduler(cfg['todo_filepath'])
-
-
-def on_file_updated():
-    """ Trampoline for all actions required on file update """
-    git.on_todo_file_updated()
-    reminders.reload_reminders_from_file()
-
-
-bot = TelBot(cfg['tok'],
-             cfg['short_poll_interval'],
-             cfg['long_poll_interval'],
-             cfg['accepted_chat_ids'],
-             cfg['todo_filepath'],
-             on_file_updated,
-             git.pull,
-             git.commit)
-
-git.register_failed_git_op_cb(bot.on_failed_git_op)
-reminders.register_sender(bot)
-
-# Flask web UI
-app = Flask(__name__, static_folder='www', static_url_path='/static')
-
-
-def process_command(cmd_input):
-    """ Process a command and return (success, result) tuple """
-    cmd_input = cmd_input.strip()
-    if not cmd_input:
-        return (False, 'Error: No command provided')
-
-    if cmd_input.startswith('/'):
-        cmd_input = cmd_input[1:]
-    parts = cmd_input.split()
-    if not parts:
-        return (False, 'Error: Empty command')
-
-    cmd = parts[0].lower()
-    args = parts[1:]
-
+# Components to start for each mode. 'web', 'bot' and 'reminders' can run side by side, as separate
+# processes, instead of 'all': only one of them may commit and push, so git sync runs in the
+# reminders mode, which picks up edits made by the others with its file watcher. Reminders and git
+# failures are sent with a send-only Telegram client, unless the bot runs in the same process: two
+# processes polling Telegram with the same token would conflict.
+MODES = {
+    'web': ('web',),
+    'bot': ('bot',),
+    'reminders': ('reminders', 'git'),
+    'all': ('web', 'bot', 'reminders', 'git'),
+}
+# Components that need to know about changes made by other programs (or processes)
+_WATCHING_COMPONENTS = ('web', 'reminders', 'git')
+
+
+# Settings that may be set for each list, falling back to the top level value
+_LIST_SETTINGS = ('commit_delay_secs', 'git_backend', 'max_commit_latency_secs',
+                  'remote_poll_interval_secs', 'file_watch_debounce_secs', 'reminder_catchup_secs')
+_LIST_NAME_RE = re.compile(r'^[A-Za-z0-9_-]+$')
+
+
+def _list_configs(cfg):
+    """ Per list config: explicit 'lists', or a single list from the top level keys """
+    if 'lists' not in cfg:
+        return [{
+            'name': 'default',
+            'todo_filepath': cfg['todo_filepath'],
+            'accepted_chat_ids': cfg.get('accepted_chat_ids', []),
+            'url_prefix': '',
+            'reminders_journal': cfg.get('reminders_journal', 'reminders.journal.json'),
+            'done_archive': cfg.get('done_archive', 'done.jsonl'),
+            **{key: cfg[key] for key in _LIST_SETTINGS if key in cfg},
+        }]
+
+    lists = []
+    for list_cfg in cfg['lists']:
+        name = list_cfg['name']
+        lists.append({
+            'url_prefix': f'/{name}',
+            'accepted_chat_ids': [],
+            'reminders_journal': f'reminders.{name}.journal.json',
+            'done_archive': f'done.{name}.jsonl',
+            **{key: cfg[key] for key in _LIST_SETTINGS if key in cfg},
+            **list_cfg,
+        })
+    return lists
+
+
+def load_config(path):
+    """ Read and validate config file. The result always has a 'lists' entry, see _list_configs """
+    with open(path, 'r', encoding="utf-8") as fp:
+        cfg = json.loads(fp.read())
+    if cfg.get('web_server', 'dev') not in ('dev', 'waitress'):
+        raise ValueError(f"Unknown web_server '{cfg['web_server']}', expected 'dev' or 'waitress'")
+
+    cfg['lists'] = _list_configs(cfg)
+    if not cfg['lists']:
+        raise ValueError("No ToDo lists configured")
+    seen = {'name': {}, 'url_prefix': {}, 'todo_filepath': {}, 'done_archive': {}, 'chat': {}}
+    for list_cfg in cfg['lists']:
+        name = list_cfg['name']
+        if not _LIST_NAME_RE.match(name):
+            raise ValueError(f"Bad list name '{name}', use only letters, digits, '-' and '_'")
+        prefix = list_cfg['url_prefix']
+        if prefix != '' and (not prefix.startswith('/') or prefix.endswith('/')):
+            raise ValueError(f"Bad url_prefix '{prefix}' for list {name}, expected '' or '/path'")
+        keys = [('name', name), ('url_prefix', prefix),
+                ('todo_filepath', os.path.abspath(list_cfg['todo_filepath']))]
+        keys.append(('done_archive', os.path.abspath(list_cfg['done_archive'])))
+        keys += [('chat', chat_id) for chat_id in list_cfg['accepted_chat_ids']]
+        for kind, key in keys:
+            if key in seen[kind]:
+                raise ValueError(f"Lists {seen[kind][key]} and {name} have the same {kind} {key}")
+            seen[kind][key] = name
+    return cfg
+
+
+def _rss_bytes():
+    """ Resident memory of this process, or None if unknown (only Linux is supported) """
     try:
-        if cmd == 'ls':
-            if args:
-                result = md_get_section_contents(cfg['todo_filepath'], args[0])
-            else:
-                result = md_get_all(cfg['todo_filepath'])
-        elif cmd == 'sections':
-            result = md_get_sections(cfg['todo_filepath'])
-        elif cmd == 'add':
-            if len(args) < 2:
-                return (False, 'Error: Usage /add <section> <todo>')
-            section = args[0]
-            todo = normalize_reminder_token(' '.join(args[1:]))
-            result = 'OK'
-            try:
-                maybe_reminder = guess_reminder_date(todo)
-            except ValueError as ex:
-                maybe_reminder = None
-                result = f"ToDo added. Detected a reminder, but can't parse it: {ex}"
-            if maybe_reminder is not None:
-                result = f"OK. Set reminder for {maybe_reminder}"
-                todo = mark_for_reminder_date(todo, maybe_reminder)
-            md_add_to_section(cfg['todo_filepath'], section, todo)
-            on_file_updated()
-        elif cmd == 'done':
-            if not args:
-                return (False, 'Error: Usage /done <number>')
+        with open('/proc/self/statm', 'r', encoding="utf-8") as fp:
+            return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class TodoList:
+    """ One ToDo file and the components that keep it in sync: git, reminders and the file
+    watcher. Lists share the process wide parts (the scheduler, the document cache, the Telegram
+    bot and the web app), but each has its own file, repo, scheduled jobs and chats """
+
+    def __init__(self, list_cfg):
+        self.cfg = list_cfg
+        self.name = list_cfg['name']
+        self.todo_filepath = list_cfg['todo_filepath']
+        self.url_prefix = list_cfg['url_prefix']
+        self.chat_ids = list_cfg['accepted_chat_ids']
+        self.git = None
+        self.reminders = None
+        self.watcher = None
+        self.changes = None
+        self._notifier = None
+
+    def start(self, components):
+        """ Start the parts of this list needed by components (see MODES): git sync, reminders
+        and the file watcher """
+        # Create todo file if it doesn't exist
+        pathlib.Path(self.todo_filepath).touch(exist_ok=True)
+        md_set_archive_path(self.todo_filepath, self.cfg['done_archive'])
+        self.changes = ChangeNotifier(md_load(self.todo_filepath).revision)
+        if 'git' in components:
+            self.git = self._make_git()
+        if 'reminders' in components:
+            self.reminders = self._make_reminders()
+        if any(component in components for component in _WATCHING_COMPONENTS):
+            self.watcher = self._start_watcher()
+
+    def _make_git(self):
+        from git import GitIntegration  # pylint: disable=import-outside-toplevel
+        # Throw on any missing cfg key
+        commit_delay = self.cfg['commit_delay_secs'] if 'commit_delay_secs' in self.cfg else None
+        return GitIntegration(self.todo_filepath,
+                              commit_delay,
+                              md_write_lock(self.todo_filepath),
+                              self.cfg.get('git_backend', 'cli'),
+                              self.cfg.get('max_commit_latency_secs'),
+                              self.cfg.get('remote_poll_interval_secs', 300),
+                              name=self.name)
+
+    def _make_reminders(self):
+        # pylint: disable=import-outside-toplevel
+        from reminders import ReminderScheduler
+        from scheduler import JobJournal
+        return ReminderScheduler(self.todo_filepath,
+                                 journal=JobJournal(self.cfg['reminders_journal']),
+                                 catchup_secs=self.cfg.get('reminder_catchup_secs', 24 * 60 * 60),
+                                 name=self.name)
+
+    def _start_watcher(self):
+        from file_watcher import FileWatcher  # pylint: disable=import-outside-toplevel
+        # Prime the external change detection with the current file
+        md_changed_externally(self.todo_filepath)
+        watcher = FileWatcher(self.todo_filepath,
+                              self.on_file_changed_on_disk,
+                              self.cfg.get('file_watch_debounce_secs', 1))
+        watcher.start()
+        return watcher
+
+    def attach_notifier(self, notifier):
+        """ Send this list's reminders and git failures to its chats through notifier (the bot,
+        or a notifier.TelegramNotifier). Reminders are only scheduled from then on """
+        self._notifier = notifier
+        if self.git is not None:
+            self.git.register_failed_git_op_cb(self.on_failed_git_op)
+        if self.reminders is not None:
+            self.reminders.register_sender(self)
+
+    def on_failed_git_op(self, msg):
+        """ Git failure callback """
+        self._notifier.on_failed_git_op(msg, self.chat_ids)
+
+    def send_reminder_msg(self, txt):
+        """ Reminders callback """
+        self._notifier.send_reminder_msg(txt, self.chat_ids)
+
+    def on_file_updated(self):
+        """ Trampoline for all actions required on file update """
+        self.changes.notify(md_load(self.todo_filepath).revision)
+        if self.git is not None:
+            self.git.on_todo_file_updated()
+        if self.reminders is not None:
+            self.reminders.reload_reminders_from_file()
+
+    def on_file_changed_on_disk(self):
+        """ File watcher callback: the ToDo file may have been changed by another program (an
+        editor, a git pull...). Our own writes are filtered out, they already called
+        on_file_updated """
+        if md_changed_externally(self.todo_filepath):
+            log.info("ToDo file for list %s changed on disk", self.name)
+            self.on_file_updated()
+
+
+class GitToDo:
+    """ The service: builds the components needed for a mode and wires them together. Building
+    this object is cheap: nothing is started, and modules with heavy dependencies (apscheduler,
+    flask, the Telegram client) are only imported by start(), for the components that need them """
+
+    def __init__(self, cfg, mode='all'):
+        self.cfg = cfg
+        self.mode = mode
+        self._components = MODES[mode]
+        self.lists = [TodoList(list_cfg) for list_cfg in cfg['lists']]
+        self.bot = None
+        # Where reminders and git failures are sent: the bot, or a send-only client without it
+        self.notifier = None
+        self.app = None
+        # Component name -> seconds it took to start
+        self.startup_times = {}
+        # List name -> bytes of resident memory its startup added (None if unknown)
+        self.list_memory = {}
+
+    def _timed(self, name, factory):
+        start = time.monotonic()
+        component = factory()
+        self.startup_times[name] = time.monotonic() - start
+        return component
+
+    def start(self):
+        """ Build and start all components for this mode """
+        md_set_durability(self.cfg.get('write_durability', 'file'))
+        # Both git and reminders use the shared scheduler, set it up before either starts
+        from scheduler import configure_scheduler  # pylint: disable=import-outside-toplevel
+        configure_scheduler(self.cfg.get('scheduler_misfire_grace_secs', 300))
+        if self.cfg.get('profiling_dir') is not None:
+            from profiling import configure_profiling  # pylint: disable=import-outside-toplevel
+            configure_profiling(self.cfg['profiling_dir'],
+                                self.cfg.get('profiling_keep', 20),
+                                self.cfg.get('profiling_targets', []))
+
+        for todo_list in self.lists:
+            rss_before = _rss_bytes()
+            self._timed(f'list:{todo_list.name}',
+                        lambda todo_list=todo_list: todo_list.start(self._components))
+            rss_after = _rss_bytes()
+            self.list_memory[todo_list.name] = \
+                None if rss_before is None or rss_after is None else rss_after - rss_before
+        if 'bot' in self._components:
+            self.bot = self._timed('bot', self._make_bot)
+            self.notifier = self.bot
+        elif 'reminders' in self._components or 'git' in self._components:
+            self.notifier = self._timed('notifier', self._make_notifier)
+        if self.notifier is not None:
+            for todo_list in self.lists:
+                todo_list.attach_notifier(self.notifier)
+        if 'web' in self._components:
+            self.app = self._timed('web', self._start_web)
+
+    def _make_bot(self):
+        sys.path.append(os.path.join(pathlib.Path(__file__).parent.resolve(), "./PyTelegramBot"))
+        from telegram import TelBot  # pylint: disable=import-outside-toplevel
+        return TelBot(self.cfg['tok'],
+                      self.cfg['short_poll_interval'],
+                      self.cfg['long_poll_interval'],
+                      self.lists,
+                      self.cfg.get('reminder_digest_secs', 5))
+
+    def _make_notifier(self):
+        from notifier import TelegramNotifier, api_sender  # pylint: disable=import-outside-toplevel
+        return TelegramNotifier(api_sender(self.cfg['tok']),
+                                self.cfg.get('reminder_digest_secs', 5))
+
+    def _start_web(self):
+        from web import create_app, run_web  # pylint: disable=import-outside-toplevel
+        app = create_app(self.lists, self.metrics_text, self.cfg.get('profiling_admin_token'),
+                         self.cfg.get('web_max_event_streams', 8))
+        threading.Thread(target=run_web, args=[app, self.cfg], daemon=True, name='web').start()
+        return app
+
+    def metrics_text(self):
+        """ All metrics of the service, in Prometheus' text format: the ones components update as
+        they run (see metrics.py), plus stats of each component, read now """
+        # pylint: disable=import-outside-toplevel
+        from reminders import reminder_cache_stats
+        from scheduler import scheduler_stats
+        extra = []
+
+        def gauge(name, doc, samples, metric_type='gauge'):
+            extra.append(metrics.format_metric(name, metric_type, doc, samples))
+
+        sizes, todos, reminders, git_stats = [], [], [], []
+        for todo_list in self.lists:
+            labels = {'list': todo_list.name}
             try:
-                todo_nums = [int(n) for n in args]
-                todo_nums.sort(reverse=True)
-            except ValueError:
-                return (False, f"Error: Can't parse todo numbers: {args}")
-            action_report = []
-            for num in todo_nums:
-                try:
-                    deleted_line = md_mark_done(cfg['todo_filepath'], num)
-                except IndexError:
-                    action_report.append(f"ToDo {num} doesn't exist")
-                    continue
-                if deleted_line is None:
-                    action_report.append(f"ToDo #{num} can't be deleted")
-                else:
-                    action_report.append(f"ToDo #{num} deleted")
-                    on_file_updated()
-            result = '\n'.join(action_report) if action_report else 'Nothing changed?'
-        elif cmd == 'pull':
-            git.pull()
-            result = 'Pull complete'
-        elif cmd == 'push':
-            git.commit()
-            result = 'Push complete'
-        else:
-            return (False, f'Error: Unknown command: {cmd}')
-
-        return (True, result)
-    except Exception as ex:
-        log.error('Error processing command', exc_info=True)
-        return (False, f'Error: {ex}')
-
-
-@app.route('/raw')
-def raw_page():
-    """ Serve the todo file as plain text """
-    with open(cfg['todo_filepath'], 'r', encoding='utf-8') as f:
-        content = f.read()
-    return Response(content, mimetype='text/plain')
-
-
-@app.route('/cmd', methods=['GET', 'POST'])
-def cmd_page():
-    """ Process commands like the Telegram bot """
-    if request.method == 'GET':
-        return Response('''Commands:
-  /ls [section]          - List all ToDos (optionally in a section)
-  /sections              - List all sections
-  /add <section> <todo>  - Add a ToDo to a section
-  /done <number>         - Mark a ToDo as complete
-  /pull                  - Force git pull
-  /push                  - Force git commit and push
-
-Usage: POST to /cmd with 'cmd' parameter
-Example: curl -X POST -d "cmd=/ls" http://localhost:5000/cmd
-''', mimetype='text/plain')
-
-    cmd_input = request.form.get('cmd', '')
-    success, result = process_command(cmd_input)
-    status = 200 if success else 400
-    return Response(result, mimetype='text/plain'), status
-
-
-@app.route('/telegram_test')
-def telegram_test_page():
-    """ HTML page to test Telegram commands """
-    return send_from_directory('www', 'telegram_test.html')
-
-
-@app.route('/api/cmd', methods=['POST'])
-def api_cmd():
-    """ API endpoint to process commands and return JSON """
+                sizes.append((labels, os.stat(todo_list.todo_filepath).st_size))
+                todos.append((labels, md_load(todo_list.todo_filepath).todo_count()))
+            except OSError:
+                pass
+            if todo_list.reminders is not None:
+                reminders.append((labels, todo_list.reminders.scheduled_count()))
+            if todo_list.git is not None:
+                git_stats.append((labels, todo_list.git.stats()))
+        gauge('gittodo_file_bytes', 'Size of the ToDo file', sizes)
+        gauge('gittodo_todos', 'ToDos in the ToDo file', todos)
+        gauge('gittodo_reminders_scheduled', 'Reminders waiting to be sent', reminders)
+        for key, metric_type, doc in (
+                ('commits', 'counter', 'Commits made'),
+                ('failed_commits', 'counter', 'Commits (or pushes) that failed'),
+                ('edits_committed', 'counter', 'Edits included in a commit'),
+                ('pending_edits', 'gauge', 'Edits waiting for the next commit'),
+                ('last_commit_latency_secs', 'gauge',
+                 'Seconds the edits of the last commit waited for it'),
+                ('max_commit_latency_secs', 'gauge', 'Most seconds edits waited for a commit')):
+            name = 'gittodo_git_' + key.replace('_secs', '_seconds')
+            name += '_total' if metric_type == 'counter' else ''
+            gauge(name, doc, [(labels, stats[key]) for labels, stats in git_stats], metric_type)
+
+        sched = scheduler_stats()
+        for key, doc in (('submitted', 'Jobs submitted to the scheduler'),
+                         ('executed', 'Scheduler jobs run'),
+                         ('errors', 'Scheduler jobs that raised'),
+                         ('missed', 'Scheduler jobs that missed their run time')):
+            gauge(f'gittodo_scheduler_jobs_{key}_total', doc, [({}, sched[key])], 'counter')
+        gauge('gittodo_scheduler_jobs', 'Jobs waiting in the scheduler', [({}, sched['scheduled'])])
+        gauge('gittodo_scheduler_last_lag_seconds',
+              'Delay between the last job\'s run time and its start',
+              [({}, sched['last_lag_secs'])])
+        gauge('gittodo_scheduler_max_lag_seconds',
+              'Longest delay between a job\'s run time and its start',
+              [({}, sched['max_lag_secs'])])
+
+        cache_stats = dict(md_cache_stats(), reminder_dates=reminder_cache_stats())
+        gauge('gittodo_cache_lookups_total', 'Cache lookups, by cache and outcome',
+              [({'cache': cache, 'outcome': outcome}, count)
+               for cache, outcomes in sorted(cache_stats.items())
+               for outcome, count in outcomes.items()],
+              'counter')
+
+        if self.notifier is not None:
+            outbox = self.notifier.outbox_stats()
+            gauge('gittodo_telegram_messages_total', 'Outbound Telegram messages, by outcome',
+                  [({'outcome': key}, outbox.get(key, 0))
+                   for key in ('queued', 'sent', 'coalesced', 'retried', 'dropped')], 'counter')
+            gauge('gittodo_telegram_messages_pending',
+                  'Outbound Telegram messages waiting to be sent', [({}, outbox['pending'])])
+
+        gauge('gittodo_resident_memory_bytes', 'Resident memory of the process',
+              [({}, _rss_bytes())])
+        return metrics.render(extra)
+
+
+def main():
+    """ Parse command line and run the service until interrupted """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('mode', nargs='?', default='all', choices=list(MODES),
+                        help='Components to run (default: all)')
+    parser.add_argument('--config', default='config.json')
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    cfg = load_config(args.config)
+    setup_logging(cfg)
+    service = GitToDo(cfg, args.mode)
+    service.start()
+    log.info("Started GitToDo (%s) in %.0f ms: %s",
+             args.mode,
+             (time.monotonic() - start) * 1000,
+             ', '.join(f'{name} {secs * 1000:.0f} ms'
+                       for name, secs in service.startup_times.items()))
+
+    for todo_list in service.lists:
+        mem = service.list_memory[todo_list.name]
+        log.info("Running list %s: ToDo file @ %s, %s KB of memory",
+                 todo_list.name, todo_list.todo_filepath, '?' if mem is None else mem // 1024)
+        if service.app is not None:
+            log.info("Web UI at http://0.0.0.0:4300%s/ | Raw: raw | Commands: cmd | "
+                     "Test: telegram_test", todo_list.url_prefix)
+    log.info("Stop with `kill %s` or Ctrl-C", os.getpid())
     try:
-        data = request.get_json()
-        cmd_input = data.get('cmd', '')
-        success, result = process_command(cmd_input)
-        return {'success': success, 'result': result}
-    except Exception as ex:
-        return {'success': False, 'result': str(ex)}
-
-
-def parse_todo_file():
-    """ Parse the todo file into sections with their todos """
-    with open(cfg['todo_filepath'], 'r', encoding='utf-8') as f:
-        lines = f.readlines()
-
-    sections = []
-    current_section = None
-
-    for i, line in enumerate(lines):
-        if line.startswith('## '):
-            if current_section:
-                sections.append(current_section)
-            current_section = {
-                'name': line[3:].strip(),
-                'todos': []
-            }
-        elif current_section and line.strip() and not line.startswith('#'):
-            todo_text = line.strip()
-            if todo_text.startswith('* '):
-                todo_text = todo_text[2:]
-            current_section['todos'].append({
-                'line_num': i,
-                'text': todo_text
-            })
-
-    if current_section:
-        sections.append(current_section)
-
-    return sections
-
-@app.route('/')
-def todos_page():
-    """ Interactive todo list page """
-    return send_from_directory('www', 'index.html')
-
-
-@app.route('/api/todos')
-def api_todos():
-    """ API endpoint to get all todos as JSON """
-    sections = parse_todo_file()
-    return {'sections': sections}
-
-
-@app.route('/api/done/<int:line_num>', methods=['POST'])
-def api_done(line_num):
-    """ API endpoint to mark a todo as done """
-    try:
-        result = md_mark_done(cfg['todo_filepath'], line_num)
-        if result is None:
-            return {'success': False, 'error': 'Cannot delete this line'}
-        on_file_updated()
-        return {'success': True}
-    except Exception as ex:
-        return {'success': False, 'error': str(ex)}
-
-
-@app.route('/api/move', methods=['POST'])
-def api_move():
-    """ API endpoint to move a todo up or down """
-    try:
-        data = request.get_json()
-        line_num = data['line']
-        direction = data['direction']
-        result = md_move_todo(cfg['todo_filepath'], line_num, direction)
-        if not result:
-            return {'success': False, 'error': 'Cannot move this todo'}
-        on_file_updated()
-        return {'success': True}
-    except Exception as ex:
-        return {'success': False, 'error': str(ex)}
-
-
-@app.route('/api/add', methods=['POST'])
-def api_add():
-    """ API endpoint to add a new todo """
-    try:
-        data = request.get_json()
-        section = data['section']
-        text = normalize_reminder_token(data['text'])
-        try:
-            maybe_reminder = guess_reminder_date(text)
-            if maybe_reminder is not None:
-                text = mark_for_reminder_date(text, maybe_reminder)
-        except ValueError:
-            pass  # Ignore reminder parsing errors for API
-        md_add_to_section(cfg['todo_filepath'], section, text)
-        on_file_updated()
-        return {'success': True}
-    except Exception as ex:
-        return {'success': False, 'error': str(ex)}
-
-
-def run_flask():
-    """ Run Flask in a separate thread """
-    app.run(host='0.0.0.0', port=4300, debug=False, use_reloader=False)
-
-
-flask_thread = threading.Thread(target=run_flask, daemon=True)
-flask_thread.start()
-
-log.info(
-    "Running GitToDo service. Monitoring ToDo file @ %s",
-    cfg['todo_filepath'])
-log.info("Web UI at http://0.0.0.0:5000/ | Raw: /raw | Commands: /cmd | Test: /telegram_test")
-log.info("Stop with `kill %s` or Ctrl-C", os.getpid())
-try:
-    while True:
-        time.sleep(10)
-except KeyboardInterrupt:
-    log.info("User requested service stop")
+        while True:
+            time.sleep(10)
+    except KeyboardInterrupt:
+        log.info("User requested service stop")
+
+
+if __name__ == '__main__':
+    main()
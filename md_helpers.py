@@ -1,5 +1,839 @@
 """ Helpers to process a markdown file """
 
+import bisect
+import collections
+import functools
+import hashlib
+import itertools
+import logging
+import os
+import re
+import shutil
+import stat
+import tempfile
+import threading
+import time
+
+from done_archive import DoneArchive, archive_paths, index_path
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows: writers will only be serialized within this process
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+
+def _is_section(line):
+    return line.startswith("## ")  # Assumes using ## as the header format
+
+
+def _is_blank(line):
+    return len(line.strip()) == 0
+
+
+def _todo_text(line):
+    txt = line.strip()
+    if txt.startswith('* '):
+        txt = txt[2:]
+    return txt
+
+
+_ID_ALPHABET = 'abcdefghijklmnopqrstuvwxyz'
+_ID_LEN = 6
+
+
+@functools.lru_cache(maxsize=65536)
+def _todo_hash_id(todo_text):
+    """ Compact id derived from the text of a ToDo. Only letters, so it can't be confused with a
+    line number """
+    num = int.from_bytes(hashlib.blake2b(todo_text.encode('utf-8'), digest_size=8).digest(), 'big')
+    chars = []
+    for _ in range(_ID_LEN):
+        num, idx = divmod(num, len(_ID_ALPHABET))
+        chars.append(_ID_ALPHABET[idx])
+    return ''.join(chars)
+
+
+def md_parse_todo_ref(ref):
+    """ A ToDo may be referenced by line number or by id. Returns an int for line numbers, or the
+    id itself. Raises ValueError for negative line numbers, which would count from the end of
+    the file """
+    ref = str(ref).strip()
+    if ref.startswith('-') and ref[1:].isdigit():
+        raise ValueError(f"Bad ToDo number {ref}")
+    if ref.isdigit():
+        return int(ref)
+    return ref.lower()
+
+
+_TOKEN_RE = re.compile(r'\w+')
+
+
+def _tokens(text):
+    """ Search tokens of a text: lowercase words """
+    return set(_TOKEN_RE.findall(text.lower()))
+
+
+class _SearchIndex:
+    """ Inverted index over the ToDos of a document: token -> texts of the ToDos containing it.
+    Documents are copied on every write, so copies share the posting sets with the original, and
+    only copy the ones they modify. """
+
+    def __init__(self, texts=()):
+        # ToDo text -> number of ToDos with that text
+        self._counts = collections.Counter(texts)
+        # Token -> set of ToDo texts
+        self._postings = {}
+        for text in self._counts:
+            for token in _tokens(text):
+                self._postings.setdefault(token, set()).add(text)
+        # Tokens whose posting set belongs to this index (the rest are shared with other copies)
+        self._owned = set(self._postings)
+        # Base id -> number of distinct texts with that id (more than one on hash collisions)
+        self._texts_per_base_id = collections.Counter(map(_todo_hash_id, self._counts))
+
+    def copy(self):
+        """ Copy that can be modified without affecting this index """
+        idx = _SearchIndex.__new__(_SearchIndex)
+        idx._postings = dict(self._postings)
+        idx._owned = set()
+        idx._counts = self._counts.copy()
+        idx._texts_per_base_id = self._texts_per_base_id.copy()
+        return idx
+
+    def _posting_for_update(self, token):
+        if token not in self._owned:
+            self._postings[token] = set(self._postings.get(token, ()))
+            self._owned.add(token)
+        return self._postings[token]
+
+    def add(self, text):
+        """ Index a ToDo text """
+        count = self._counts.get(text, 0)
+        self._counts[text] = count + 1
+        if count > 0:
+            return
+        base_id = _todo_hash_id(text)
+        self._texts_per_base_id[base_id] = self._texts_per_base_id.get(base_id, 0) + 1
+        for token in _tokens(text):
+            self._posting_for_update(token).add(text)
+
+    def remove(self, text):
+        """ Remove a ToDo text (once, if there are many ToDos with this text) """
+        count = self._counts.get(text, 0)
+        if count > 1:
+            self._counts[text] = count - 1
+            return
+        if count == 0:
+            return
+        del self._counts[text]
+        base_id = _todo_hash_id(text)
+        self._texts_per_base_id[base_id] -= 1
+        if self._texts_per_base_id[base_id] == 0:
+            del self._texts_per_base_id[base_id]
+        for token in _tokens(text):
+            posting = self._posting_for_update(token)
+            posting.discard(text)
+            if not posting:
+                del self._postings[token]
+                self._owned.discard(token)
+
+    def search(self, query):
+        """ Yield (text, number of ToDos with that text) for texts that contain all the words in
+        query, in no particular order. Lazy, so callers only pay for the results they use """
+        tokens = _tokens(query)
+        if not tokens:
+            return
+        postings = sorted((self._postings.get(token, ()) for token in tokens), key=len)
+        for text in postings[0]:
+            if all(text in posting for posting in postings[1:]):
+                yield text, self._counts[text]
+
+    def has_collision(self, text):
+        """ True if another indexed text has the same base id as text """
+        return self._texts_per_base_id.get(_todo_hash_id(text), 0) > 1
+
+
+def _section_key(name):
+    """ Normalize a section name for lookups: case and whitespace insensitive """
+    return ' '.join(name.lower().split())
+
+
+class MdSection:
+    """ A section in a document. Lines [start, end) belong to this section, start being the line
+    number of its header and end the line number where the next section (or EOF) starts """
+    __slots__ = ('name', 'key', 'start', 'end', 'n_content')
+
+    def __init__(self, name, start, end, n_content):
+        self.name = name
+        self.key = _section_key(name)
+        self.start = start
+        self.end = end
+        # Number of lines in the section that aren't blank, used to GC empty sections
+        self.n_content = n_content
+
+    def copy(self):
+        """ Shallow copy """
+        return MdSection(self.name, self.start, self.end, self.n_content)
+
+
+class MdTodoDoc:
+    """ A parsed ToDo markdown file: the raw lines of the file, plus an index of its sections.
+    Documents held by the cache are never modified; writers copy() a document, apply mutations
+    to the copy (which keep the section index up to date incrementally) and then store it, so
+    readers holding a reference to an old document are never affected by a write. """
+
+    def __init__(self, lines, file_sig=None):
+        self.lines = lines
+        # (inode, mtime, size) of the file this document was read from, used to detect changes
+        self.file_sig = file_sig
+        # Last time we confirmed the file on disk matches this document
+        self.verified_at_ns = time.time_ns()
+        # True if this document was written by this process, False if it was read from a file
+        self.local_write = False
+        # Set when the document is cached, see _cache_doc
+        self.revision = None
+        # Sections, in file order
+        self.sections = []
+        # Normalized section name -> first section with that name
+        self._section_index = {}
+        # Number of non-blank lines before the first section
+        self._preamble_content = 0
+        # Search index, built on first search and then updated incrementally by writers
+        self._search = None
+        # Id of the ToDo on each line (None for headers and blank lines) and number of ToDos with
+        # each base id. Built on first use, then copied with the document and updated by writers
+        self._line_ids = None
+        self._base_counts = None
+        self._reset_caches()
+
+        current = None
+        for i, line in enumerate(self.lines):
+            if _is_section(line):
+                if current is not None:
+                    current.end = i
+                current = MdSection(line[3:].strip(), i, len(self.lines), 0)
+                self.sections.append(current)
+            elif not _is_blank(line):
+                if current is None:
+                    self._preamble_content += 1
+                else:
+                    current.n_content += 1
+        self._build_section_index()
+
+    def _build_section_index(self):
+        self._section_index = {}
+        for sect in self.sections:
+            self._section_index.setdefault(sect.key, sect)
+
+    def _reset_caches(self):
+        self._text = None
+        self._all_todos = None
+        self._rendered = None
+        self._render_offsets = None
+        self._pages = {}
+        self._parsed_sections = None
+        self._signatures = None
+        # Id -> line number of each ToDo. Any added or deleted line shifts it, so unlike the ids
+        # themselves it isn't kept up to date by writers: built on first lookup
+        self._id_lines = None
+
+    def copy(self):
+        """ Get a mutable copy of this document. Costs a copy of the list of lines (not of the
+        lines themselves), of the section index and of the ToDo ids """
+        doc = MdTodoDoc.__new__(MdTodoDoc)
+        doc.lines = list(self.lines)
+        doc.file_sig = None
+        doc.verified_at_ns = self.verified_at_ns
+        doc.local_write = False
+        doc.revision = None
+        doc.sections = [sect.copy() for sect in self.sections]
+        doc._preamble_content = self._preamble_content
+        doc._search = None if self._search is None else self._search.copy()
+        doc._line_ids = None if self._line_ids is None else list(self._line_ids)
+        doc._base_counts = None if self._base_counts is None else self._base_counts.copy()
+        doc._build_section_index()
+        doc._reset_caches()
+        return doc
+
+    @property
+    def text(self):
+        """ The document as a single string """
+        if self._text is None:
+            self._text = ''.join(self.lines)
+        return self._text
+
+    def todo_count(self):
+        """ Number of ToDos: lines that are neither section headers nor blank """
+        return self._preamble_content + sum(sect.n_content for sect in self.sections)
+
+    def is_empty(self):
+        """ True if the document has no content at all """
+        if len(self.lines) == 0:
+            return True
+        return len(self.lines) == 1 and _is_blank(self.lines[0])
+
+    def find_section(self, name, prefix=True):
+        """ Find a section by name, ignoring case and whitespace. An exact match is an O(1)
+        lookup. If there is no exact match and prefix is set, returns the first section (in file
+        order) whose name starts with name. Returns None if nothing matches. """
+        key = _section_key(name)
+        sect = self._section_index.get(key)
+        if sect is not None or not prefix:
+            return sect
+        for sect in self.sections:
+            if sect.key.startswith(key):
+                return sect
+        return None
+
+    def _build_id_index(self):
+        """ Assign an id to each ToDo: a hash of its text, plus an occurrence count for duplicate
+        texts (or hash collisions). Ids don't depend on line numbers or sections, so they remain
+        valid when other ToDos are added, moved or marked done. """
+        line_ids = []
+        base_counts = collections.Counter()
+        for line in self.lines:
+            if _is_section(line) or _is_blank(line):
+                line_ids.append(None)
+                continue
+            base_id = _todo_hash_id(_todo_text(line))
+            count = base_counts[base_id]
+            base_counts[base_id] = count + 1
+            line_ids.append(base_id if count == 0 else f'{base_id}{count}')
+        self._line_ids = line_ids
+        self._base_counts = base_counts
+
+    def _renumber_ids(self, base_id):
+        """ Ids of ToDos sharing a base id depend on their order in the file: number them again """
+        remaining = self._base_counts[base_id]
+        count = 0
+        for i, todo_id in enumerate(self._line_ids):
+            if count == remaining:
+                break
+            if todo_id is not None and todo_id.startswith(base_id):
+                self._line_ids[i] = base_id if count == 0 else f'{base_id}{count}'
+                count += 1
+
+    def _insert_id(self, line_num, line):
+        """ Keep the ids up to date after line was inserted at line_num """
+        if self._line_ids is None:
+            return
+        if _is_section(line) or _is_blank(line):
+            self._line_ids.insert(line_num, None)
+            return
+        base_id = _todo_hash_id(_todo_text(line))
+        self._line_ids.insert(line_num, base_id)
+        self._base_counts[base_id] += 1
+        if self._base_counts[base_id] > 1:
+            self._renumber_ids(base_id)
+
+    def _delete_id(self, line_num):
+        """ Keep the ids up to date after line_num was deleted """
+        if self._line_ids is None:
+            return
+        todo_id = self._line_ids.pop(line_num)
+        if todo_id is None:
+            return
+        base_id = todo_id[:_ID_LEN]
+        self._base_counts[base_id] -= 1
+        if self._base_counts[base_id] == 0:
+            del self._base_counts[base_id]
+        else:
+            self._renumber_ids(base_id)
+
+    def todo_id(self, line_num):
+        """ Id of the ToDo at line_num, or None if the line isn't a ToDo """
+        if self._line_ids is None:
+            self._build_id_index()
+        if line_num < 0 or line_num >= len(self._line_ids):
+            return None
+        return self._line_ids[line_num]
+
+    def todo_text(self, line_num):
+        """ Text of the ToDo at line_num, without list markers or trailing newline """
+        return _todo_text(self.lines[line_num])
+
+    def resolve_todo(self, todo_ref):
+        """ Get the line number of a ToDo, referenced either by line number or by id (see
+        md_parse_todo_ref). Raises KeyError if there is no ToDo with that id; line numbers are
+        returned as is. Id lookups are O(1), after an O(n) scan on the first one for each version
+        of the document """
+        if isinstance(todo_ref, int):
+            return todo_ref
+        if self._id_lines is None:
+            if self._line_ids is None:
+                self._build_id_index()
+            self._id_lines = {todo_id: line_num for line_num, todo_id in enumerate(self._line_ids)
+                              if todo_id is not None}
+        line_num = self._id_lines.get(todo_ref)
+        if line_num is None:
+            raise KeyError(f"No ToDo with id {todo_ref}")
+        return line_num
+
+    def section_at(self, line_num):
+        """ Return the section a line belongs to, or None for lines before the first section """
+        pos = bisect.bisect_right(self.sections, line_num, key=lambda sect: sect.start)
+        return self.sections[pos - 1] if pos > 0 else None
+
+    def section_lines(self, sect):
+        """ Line numbers of the ToDos in a section: the lines after its header, up to the first
+        blank line """
+        for i in range(sect.start + 1, sect.end):
+            if _is_blank(self.lines[i]):
+                break
+            yield i
+
+    def _shift_sections_after(self, sect, delta):
+        """ Move all sections after sect (or all sections, if sect is None) by delta lines """
+        first = 0 if sect is None else self.sections.index(sect) + 1
+        for later in self.sections[first:]:
+            later.start += delta
+            later.end += delta
+
+    def add_todo(self, section, txt):
+        """ Add a ToDo as the first line of section (which is created if it doesn't exist) """
+        if self._search is not None and not _is_blank(txt):
+            self._search.add(_todo_text(txt))
+        sect = self.find_section(section)
+        if sect is not None:
+            self.lines.insert(sect.start + 1, f"{txt}\n")
+            self._insert_id(sect.start + 1, self.lines[sect.start + 1])
+            sect.end += 1
+            sect.n_content += 1
+            self._shift_sections_after(sect, 1)
+            self._reset_caches()
+            return
+
+        # Separate the new section from whatever was there before with a blank line
+        self.lines.append("\n")
+        start = len(self.lines)
+        self.lines.append(f"## {section}\n")
+        self.lines.append(f"{txt}\n")
+        for line_num in range(start - 1, start + 2):
+            self._insert_id(line_num, self.lines[line_num])
+        if len(self.sections) > 0:
+            self.sections[-1].end = start
+        sect = MdSection(section, start, len(self.lines), 1)
+        self.sections.append(sect)
+        self._section_index.setdefault(sect.key, sect)
+        self._reset_caches()
+
+    def delete_line(self, line_num):
+        """ Delete a line. Returns the deleted line, or None if line_num is a section header.
+        Raises IndexError if the line doesn't exist. """
+        line = self.lines[line_num]
+        if _is_section(line):
+            return None
+        if line_num < 0:
+            line_num += len(self.lines)
+
+        if self._search is not None and not _is_blank(line):
+            self._search.remove(_todo_text(line))
+        sect = self.section_at(line_num)
+        del self.lines[line_num]
+        self._delete_id(line_num)
+        if sect is None:
+            if not _is_blank(line):
+                self._preamble_content -= 1
+        else:
+            sect.end -= 1
+            if not _is_blank(line):
+                sect.n_content -= 1
+        self._shift_sections_after(sect, -1)
+        self._reset_caches()
+        return line
+
+    def swap_lines(self, line_a, line_b):
+        """ Swap two ToDos. Both lines must be content (not headers nor blank) in the same
+        section, so the section index doesn't change. """
+        self.lines[line_a], self.lines[line_b] = self.lines[line_b], self.lines[line_a]
+        if self._line_ids is not None:
+            ids = self._line_ids
+            ids[line_a], ids[line_b] = ids[line_b], ids[line_a]
+            base_a = None if ids[line_a] is None else ids[line_a][:_ID_LEN]
+            if base_a is not None and ids[line_b] is not None and base_a == ids[line_b][:_ID_LEN]:
+                self._renumber_ids(base_a)
+        self._reset_caches()
+
+    def gc_empty_sections(self):
+        """ Remove sections without any content. Blank lines before the first section are
+        removed too, unless there is some content there. """
+        preamble_len = self.sections[0].start if self.sections else len(self.lines)
+        gc_preamble = preamble_len > 0 and self._preamble_content == 0
+        if not gc_preamble and all(sect.n_content > 0 for sect in self.sections):
+            return
+
+        keep = [sect for sect in self.sections if sect.n_content > 0]
+        lines = [] if gc_preamble else self.lines[:preamble_len]
+        # Only blank lines and headers are dropped, the ids of the ToDos don't change
+        line_ids = None
+        if self._line_ids is not None:
+            line_ids = [] if gc_preamble else self._line_ids[:preamble_len]
+        for sect in keep:
+            sect_lines = self.lines[sect.start:sect.end]
+            if line_ids is not None:
+                line_ids.extend(self._line_ids[sect.start:sect.end])
+            sect.start = len(lines)
+            sect.end = sect.start + len(sect_lines)
+            lines.extend(sect_lines)
+
+        self.lines = lines
+        self._line_ids = line_ids
+        self.sections = keep
+        self._build_section_index()
+        self._reset_caches()
+
+    def search(self, query, limit):
+        """ ToDos containing all words in query (case insensitive), as dicts with an id and the
+        text of the ToDo. At most limit results; they are sorted by text, but when there are more
+        than limit matches, which ones are returned is arbitrary """
+        if self._search is None:
+            self._search = _SearchIndex(_todo_text(line) for line in self.lines
+                                        if not _is_section(line) and not _is_blank(line))
+
+        results = []
+        matches = sorted(itertools.islice(self._search.search(query), limit))
+        for text, count in matches:
+            if self._search.has_collision(text):
+                # Rare: ids of texts sharing a base id depend on their order in the file
+                if self._line_ids is None:
+                    self._build_id_index()
+                ids = [todo_id for line_num, todo_id in enumerate(self._line_ids)
+                       if todo_id is not None and _todo_text(self.lines[line_num]) == text]
+            else:
+                base_id = _todo_hash_id(text)
+                ids = [base_id] + [f'{base_id}{i}' for i in range(1, count)]
+            results.extend({'id': todo_id, 'text': text} for todo_id in ids)
+            if len(results) >= limit:
+                return results[:limit]
+        return results
+
+    def render(self, skip_non_todos):
+        """ Get all lines, with a ToDo number prepended to lines that aren't sections """
+        lns = []
+        for i, line in enumerate(self.lines):
+            if _is_section(line) or _is_blank(line):
+                if not skip_non_todos:
+                    lns.append(line)
+            else:
+                if line.startswith('* '):
+                    line = line[len('* '):]
+                lns.append(f'{i} - {line}')
+        return lns
+
+    def all_todos(self):
+        """ Numbered ToDo lines (cached, treat as read only) """
+        if self._all_todos is None:
+            self._all_todos = self.render(skip_non_todos=True)
+        return self._all_todos
+
+    def rendered(self):
+        """ The full numbered document as a single string (cached) """
+        if self._rendered is None:
+            self._rendered = ''.join(self.render(skip_non_todos=False))
+        return self._rendered
+
+    def render_offsets(self):
+        """ Offset of each line in rendered(), plus one past the end (cached) """
+        if self._render_offsets is None:
+            self._render_offsets = [0]
+            self._render_offsets.extend(
+                itertools.accumulate(len(line) for line in self.render(False)))
+        return self._render_offsets
+
+    def pages(self, first_line, end_line, max_chars):
+        """ Split lines [first_line, end_line) of rendered() in pages of at most max_chars. Pages
+        end at a line boundary, unless a single line doesn't fit in a page. Returns a list of
+        (start, end) offsets into rendered() (cached) """
+        key = (first_line, end_line, max_chars)
+        if key in self._pages:
+            return self._pages[key]
+
+        offsets = self.render_offsets()
+        pos, end = offsets[first_line], offsets[end_line]
+        pages = []
+        while pos < end:
+            limit = pos + max_chars
+            if limit >= end:
+                pages.append((pos, end))
+                break
+            # Last line boundary that fits in this page
+            cut = offsets[bisect.bisect_right(offsets, limit, first_line, end_line + 1) - 1]
+            if cut <= pos:
+                cut = limit
+            pages.append((pos, cut))
+            pos = cut
+        self._pages[key] = pages
+        return pages
+
+    def parsed_sections(self):
+        """ Sections with their ToDos, as a list of dicts (cached, treat as read only) """
+        if self._parsed_sections is not None:
+            return self._parsed_sections
+
+        parsed = []
+        for sect in self.sections:
+            todos = []
+            for i in range(sect.start + 1, sect.end):
+                line = self.lines[i]
+                if _is_blank(line) or line.startswith('#'):
+                    continue
+                todos.append({'id': self.todo_id(i), 'line_num': i, 'text': _todo_text(line)})
+            parsed.append({'name': sect.name, 'todos': todos})
+
+        self._parsed_sections = parsed
+        return parsed
+
+    def has_ids(self):
+        """ True if the ids of this document's ToDos were already computed """
+        return self._line_ids is not None
+
+    def section_signatures(self):
+        """ For each section, a (hash of its name, lines and ToDo ids, line number of its first
+        ToDo or None) pair. Enough to tell which sections of a later revision are unchanged, and
+        how far they moved, without keeping this document around (cached) """
+        if self._signatures is not None:
+            return self._signatures
+
+        if self._line_ids is None:
+            self._build_id_index()
+        signatures = []
+        for sect in self.sections:
+            lines = self.lines[sect.start + 1:sect.end]
+            ids = tuple(self._line_ids[sect.start + 1:sect.end])
+            first = next((sect.start + 1 + i for i, line in enumerate(lines)
+                          if not _is_blank(line) and not line.startswith('#')), None)
+            signatures.append((hash((sect.name, tuple(lines), ids)), first))
+        self._signatures = signatures
+        return signatures
+
+
+# Cache of parsed documents, keyed by absolute file path
+_docs = {}
+_docs_lock = threading.Lock()
+
+# Each document gets a new revision number when it's cached. Revisions only ever grow (across all
+# files), so clients can use them to ask for changes since the version they have
+_revisions = itertools.count(1)
+# Section signatures of the last few revisions of each file, keyed by absolute file path, to
+# compute deltas between revisions: deque of (revision, MdTodoDoc.section_signatures() or None).
+# Old documents themselves aren't kept, a large file would take that much memory per revision
+_HISTORY_LEN = 32
+_history = {}
+
+# Locks to serialize writers, keyed by absolute file path. Readers don't need one: they always get
+# a complete document, either from the cache or from a file that is only ever replaced atomically.
+_write_locks = {}
+# Done archive per file, see md_get_history
+_archives = {}
+# Archive log path per file, for files whose archive isn't next to them (see md_set_archive_path)
+_archive_locations = {}
+
+
+class _WriteLock:
+    """ Reentrant lock that serializes writers of a file both across threads and across processes
+    (eg several server workers, or several instances of the service). The cross-process part is an
+    flock on the file's directory: the file itself is replaced on every write, so its inode can't
+    be locked, and a directory doesn't leave a stray lock file in the user's repo. """
+
+    def __init__(self, file_path):
+        self._dir_path = os.path.dirname(os.path.realpath(file_path))
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._dir_fd = None
+
+    def acquire(self):
+        """ Acquire, blocking until no other thread or process holds the lock """
+        self._thread_lock.acquire()
+        if self._depth == 0 and fcntl is not None:
+            try:
+                if self._dir_fd is None:
+                    self._dir_fd = os.open(self._dir_path, os.O_RDONLY)
+                fcntl.flock(self._dir_fd, fcntl.LOCK_EX)
+            except BaseException:
+                self._thread_lock.release()
+                raise
+        self._depth += 1
+
+    def release(self):
+        """ Release, other processes may write once the outermost acquire is released """
+        self._depth -= 1
+        if self._depth == 0 and self._dir_fd is not None:
+            fcntl.flock(self._dir_fd, fcntl.LOCK_UN)
+        self._thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *_):
+        self.release()
+
+# Filesystem timestamps are coarse: a file may be rewritten (with the same size) without its mtime
+# changing. If a file was modified shortly before we last saw it, its signature can't be trusted
+# and the content needs to be compared too.
+_RACY_WINDOW_NS = 2 * 10**9
+
+
+def _file_sig(md_path):
+    st = os.stat(md_path)
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def _cache_doc(key, doc):
+    with _docs_lock:
+        prev = _docs.get(key)
+        doc.revision = next(_revisions)
+        _docs[key] = doc
+        if prev is not None:
+            # Clients can only hold revisions they were sent ToDos (and so ids) for: there's no
+            # need to compute ids just to remember the signatures of a revision nobody saw
+            signatures = prev.section_signatures() if prev.has_ids() else None
+            history = _history.setdefault(key, collections.deque(maxlen=_HISTORY_LEN))
+            history.append((prev.revision, signatures))
+
+
+# md_load outcomes: 'hit' (cached, file unchanged), 'revalidated' (file read again, but it had the
+# same content) or 'miss' (file read and parsed)
+_load_stats = collections.Counter()
+_load_stats_lock = threading.Lock()
+
+
+def _count_load(outcome):
+    with _load_stats_lock:
+        _load_stats[outcome] += 1
+
+
+def md_cache_stats():
+    """ Hit counts of the caches in this module: {cache name: {outcome: count}} """
+    with _load_stats_lock:
+        docs = dict(_load_stats)
+    ids = _todo_hash_id.cache_info()
+    return {
+        'docs': {outcome: docs.get(outcome, 0) for outcome in ('hit', 'revalidated', 'miss')},
+        'todo_ids': {'hit': ids.hits, 'miss': ids.misses},
+    }
+
+
+def md_load(md_path):
+    """ Get the parsed document for md_path. The file is only read and parsed again if its
+    inode, mtime or size changed since the last time it was loaded. """
+    key = os.path.abspath(md_path)
+    # Stat before reading: if the file changes while we read it, the next call will see a new
+    # signature and re-read it
+    sig = _file_sig(md_path)
+    now = time.time_ns()
+    doc = _docs.get(key)
+    if doc is not None and doc.file_sig == sig:
+        if sig[1] + _RACY_WINDOW_NS < doc.verified_at_ns:
+            _count_load('hit')
+            return doc
+
+    with open(md_path, 'r', encoding="utf-8") as file:
+        lines = file.readlines()
+
+    if doc is not None and doc.lines == lines:
+        # Same content (maybe just touched): keep the document and its revision
+        doc.file_sig = sig
+        doc.verified_at_ns = now
+        _count_load('revalidated')
+        return doc
+
+    _count_load('miss')
+    doc = MdTodoDoc(lines, sig)
+    doc.verified_at_ns = now
+    _cache_doc(key, doc)
+    return doc
+
+
+# How hard to try to make writes survive a crash or power loss:
+#   'none': rely on the OS to flush the file eventually
+#   'file': fsync the new file before it replaces the old one
+#   'full': also fsync the directory, so the rename itself is durable
+# Writes are atomic regardless of this setting: readers see either the old or the new file
+DURABILITY_LEVELS = ('none', 'file', 'full')
+_durability = 'file'
+
+
+def md_set_durability(level):
+    """ Set durability level for all writes, see DURABILITY_LEVELS """
+    global _durability  # pylint: disable=global-statement
+    if level not in DURABILITY_LEVELS:
+        raise ValueError(f"Unknown durability level '{level}', expected one of {DURABILITY_LEVELS}")
+    _durability = level
+
+
+def _atomic_write(file_path, content):
+    """ Write content to a temp file next to file_path, then rename it over file_path. A crash
+    (or a concurrent reader) will see either the old or the new content, never a partial file """
+    # Write through symlinks, instead of replacing the link with a regular file
+    file_path = os.path.realpath(file_path)
+    dir_path = os.path.dirname(file_path)
+    fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix=f'.{os.path.basename(file_path)}.')
+    try:
+        with os.fdopen(fd, 'w', encoding="utf-8") as file:
+            file.write(content)
+            file.flush()
+            if _durability != 'none':
+                os.fsync(file.fileno())
+        try:
+            os.chmod(tmp_path, stat.S_IMODE(os.stat(file_path).st_mode))
+        except FileNotFoundError:
+            pass
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+    if _durability == 'full':
+        dir_fd = os.open(dir_path, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+def _md_store(md_path, doc):
+    """ Write a (modified copy of a) document to md_path and cache it """
+    _atomic_write(md_path, doc.text)
+
+    doc.file_sig = _file_sig(md_path)
+    doc.verified_at_ns = time.time_ns()
+    doc.local_write = True
+    _cache_doc(os.path.abspath(md_path), doc)
+    return doc
+
+
+# Revision of the last document md_changed_externally() saw, keyed by absolute file path
+_external_seen = {}
+
+
+def md_changed_externally(md_path):
+    """ True if md_path was changed by another program (an editor, a git pull...) since the last
+    call. Writes made through this module aren't reported: their callers already know about them """
+    doc = md_load(md_path)
+    key = os.path.abspath(md_path)
+    with _docs_lock:
+        prev_rev = _external_seen.get(key)
+        _external_seen[key] = doc.revision
+    return prev_rev is not None and doc.revision != prev_rev and not doc.local_write
+
+
+def md_write_lock(md_path):
+    """ Get the (reentrant) lock that serializes all writes to md_path, across threads and
+    processes. Writers in this module already take it; hold it to keep them out while the file is
+    changed by other means (eg a git pull) """
+    with _docs_lock:
+        key = os.path.abspath(md_path)
+        if key not in _write_locks:
+            _write_locks[key] = _WriteLock(md_path)
+        return _write_locks[key]
+
 
 def md_create_if_not_exists(file_path):
     """ Create file if not exists """
@@ -13,27 +847,15 @@ def md_create_if_not_exists(file_path):
 
 def _md_get_content(md_path, skip_non_todos, as_line_array):
     """ Get all MD lines, add a ToDo number to lines that aren't sections """
-    with open(md_path, 'r', encoding="utf-8") as file:
-        lines = file.readlines()
-
-    if len(lines) == 0:
-        return '<empty>'
-    if len(lines) == 1 and len(lines[0].strip()) == 0:
+    doc = md_load(md_path)
+    if doc.is_empty():
         return '<empty>'
 
-    lns = []
-    for i, line in enumerate(lines):
-        if line.startswith("## ") or len(line.strip()) == 0:
-            if not skip_non_todos:
-                lns.append(line)
-        else:
-            if line.startswith('* '):
-                line = line[len('* '):]
-            lns.append(f'{i} - {line}')
-
     if as_line_array:
-        return lns
-    return ''.join(lns)
+        return doc.all_todos() if skip_non_todos else doc.render(skip_non_todos)
+    if skip_non_todos:
+        return ''.join(doc.all_todos())
+    return doc.rendered()
 
 
 def md_get_all_todos(md_path):
@@ -46,15 +868,56 @@ def md_get_all(md_path):
     return _md_get_content(md_path, skip_non_todos=False, as_line_array=False)
 
 
+def md_get_parsed_sections(md_path):
+    """ Return a list of sections, each with its name and a list of ToDos with their line number """
+    return md_load(md_path).parsed_sections()
+
+
+def md_get_sections_delta(md_path, since_rev):
+    """ Get (revision, delta) for the current version of md_path, relative to revision since_rev.
+    The delta is a list with an entry per section, either a section (like in
+    md_get_parsed_sections) or {'same': i, 'shift': n} for a section that is the same as section i
+    of revision since_rev, but moved by n lines. delta is None if since_rev is too old (or
+    unknown), in which case the caller should get all sections instead """
+    doc = md_load(md_path)
+    if since_rev == doc.revision:
+        base = doc.section_signatures()
+    else:
+        with _docs_lock:
+            history = list(_history.get(os.path.abspath(md_path), ()))
+        base = next((signatures for rev, signatures in history if rev == since_rev), None)
+    if base is None:
+        return doc.revision, None
+
+    # Signature -> indexes of sections in base with that signature
+    unchanged = {}
+    for i, (signature, _) in enumerate(base):
+        unchanged.setdefault(signature, collections.deque()).append(i)
+
+    delta = []
+    for sect, (signature, first) in zip(doc.parsed_sections(), doc.section_signatures()):
+        same = unchanged.get(signature)
+        if same:
+            i = same.popleft()
+            base_first = base[i][1]
+            delta.append({'same': i, 'shift': 0 if base_first is None else first - base_first})
+        else:
+            delta.append(sect)
+    return doc.revision, delta
+
+
+def md_find_section(md_path, section, prefix=True):
+    """ Return the name of the section matching section (ignoring case and whitespace) or None.
+    If prefix is set and there is no exact match, the first section starting with section
+    matches (eg "work" will find "## Work stuff") """
+    sect = md_load(md_path).find_section(section, prefix)
+    return None if sect is None else sect.name
+
+
 def md_get_sections(md_path):
     """ Get sections in a todo markdown file """
-    with open(md_path, 'r', encoding="utf-8") as file:
-        lines = file.readlines()
-
-    sections = []
-    for line in lines:
-        if line.startswith("## "):  # Assumes using ## as the header format
-            sections.append(line)
+    doc = md_load(md_path)
+    sections = [doc.lines[sect.start] for sect in doc.sections]
 
     if len(sections) == 0:
         return '<No sections found>'
@@ -66,135 +929,243 @@ def md_get_section_contents(md_path, section):
     if len(section) == 0:
         raise ValueError("Section can't be empty")
 
-    with open(md_path, 'r', encoding="utf-8") as file:
-        lines = file.readlines()
+    doc = md_load(md_path)
+    sect = doc.find_section(section)
+    if sect is None:
+        return f'<No section {section}>'
 
-    section_found = False
     section_todos = []
+    for i in doc.section_lines(sect):
+        line = doc.lines[i]
+        if line.startswith('* '):
+            line = line[len('* '):]
+        section_todos.append(f'{i} - {line}')
 
-    for i, line in enumerate(lines):
-        if line.startswith(
-                f"## {section}"):  # Assumes using ## as the header format
-            section_found = True
-            continue
-        if section_found:
-            if line.startswith('## ') or len(
-                    line.strip()) == 0:  # Found a new section
-                break
-            if line.startswith('* '):
-                line = line[len('* '):]
-            section_todos.append(f'{i} - {line}')
-
-    if not section_found:
-        return f'<No section {section}>'
     if len(section_todos) == 0:
         return f'<{section} is empty>'
     return ''.join(section_todos)
 
 
-def md_add_to_section(md_path, section, txt):
-    """ Append a ToDo to a markdown section """
+def md_search(md_path, query, limit=50):
+    """ Find ToDos containing all words in query, see MdTodoDoc.search """
+    return md_load(md_path).search(query, limit)
+
+
+def md_set_archive_path(md_path, log_path):
+    """ Keep the done archive of md_path in log_path (and its index next to it, see
+    done_archive.index_path) instead of next to the ToDo file, where it shows up as untracked files
+    in the ToDo file's git checkout. An archive already next to the ToDo file is moved there. Call
+    before the archive is used """
+    key = os.path.abspath(md_path)
+    log_path = os.path.abspath(log_path)
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    old_log, old_idx = archive_paths(key)
+    if old_log != log_path and os.path.exists(old_log) and not os.path.exists(log_path):
+        log.info("Moving done archive %s to %s", old_log, log_path)
+        shutil.move(old_log, log_path)
+        # A missing index is rebuilt from the log, but moving it saves a scan
+        if os.path.exists(old_idx):
+            shutil.move(old_idx, index_path(log_path))
+    with _docs_lock:
+        _archive_locations[key] = log_path
+        _archives.pop(key, None)
+
+
+def _done_archive(md_path):
+    key = os.path.abspath(md_path)
+    with _docs_lock:
+        if key not in _archives:
+            if key in _archive_locations:
+                log_path = _archive_locations[key]
+                _archives[key] = DoneArchive(log_path, index_path(log_path))
+            else:
+                _archives[key] = DoneArchive(*archive_paths(key))
+        return _archives[key]
+
+
+def _archive_done(md_path, archived):
+    """ Append ToDos marked done to the archive. The ToDo file was already written, so failing to
+    archive them is logged but doesn't fail the write """
+    if not archived:
+        return
+    try:
+        _done_archive(md_path).append(archived, fsync=_durability != 'none')
+    except OSError:
+        log.error("Failed to archive %d done ToDos for %s", len(archived), md_path, exc_info=True)
+
+
+def md_get_history(md_path, limit, skip=0):
+    """ Recently completed ToDos, most recent first: (total archived, list of dicts with 'ts',
+    'section' and 'text'). See DoneArchive.recent """
+    archive = _done_archive(md_path)
+    return archive.count(), archive.recent(limit, skip)
+
+
+def md_get_page(md_path, page, max_chars, section=None):
+    """ Like md_get_all (or md_get_section_contents, if section is set) but split in pages of at
+    most max_chars. Returns (text, page, n_pages); page is clamped to the last one. Pages are
+    served from the cached document: only the first request for a page size has to index it """
+    doc = md_load(md_path)
+    if section is None:
+        if doc.is_empty():
+            return '<empty>', 0, 1
+        first_line, end_line = 0, len(doc.lines)
+    else:
+        if len(section) == 0:
+            raise ValueError("Section can't be empty")
+        sect = doc.find_section(section)
+        if sect is None:
+            return f'<No section {section}>', 0, 1
+        todo_lines = list(doc.section_lines(sect))
+        if len(todo_lines) == 0:
+            return f'<{section} is empty>', 0, 1
+        first_line, end_line = todo_lines[0], todo_lines[-1] + 1
+
+    pages = doc.pages(first_line, end_line, max_chars)
+    page = max(0, min(page, len(pages) - 1))
+    start, end = pages[page]
+    return doc.rendered()[start:end], page, len(pages)
+
+
+def _apply_add(doc, section, txt):
     if len(section) == 0:
         raise ValueError("Section can't be empty")
     if len(txt) == 0:
         raise ValueError("ToDo can't be empty")
 
-    with open(md_path, 'r', encoding="utf-8") as file:
-        lines = file.readlines()
-
     if not txt.startswith('* '):
         txt = '* ' + txt
 
-    section_found = False
+    doc.add_todo(section, txt)
+    return True, None
 
-    for i, line in enumerate(lines):
-        if line.lower().startswith(
-                f"## {section.lower()}"):  # Assumes using ## as the header format
-            section_found = True
-            lines.insert(i + 1, f"{txt}\n")
-            break
 
-    if not section_found:
-        lines.append(f"\n## {section}\n")
-        lines.append(f"{txt}\n")
+def _apply_done(doc, todo_ref, archived):
+    line_num = doc.resolve_todo(todo_ref)
+    if line_num < 0:
+        # Would delete a line counting from the end of the file
+        raise IndexError(f"Bad ToDo number {todo_ref}")
+    sect = doc.section_at(line_num % len(doc.lines)) if doc.lines else None
+    deld_line = doc.delete_line(line_num)
+    if deld_line is not None and not _is_blank(deld_line):
+        archived.append((None if sect is None else sect.name, _todo_text(deld_line)))
+    # None means this is a section/header
+    return deld_line is not None, deld_line
 
-    with open(md_path, 'w', encoding="utf-8") as file:
-        file.writelines(lines)
 
+def _apply_move(doc, todo_ref, direction):
+    todo_num = doc.resolve_todo(todo_ref)
+    if todo_num < 0 or todo_num >= len(doc.lines):
+        return False, False
 
-def md_gc_empty_sections(file_path):
-    """ Clean emtpy sections from a markdown file """
-    with open(file_path, 'r', encoding="utf-8") as file:
-        lines = file.readlines()
+    # Can't move section headers
+    if _is_section(doc.lines[todo_num]):
+        return False, False
 
-    gcd_lines = []
-    this_section = []
-    has_content = False
+    target_num = todo_num + direction
 
-    for line in lines:
-        if line.startswith("## "):
-            if has_content:
-                gcd_lines.extend(this_section)
-            has_content = False
-            this_section = []
-        if not (line.startswith("## ") or len(line.strip()) == 0):
-            has_content = True
-        this_section.append(line)
+    if target_num < 0 or target_num >= len(doc.lines):
+        return False, False
 
-    # If we reach EOF:
-    if has_content:
-        gcd_lines.extend(this_section)
+    # Can't swap with section headers or empty lines
+    if _is_section(doc.lines[target_num]) or _is_blank(doc.lines[target_num]):
+        return False, False
 
-    # Write back the modified content to the file
-    with open(file_path, 'w', encoding="utf-8") as file:
-        file.writelines(gcd_lines)
+    doc.swap_lines(todo_num, target_num)
+    return True, True
 
 
-def md_mark_done(file_path, todo_num):
-    """ Mark a ToDo done by line number """
-    with open(file_path, 'r', encoding="utf-8") as file:
-        lines = file.readlines()
+_OPS = {
+    'add': _apply_add,
+    'done': _apply_done,
+    'move': _apply_move,
+}
 
-    if lines[todo_num].startswith("## "):  # This is a section/header
-        return None
 
-    deld_line = lines[todo_num]
-    del lines[todo_num]
+def md_apply(md_path, ops):
+    """ Apply a batch of operations to a ToDo file, with a single read and a single write. Each op
+    is a tuple of (op name, args...), one of:
+        ('add', section, txt)
+        ('done', todo_ref)
+        ('move', todo_ref, direction)
+    todo_ref is either a line number or a ToDo id (see md_parse_todo_ref). Ops are applied in
+    order, so line numbers refer to the document as left by the previous op (eg mark ToDos done
+    in reverse order to keep the numbers of the rest stable, or see md_done_ops). If any ToDo was
+    marked done, empty sections are cleaned up once, after all ops are applied.
 
-    with open(file_path, 'w', encoding="utf-8") as file:
-        file.writelines(lines)
+    Returns a tuple (changed, results): changed is True if the file was written, results has one
+    entry per op, with the same value the single-op function would return (md_add_to_section,
+    md_mark_done or md_move_todo). An op that fails with a LookupError (a line or id that doesn't
+    exist) or a ValueError has the exception as its result, and doesn't stop the rest of the
+    batch. ToDos marked done are appended to the file's done archive (see md_get_history). """
+    with md_write_lock(md_path):
+        doc = md_load(md_path).copy()
+        changed = False
+        needs_gc = False
+        results = []
+        # (section, text) of ToDos marked done
+        archived = []
+        for op in ops:
+            try:
+                extra = (archived,) if op[0] == 'done' else ()
+                op_changed, result = _OPS[op[0]](doc, *op[1:], *extra)
+            except (LookupError, ValueError) as ex:
+                op_changed, result = False, ex
+            changed = changed or op_changed
+            needs_gc = needs_gc or (op_changed and op[0] == 'done')
+            results.append(result)
 
-    md_gc_empty_sections(file_path)
-    return deld_line
+        if needs_gc:
+            doc.gc_empty_sections()
+        if changed:
+            _md_store(md_path, doc)
+            _archive_done(md_path, archived)
+    return changed, results
 
 
-def md_move_todo(file_path, todo_num, direction):
-    """ Move a ToDo up or down by swapping with adjacent line.
-        direction: -1 for up, 1 for down
-        Returns True if moved, False otherwise """
-    with open(file_path, 'r', encoding="utf-8") as file:
-        lines = file.readlines()
+def _md_apply_one(md_path, op):
+    _, results = md_apply(md_path, [op])
+    if isinstance(results[0], Exception):
+        raise results[0]
+    return results[0]
 
-    if todo_num < 0 or todo_num >= len(lines):
-        return False
 
-    # Can't move section headers
-    if lines[todo_num].startswith("## "):
-        return False
+def md_add_to_section(md_path, section, txt):
+    """ Append a ToDo to a markdown section """
+    _md_apply_one(md_path, ('add', section, txt))
 
-    target_num = todo_num + direction
 
-    if target_num < 0 or target_num >= len(lines):
-        return False
+def md_gc_empty_sections(file_path):
+    """ Clean emtpy sections from a markdown file """
+    with md_write_lock(file_path):
+        doc = md_load(file_path).copy()
+        doc.gc_empty_sections()
+        _md_store(file_path, doc)
+
 
-    # Can't swap with section headers or empty lines
-    if lines[target_num].startswith("## ") or len(lines[target_num].strip()) == 0:
-        return False
+def md_done_ops(md_path, todo_refs):
+    """ Build a list of ops for md_apply to mark a list of ToDos done, given by line number or id.
+    Ops are sorted bottom-up, so that deleting a line doesn't shift the line number (or, for
+    duplicated ToDos, the id) of the ones still to be deleted """
+    doc = md_load(md_path)
 
-    # Swap the lines
-    lines[todo_num], lines[target_num] = lines[target_num], lines[todo_num]
+    def sort_key(ref):
+        try:
+            return doc.resolve_todo(ref)
+        except KeyError:
+            return -1
 
-    with open(file_path, 'w', encoding="utf-8") as file:
-        file.writelines(lines)
+    refs = sorted((md_parse_todo_ref(ref) for ref in todo_refs), key=sort_key, reverse=True)
+    return [('done', ref) for ref in refs]
 
-    return True
+
+def md_mark_done(file_path, todo_ref):
+    """ Mark a ToDo done by line number or id """
+    return _md_apply_one(file_path, ('done', todo_ref))
+
+
+def md_move_todo(file_path, todo_ref, direction):
+    """ Move a ToDo up or down by swapping with adjacent line.
+        direction: -1 for up, 1 for down
+        Returns True if moved, False otherwise """
+    return _md_apply_one(file_path, ('move', todo_ref, direction))
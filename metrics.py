@@ -0,0 +1,149 @@
+""" Minimal metrics (counters and latency histograms), rendered in Prometheus' text exposition
+format. Modules declare the metrics they update at import time; values that are cheaper to read
+when scraped (queue lengths, file sizes...) are passed to render() as samples instead """
+
+import threading
+import time
+
+# Seconds; covers from a cached read to a slow git push
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(val)}"' for key, val in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_metric(name, metric_type, doc, samples):
+    """ Text for one metric. samples is a list of (labels dict, value), or of (name suffix,
+    labels dict, value) for metrics with several series (eg histograms). Samples with a None
+    value are skipped """
+    lines = [f'# HELP {name} {doc}', f'# TYPE {name} {metric_type}']
+    for sample in samples:
+        suffix, labels, value = sample if len(sample) == 3 else ('', *sample)
+        if value is None:
+            continue
+        labels = labels.items() if isinstance(labels, dict) else labels
+        lines.append(f'{name}{suffix}{_format_labels(labels)} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+class Counter:
+    """ Monotonic counter, with one series per set of label values """
+
+    def __init__(self, name, doc, label_names=()):
+        self.name = name
+        self.doc = doc
+        self._label_names = label_names
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *label_values, amount=1):
+        """ Add amount to the series for label_values (given in label_names order) """
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        """ Prometheus text for this metric """
+        with self._lock:
+            values = sorted(self._values.items())
+        return format_metric(self.name, 'counter', self.doc,
+                             [(tuple(zip(self._label_names, key)), value) for key, value in values])
+
+
+class Histogram:
+    """ Distribution of durations (or any other value), with one series per set of label values """
+
+    def __init__(self, name, doc, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self._label_names = label_names
+        self._buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # Label values -> [count per bucket..., sum, count]
+        self._series = {}
+
+    def observe(self, value, *label_values):
+        """ Record a value for label_values (given in label_names order) """
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self._buckets) + 2)
+            for i, bound in enumerate(self._buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def time(self, *label_values):
+        """ Context manager that observes how long its block took, in seconds """
+        return _Timer(self, label_values)
+
+    def render(self):
+        """ Prometheus text for this metric """
+        with self._lock:
+            all_series = sorted((key, list(series)) for key, series in self._series.items())
+        samples = []
+        for key, series in all_series:
+            labels = tuple(zip(self._label_names, key))
+            cumulative = 0
+            for bound, count in zip(self._buckets, series):
+                cumulative += count
+                bound_label = ('le', _format_value(float(bound)))
+                samples.append(('_bucket', labels + (bound_label,), cumulative))
+            samples.append(('_bucket', labels + (('le', '+Inf'),), series[-1]))
+            samples.append(('_sum', labels, series[-2]))
+            samples.append(('_count', labels, series[-1]))
+        return format_metric(self.name, 'histogram', self.doc, samples)
+
+
+class _Timer:
+    def __init__(self, histogram, label_values):
+        self._histogram = histogram
+        self._label_values = label_values
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        self._histogram.observe(time.perf_counter() - self._start, *self._label_values)
+
+
+def _register(metric):
+    with _registry_lock:
+        _registry.append(metric)
+    return metric
+
+
+def counter(name, doc, label_names=()):
+    """ Declare a counter, included in every render() """
+    return _register(Counter(name, doc, label_names))
+
+
+def histogram(name, doc, label_names=(), buckets=DEFAULT_BUCKETS):
+    """ Declare a histogram, included in every render() """
+    return _register(Histogram(name, doc, label_names, buckets))
+
+
+def render(extra=()):
+    """ Prometheus text for all declared metrics, plus extra (text blocks from format_metric) """
+    with _registry_lock:
+        metrics = list(_registry)
+    return ''.join(metric.render() for metric in metrics) + ''.join(extra)
@@ -0,0 +1,60 @@
+""" Send-only Telegram notifications (reminders, git failures) for the chats of a list. Messages go
+through an OutboundQueue, so scheduler threads never block on Telegram. Used by the Telegram bot,
+and on its own by processes that send notifications without serving commands (see main.MODES):
+it never polls for updates, so it can run next to a bot process using the same token """
+
+import json
+import logging
+import urllib.error
+import urllib.request
+
+from outbox import OutboundQueue
+from reminders import strip_reminder_tokens
+
+log = logging.getLogger(__name__)
+
+_API_URL = 'https://api.telegram.org/bot{tok}/{method}'
+_API_TIMEOUT_SECS = 30
+
+
+def api_sender(tok):
+    """ send_message(chat_id, text) function that calls Telegram's Bot API directly. Raises on
+    failure; errors carry the 'parameters' Telegram sent, eg how long to wait after a 429 """
+    url = _API_URL.format(tok=tok, method='sendMessage')
+
+    def send_message(chat_id, text):
+        body = json.dumps({'chat_id': chat_id, 'text': text}).encode('utf-8')
+        req = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(req, timeout=_API_TIMEOUT_SECS) as resp:
+                resp.read()
+        except urllib.error.HTTPError as ex:
+            try:
+                ex.parameters = json.loads(ex.read().decode('utf-8')).get('parameters')
+            except (ValueError, AttributeError):
+                pass
+            raise
+    return send_message
+
+
+class TelegramNotifier:
+    """ Queues notifications for send_fn(chat_id, text) (eg a bot's send_message, or api_sender) """
+
+    def __init__(self, send_fn, reminder_digest_secs=5):
+        # Bursts don't get throttled: reminders due together are sent as one digest
+        self._outbox = OutboundQueue(send_fn, digest_secs=reminder_digest_secs)
+
+    def on_failed_git_op(self, msg, chat_ids):
+        """ Notify the users of a list of a failed git op """
+        for cid in chat_ids:
+            self._outbox.send(cid, f'Git op fail, manual fix will be needed {msg}')
+
+    def send_reminder_msg(self, txt, chat_ids):
+        """ Notify the users of a list of a reminder triggering """
+        clean_txt = strip_reminder_tokens(txt)
+        for cid in chat_ids:
+            self._outbox.send_reminder(cid, clean_txt)
+
+    def outbox_stats(self):
+        """ Stats of the queue for outbound notifications """
+        return self._outbox.stats()
@@ -0,0 +1,170 @@
+""" Outbound message queue: sends messages from a background thread, so that callers (eg scheduler
+jobs) never block on the network. Sends are rate limited per chat and globally, failed sends are
+retried with exponential backoff, and reminders that come due together are sent as one digest """
+
+import collections
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class _Msg:
+    def __init__(self, text, not_before, reminders=None):
+        self.text = text
+        # Reminder texts, if this is a reminder digest. Reminders can be added until it's sent
+        self.reminders = reminders
+        self.not_before = not_before
+        self.attempts = 0
+
+    def render(self):
+        """ Text to send """
+        if self.reminders is None:
+            return self.text
+        if len(self.reminders) == 1:
+            return f'Reminder: {self.reminders[0]}'
+        return 'Reminders:\n' + '\n'.join(f'* {txt}' for txt in self.reminders)
+
+
+def _retry_after(ex):
+    """ Seconds the server asked us to wait before retrying (Telegram's 429 responses say so), if
+    the exception carries it """
+    retry_after = getattr(ex, 'retry_after', None)
+    if retry_after is None:
+        params = getattr(ex, 'parameters', None)
+        if isinstance(params, dict):
+            retry_after = params.get('retry_after')
+    try:
+        return None if retry_after is None else float(retry_after)
+    except (TypeError, ValueError):
+        return None
+
+
+class OutboundQueue:
+    """ Queue messages for send_fn(chat_id, text), which is called from a single background thread.
+    Messages to the same chat are sent in order, at most one every per_chat_interval_secs, and at
+    most one every global_interval_secs across all chats (Telegram allows ~1/s per chat and ~30/s
+    overall). A reminder is held for digest_secs before it's sent, and any other reminders for the
+    same chat queued before then are sent with it, as a single message. """
+
+    def __init__(self, send_fn, per_chat_interval_secs=1, global_interval_secs=0.05, digest_secs=5,
+                 max_attempts=5, backoff_secs=2, max_backoff_secs=300):
+        self._send_fn = send_fn
+        self._per_chat_interval_secs = per_chat_interval_secs
+        self._global_interval_secs = global_interval_secs
+        self._digest_secs = digest_secs
+        self._max_attempts = max_attempts
+        self._backoff_secs = backoff_secs
+        self._max_backoff_secs = max_backoff_secs
+
+        self._cond = threading.Condition()
+        # Chat id -> deque of _Msg waiting to be sent
+        self._pending = {}
+        # Chat id -> earliest time its next message may be sent
+        self._chat_next_send = {}
+        self._global_next_send = 0
+        self._stats = collections.Counter()
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, daemon=True, name='outbox')
+        self._thread.start()
+
+    def send(self, chat_id, text):
+        """ Queue a message """
+        with self._cond:
+            queue = self._pending.setdefault(chat_id, collections.deque())
+            queue.append(_Msg(text, time.monotonic()))
+            self._stats['queued'] += 1
+            self._cond.notify()
+
+    def send_reminder(self, chat_id, text):
+        """ Queue a reminder; reminders queued close together are sent as one message """
+        now = time.monotonic()
+        with self._cond:
+            self._stats['queued'] += 1
+            queue = self._pending.setdefault(chat_id, collections.deque())
+            # Join a digest that wasn't sent yet (a message being sent, or retried, is left alone)
+            if queue and queue[-1].reminders is not None and queue[-1].attempts == 0:
+                queue[-1].reminders.append(text)
+                self._stats['coalesced'] += 1
+                return
+            # Hold it for a while to give other reminders due at the same time a chance to join
+            queue.append(_Msg(None, now + self._digest_secs, reminders=[text]))
+            self._cond.notify()
+
+    def stats(self):
+        """ Counters (queued, sent, coalesced, retried, dropped) and current queue length """
+        with self._cond:
+            stats = dict(self._stats)
+            stats['pending'] = sum(len(queue) for queue in self._pending.values())
+        return stats
+
+    def stop(self):
+        """ Stop the sender thread; messages still queued are dropped """
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _next_ready(self, now):
+        """ (chat id, time its next message can be sent) for the chat that can send soonest """
+        best = None
+        for chat_id, queue in self._pending.items():
+            ready_at = max(queue[0].not_before, self._chat_next_send.get(chat_id, 0),
+                           self._global_next_send)
+            if best is None or ready_at < best[1]:
+                best = (chat_id, ready_at)
+            if ready_at <= now:
+                break
+        return best
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stop:
+                        return
+                    now = time.monotonic()
+                    ready = self._next_ready(now)
+                    if ready is None:
+                        self._cond.wait()
+                    elif ready[1] > now:
+                        self._cond.wait(ready[1] - now)
+                    else:
+                        break
+                chat_id = ready[0]
+                msg = self._pending[chat_id][0]
+                # Claim the message, no more reminders may be added to it
+                msg.attempts += 1
+                text = msg.render()
+
+            try:
+                self._send_fn(chat_id, text)
+                failure = None
+            except Exception as ex:  # pylint: disable=broad-exception-caught
+                failure = ex
+
+            with self._cond:
+                now = time.monotonic()
+                self._global_next_send = now + self._global_interval_secs
+                self._chat_next_send[chat_id] = now + self._per_chat_interval_secs
+                queue = self._pending[chat_id]
+                if failure is None:
+                    self._stats['sent'] += 1
+                    queue.popleft()
+                elif msg.attempts >= self._max_attempts:
+                    log.error("Failed to send message to %s after %d attempts, dropping it: %s",
+                              chat_id, msg.attempts, text, exc_info=failure)
+                    self._stats['dropped'] += 1
+                    queue.popleft()
+                else:
+                    delay = _retry_after(failure)
+                    if delay is None:
+                        delay = min(self._max_backoff_secs,
+                                    self._backoff_secs * 2 ** (msg.attempts - 1))
+                    log.warning("Failed to send message to %s, will retry in %.0f seconds: %s",
+                                chat_id, delay, failure)
+                    self._stats['retried'] += 1
+                    msg.not_before = now + delay
+                if not queue:
+                    del self._pending[chat_id]
@@ -0,0 +1,190 @@
+""" On-demand profiling: run a single web request, Telegram command or background job (commit,
+pull, reminder reload...) under cProfile, and keep the result in a directory that holds the most
+recent profiles. Profiles are in pstats format: read them with `python3 -m pstats FILE`, or any
+viewer that understands it (snakeviz, gprof2dot...).
+
+Each place that can be profiled has a target name, eg 'web:/api/todos', 'telegram:done' or
+'job:commit:home'. A target is profiled if it matches (fnmatch) one of the patterns configured
+to always be profiled, or a pattern armed for its next few runs with arm(). Profiling is off
+until configure_profiling() is called """
+
+import cProfile
+from contextlib import contextmanager
+from datetime import datetime
+import fnmatch
+import itertools
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+_PROFILE_EXT = '.prof'
+_UNSAFE_CHARS_RE = re.compile(r'[^A-Za-z0-9_.-]+')
+
+_lock = threading.Lock()
+_store = None
+# Patterns of targets profiled on every run
+_always = ()
+# Pattern -> runs left, see arm()
+_armed = {}
+# Profilers can't nest (and would mix up each other's results): only one profile at a time
+_active_lock = threading.Lock()
+
+
+class ProfileStore:
+    """ Directory with the keep most recent profiles """
+
+    def __init__(self, directory, keep):
+        self._dir = directory
+        self._keep = keep
+        self._seq = itertools.count()
+        os.makedirs(directory, exist_ok=True)
+
+    def save(self, target, profiler, elapsed_secs):
+        """ Store the stats of a profiler for target, dropping the oldest profiles over the limit.
+        Returns the profile's name """
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        safe_target = _UNSAFE_CHARS_RE.sub('_', target).strip('_')
+        name = (f'{stamp}-{next(self._seq):04d}-{safe_target}-{elapsed_secs * 1000:.0f}ms'
+                f'{_PROFILE_EXT}')
+        # Write and rename, so list() never sees a partial profile
+        fd, tmp_path = tempfile.mkstemp(dir=self._dir, prefix='.tmp')
+        os.close(fd)
+        try:
+            profiler.dump_stats(tmp_path)
+            os.replace(tmp_path, os.path.join(self._dir, name))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self._rotate()
+        return name
+
+    def _rotate(self):
+        for old in self.list()[self._keep:]:
+            try:
+                os.unlink(os.path.join(self._dir, old['name']))
+            except FileNotFoundError:
+                pass
+
+    def list(self):
+        """ Stored profiles, most recent first: dicts with 'name', 'size' and 'created' (unix
+        time) """
+        profiles = []
+        with os.scandir(self._dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith(_PROFILE_EXT) or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                profiles.append(
+                    {'name': entry.name, 'size': stat.st_size, 'created': stat.st_mtime})
+        # Names start with a timestamp and a sequence number, so they sort by creation too
+        profiles.sort(key=lambda prof: (prof['created'], prof['name']), reverse=True)
+        return profiles
+
+    def path(self, name):
+        """ Path of a stored profile, or None if there's no profile with that name """
+        if os.path.basename(name) != name or not name.endswith(_PROFILE_EXT):
+            return None
+        path = os.path.join(self._dir, name)
+        return path if os.path.isfile(path) else None
+
+
+def configure_profiling(directory, keep=20, targets=()):
+    """ Enable profiling: profiles are stored in directory (keeping the most recent keep), and
+    targets matching any of the patterns in targets are profiled on each run """
+    global _store, _always  # pylint: disable=global-statement
+    with _lock:
+        _store = ProfileStore(directory, keep)
+        _always = tuple(targets)
+
+
+def is_enabled():
+    """ True if configure_profiling was called """
+    return _store is not None
+
+
+def get_store():
+    """ The ProfileStore, or None if profiling is disabled """
+    return _store
+
+
+def arm(pattern, count=1):
+    """ Profile the next count runs of targets matching pattern """
+    if _store is None:
+        raise RuntimeError('Profiling is not enabled')
+    with _lock:
+        _armed[pattern] = _armed.get(pattern, 0) + count
+
+
+def armed():
+    """ Armed patterns and the number of runs left to profile for each """
+    with _lock:
+        return dict(_armed)
+
+
+def _wanted(target):
+    """ True if target should be profiled now; uses up one run of an armed pattern that matches """
+    with _lock:
+        for pattern in _armed:
+            if fnmatch.fnmatchcase(target, pattern):
+                _armed[pattern] -= 1
+                if _armed[pattern] == 0:
+                    del _armed[pattern]
+                return True
+        return any(fnmatch.fnmatchcase(target, pattern) for pattern in _always)
+
+
+class _Session:
+    def __init__(self, target):
+        self.target = target
+        self._profiler = cProfile.Profile()
+        self._start = time.monotonic()
+        self._profiler.enable()
+
+    def stop(self):
+        """ Stop profiling and store the profile. Returns its name, or None if it couldn't be
+        stored """
+        self._profiler.disable()
+        elapsed = time.monotonic() - self._start
+        try:
+            name = _store.save(self.target, self._profiler, elapsed)
+        except OSError:
+            log.error("Failed to store profile for %s", self.target, exc_info=True)
+            return None
+        finally:
+            _active_lock.release()
+        log.info("Profiled %s (%.0f ms): %s", self.target, elapsed * 1000, name)
+        return name
+
+
+def start(target, force=False):
+    """ Start profiling target (in the calling thread) if it should be profiled, or if force is set.
+    Returns a session to stop() once target is done, or None if target isn't profiled. Nothing is
+    profiled while another profile runs, eg a commit run by a profiled Telegram command """
+    if _store is None:
+        return None
+    if not _active_lock.acquire(blocking=False):
+        return None
+    if not force and not _wanted(target):
+        _active_lock.release()
+        return None
+    try:
+        return _Session(target)
+    except BaseException:
+        _active_lock.release()
+        raise
+
+
+@contextmanager
+def maybe_profile(target):
+    """ Context manager that profiles its block if target should be profiled """
+    session = start(target)
+    try:
+        yield
+    finally:
+        if session is not None:
+            session.stop()
@@ -1,15 +1,99 @@
 """ Helpers and schedulers to parse strings into dates, and set reminders based on them """
 
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.date import DateTrigger
 from datetime import datetime
 from datetime import timedelta
-from md_helpers import md_get_all_todos
+from md_helpers import md_load
+import collections
+import functools
+import hashlib
 import logging
+import profiling
 import re
+import threading
 
 log = logging.getLogger(__name__)
 
+# Words that can be parsed into numbers, per language
+_NUMBER_WORDS = {
+    'en': {
+        'zero': 0,
+        'one': 1,
+        'two': 2,
+        'three': 3,
+        'four': 4,
+        'five': 5,
+        'six': 6,
+        'seven': 7,
+        'eight': 8,
+        'nine': 9,
+        'ten': 10,
+        'eleven': 11,
+        'twelve': 12,
+        'thirteen': 13,
+        'fourteen': 14,
+        'fifteen': 15,
+        'sixteen': 16,
+        'seventeen': 17,
+        'eighteen': 18,
+        'nineteen': 19,
+        'twenty': 20,
+        'thirty': 30,
+        'forty': 40,
+        'fifty': 50,
+        'sixty': 60,
+        'seventy': 70,
+        'eighty': 80,
+        'ninety': 90},
+    'es': {
+        'cero': 0,
+        'uno': 1,
+        'dos': 2,
+        'tres': 3,
+        'cuatro': 4,
+        'cinco': 5,
+        'seis': 6,
+        'siete': 7,
+        'ocho': 8,
+        'nueve': 9,
+        'diez': 10,
+        'once': 11,
+        'doce': 12,
+        'trece': 13,
+        'catorce': 14,
+        'quince': 15,
+        'dieciséis': 16,
+        'diecisiete': 17,
+        'dieciocho': 18,
+        'diecinueve': 19,
+        'veinte': 20,
+        'veintiuno': 21,
+        'veintidós': 22,
+        'veintitrés': 23,
+        'veinticuatro': 24,
+        'veinticinco': 25,
+        'veintiseis': 26,
+        'veintiséis': 26,
+        'veintisiete': 27,
+        'veintiocho': 28,
+        'veintinueve': 29,
+        'treinta': 30,
+        'cuarenta': 40,
+        'cincuenta': 50,
+        'sesenta': 60,
+        'setenta': 70,
+        'ochenta': 80,
+        'noventa': 90,
+        'cien': 100,
+        'doscientos': 200,
+        'trescientos': 300,
+        'cuatrocientos': 400,
+        'quinientos': 500,
+        'seiscientos': 600,
+        'setecientos': 700,
+        'ochocientos': 800,
+        'novecientos': 900}}
+
+
 def _text_to_number(text):
     """ Got it from ChatGPT and fixed a few bugs, it's not very robust but it's good
     enough for reminders """
@@ -19,92 +103,14 @@ def _text_to_number(text):
     if text.isdigit():
         return int(text)
 
-    number_mapping = {
-        'en': {
-            'zero': 0,
-            'one': 1,
-            'two': 2,
-            'three': 3,
-            'four': 4,
-            'five': 5,
-            'six': 6,
-            'seven': 7,
-            'eight': 8,
-            'nine': 9,
-            'ten': 10,
-            'eleven': 11,
-            'twelve': 12,
-            'thirteen': 13,
-            'fourteen': 14,
-            'fifteen': 15,
-            'sixteen': 16,
-            'seventeen': 17,
-            'eighteen': 18,
-            'nineteen': 19,
-            'twenty': 20,
-            'thirty': 30,
-            'forty': 40,
-            'fifty': 50,
-            'sixty': 60,
-            'seventy': 70,
-            'eighty': 80,
-            'ninety': 90},
-        'es': {
-            'cero': 0,
-            'uno': 1,
-            'dos': 2,
-            'tres': 3,
-            'cuatro': 4,
-            'cinco': 5,
-            'seis': 6,
-            'siete': 7,
-            'ocho': 8,
-            'nueve': 9,
-            'diez': 10,
-            'once': 11,
-            'doce': 12,
-            'trece': 13,
-            'catorce': 14,
-            'quince': 15,
-            'dieciséis': 16,
-            'diecisiete': 17,
-            'dieciocho': 18,
-            'diecinueve': 19,
-            'veinte': 20,
-            'veintiuno': 21,
-            'veintidós': 22,
-            'veintitrés': 23,
-            'veinticuatro': 24,
-            'veinticinco': 25,
-            'veintiseis': 26,
-            'veintiséis': 26,
-            'veintisiete': 27,
-            'veintiocho': 28,
-            'veintinueve': 29,
-            'treinta': 30,
-            'cuarenta': 40,
-            'cincuenta': 50,
-            'sesenta': 60,
-            'setenta': 70,
-            'ochenta': 80,
-            'noventa': 90,
-            'cien': 100,
-            'doscientos': 200,
-            'trescientos': 300,
-            'cuatrocientos': 400,
-            'quinientos': 500,
-            'seiscientos': 600,
-            'setecientos': 700,
-            'ochocientos': 800,
-            'novecientos': 900}}
-
-    result = 0
-    current_number = 0
-
-    for lang in ['en', 'es']:
-        for word in text.lower().split():
-            if word in number_mapping[lang]:
-                current_number += number_mapping[lang][word]
+    words = text.lower().split()
+    for lang in ('en', 'es'):
+        number_words = _NUMBER_WORDS[lang]
+        result = 0
+        current_number = 0
+        for word in words:
+            if word in number_words:
+                current_number += number_words[word]
             elif word == 'hundred' and lang == 'en':
                 current_number = 100 * current_number
             elif word in ('y', 'and'):
@@ -120,16 +126,13 @@ def _text_to_number(text):
     return 0
 
 
-def _extract_reminder(text, trigger_token):
-    # Tokens to skip (eg if format is 'in two weeks', we don't care about 'in')
-    TOKS_TO_IGNORE = ['in', 'at']
-
-    # Find the position of the trigger_token
-    trigger_position = text.find(trigger_token)
+# Tokens to skip (eg if format is 'in two weeks', we don't care about 'in')
+_TOKS_TO_IGNORE = frozenset(('in', 'at'))
 
-    if trigger_position == -1:
-        return None
 
+def _extract_reminder(text, trigger_token, trigger_position):
+    """ Split the reminder spec following trigger_token (found at trigger_position) into a
+    (value, unit) tuple. unit may be None if the spec is a single word (eg 'tomorrow') """
     # Extract the substring starting from the position after the trigger_token
     start_position = trigger_position + len(trigger_token)
     remaining_text = text[start_position:].strip()
@@ -144,26 +147,30 @@ def _extract_reminder(text, trigger_token):
             f"Can't finder @reminder time in {text}, reminder seems empty")
 
     # TODO: Need to consume as many tokens as possible, in case it's a number with spaces
+    tok_0 = tokens[0].lower()
     tok_0_is_num = _text_to_number(tokens[0]) != 0
-    if not tok_0_is_num and not tokens[0].strip().lower() in TOKS_TO_IGNORE:
-        return (tokens[0].strip().lower(), None)
+    if not tok_0_is_num and tok_0 not in _TOKS_TO_IGNORE:
+        return (tok_0, None)
 
     # Check if the next token is a number, if so we need a unit too (eg 2 days)
     if len(tokens) == 1:
         raise ValueError(
             f"Found reminder for {tokens[0]}, but can't find its unit of time")
 
-    if tokens[0].strip().lower() in TOKS_TO_IGNORE and len(tokens) > 2:
+    if tok_0 in _TOKS_TO_IGNORE and len(tokens) > 2:
         # If the first token is ignorable, return toks 2 and 3 (eg if format is
         # '@reminder in 2 weeks', then skip 'in' and return (2, weeks)
-        return (tokens[1].strip().lower(), tokens[2].strip().lower())
+        return (tokens[1].lower(), tokens[2].lower())
+
+    return (tok_0, tokens[1].lower())
+
 
-    return (tokens[0].strip().lower(), tokens[1].strip().lower())
+_VALUE_WITH_SUFFIX_RE = re.compile(r'(\d+)(.*)')
 
 
 def _extract_unit_value_from_single_value(input_str):
     """ Try to break a line like '25th' into unit/value (25, th) """
-    match = re.match(r'(\d+)(.*)', input_str)
+    match = _VALUE_WITH_SUFFIX_RE.match(input_str)
     if match:
         digits = match.group(1).strip()
         rest = match.group(2).strip()
@@ -171,104 +178,65 @@ def _extract_unit_value_from_single_value(input_str):
     return input_str, None
 
 
+# Relative time units -> timedelta kwarg, and how many of them make a unit
+_RELATIVE_UNITS = {}
+for _tok in ('minute', 'minutes', 'mins', 'min'):
+    _RELATIVE_UNITS[_tok] = ('minutes', 1)
+for _tok in ('hrs', 'hr', 'hour', 'hours', 'horas', 'hora'):
+    _RELATIVE_UNITS[_tok] = ('hours', 1)
+for _tok in ('day', 'days', 'dia', 'dias'):
+    _RELATIVE_UNITS[_tok] = ('days', 1)
+for _tok in ('week', 'weeks', 'wk', 'wks', 'semanas'):
+    _RELATIVE_UNITS[_tok] = ('weeks', 1)
+for _tok in ('month', 'months', 'mes', 'meses'):
+    # timedelta has no months, close enough for a reminder
+    _RELATIVE_UNITS[_tok] = ('days', 30)
+# Absolute time units -> hours to add to the value
+_ABSOLUTE_UNITS = {'am': 0, 'pm': 12}
 
-def _guess_reminder_date_from_value_and_unit(value, unit):
-    ABSOLUTE_TIME_TOK = ['am', 'pm']
-    MINUTES_TOK = ['minute', 'minutes', 'mins', 'min']
-    HOURS_TOK = ['hrs', 'hr', 'hour', 'hours', 'horas', 'hora']
-    DAYS_TOK = ['day', 'days', 'dia', 'dias']
-    WEEKS_TOK = ['week', 'weeks', 'wk', 'wks', 'semanas']
-    MONTHS_TOK = ['month', 'months', 'mes', 'meses']
 
+def _guess_reminder_date_from_value_and_unit(value, unit):
     parsed_value = _text_to_number(value)
     if parsed_value == 0:
         raise ValueError(
             f"Expected {value} to be a number, parsed it to {parsed_value}")
 
-    value = parsed_value
+    unit = unit.lower()
     target_time = datetime.now()
-    if unit.lower() in MINUTES_TOK:
-        target_time += timedelta(minutes=int(value))
-    elif unit.lower() in HOURS_TOK:
-        target_time += timedelta(hours=int(value))
-    elif unit.lower() in DAYS_TOK:
-        target_time += timedelta(days=int(value))
-    elif unit.lower() in WEEKS_TOK:
-        target_time += timedelta(weeks=int(value))
-    elif unit.lower() in MONTHS_TOK:
-        target_time += timedelta(months=int(value))
-    elif unit.lower() in ABSOLUTE_TIME_TOK:
-        if unit.lower() == 'am':
-            target_time = target_time.replace(hour=int(value), minute=0, second=0, microsecond=0)
-        else:
-            target_time = target_time.replace(hour=int(value)+12, minute=0, second=0, microsecond=0)
-    else:
-        return None
-    return target_time
+    if unit in _RELATIVE_UNITS:
+        kwarg, multiplier = _RELATIVE_UNITS[unit]
+        return target_time + timedelta(**{kwarg: int(parsed_value) * multiplier})
+    if unit in _ABSOLUTE_UNITS:
+        return target_time.replace(hour=int(parsed_value) + _ABSOLUTE_UNITS[unit],
+                                   minute=0, second=0, microsecond=0)
+    return None
 
 
-def _guess_reminder_date_from_value_only(input_str):
-    MORNING_TOKS = ['maniana', 'morning', 'early', 'temprano']
-    AFTERNOON_TOKS = ['noon', 'afternoon']
-    NIGHT_TOKS = ['noche', 'night', 'tonight', 'tarde']
-    TOMORROW_TOKS = ['tomorrow', 'tmrw']
-    WEEKEND_TOKS = ['weekend', 'finde']
+# Single word reminders -> (days from today, hour)
+_DAY_TIME_TOKS = {}
+for _tok in ('maniana', 'morning', 'early', 'temprano'):
+    _DAY_TIME_TOKS[_tok] = (0, 8)
+for _tok in ('noon', 'afternoon'):
+    _DAY_TIME_TOKS[_tok] = (0, 13)
+for _tok in ('noche', 'night', 'tonight', 'tarde'):
+    _DAY_TIME_TOKS[_tok] = (0, 20)
+for _tok in ('tomorrow', 'tmrw'):
+    _DAY_TIME_TOKS[_tok] = (1, 8)
+_WEEKEND_TOKS = frozenset(('weekend', 'finde'))
+
 
+def _guess_reminder_date_from_value_only(input_str):
+    input_str = input_str.lower()
     current_time = datetime.now()
-    target_time = None
-    if input_str.lower() in MORNING_TOKS:
-        target_time = datetime(
-            current_time.year,
-            current_time.month,
-            current_time.day,
-            8,
-            0,
-            0)
-    elif input_str.lower() in AFTERNOON_TOKS:
-        target_time = datetime(
-            current_time.year,
-            current_time.month,
-            current_time.day,
-            13,
-            0,
-            0)
-    elif input_str.lower() in NIGHT_TOKS:
-        target_time = datetime(
-            current_time.year,
-            current_time.month,
-            current_time.day,
-            20,
-            0,
-            0)
-    elif input_str.lower() in TOMORROW_TOKS:
-        target_time = datetime(
-            current_time.year,
-            current_time.month,
-            current_time.day + 1,
-            8,
-            0,
-            0)
-    elif input_str.lower() in WEEKEND_TOKS:
-        if current_time.weekday() == 5:  # If today is Saturday
-            target_time = datetime(current_time.year,
-                                   current_time.month,
-                                   current_time.day,
-                                   9,
-                                   0,
-                                   0) + timedelta(days=7)
-        else:
-            target_time = datetime(
-                current_time.year,
-                current_time.month,
-                current_time.day,
-                9,
-                0,
-                0)
-            # Calculate days until Saturday
-            days_until_saturday = (5 - current_time.weekday() + 7) % 7
-            target_time += timedelta(days=days_until_saturday)
-
-    if target_time is None:
+    today = datetime(current_time.year, current_time.month, current_time.day)
+    if input_str in _DAY_TIME_TOKS:
+        days, hour = _DAY_TIME_TOKS[input_str]
+        target_time = today + timedelta(days=days, hours=hour)
+    elif input_str in _WEEKEND_TOKS:
+        # Next Saturday at 9, or a week from today if today is Saturday
+        days_until_saturday = (5 - current_time.weekday() + 7) % 7 or 7
+        target_time = today + timedelta(days=days_until_saturday, hours=9)
+    else:
         return None
 
     if current_time > target_time:
@@ -281,29 +249,47 @@ DEFAULT_REMINDER_TOK = '@reminder'
 REMINDER_INPUT_TOKENS = ['@reminder', '@remindme', '@r', '@at', '@in']
 DEFAULT_REMINDER_SET_TOK = '@remind_at'
 
+# All of REMINDER_INPUT_TOKENS in a single regex. Longer tokens first, so a token that is a prefix
+# of another one (eg @r and @reminder) only matches when the longer one doesn't
+_REMINDER_TOKS_ALT = '|'.join(
+    re.escape(tok) for tok in sorted(REMINDER_INPUT_TOKENS, key=len, reverse=True))
+_REMINDER_TOK_RE = re.compile(_REMINDER_TOKS_ALT)
+_NON_DEFAULT_REMINDER_TOK_RE = re.compile(
+    '(?:' + '|'.join(re.escape(tok) for tok in sorted(REMINDER_INPUT_TOKENS, key=len, reverse=True)
+                     if tok != DEFAULT_REMINDER_TOK) + r')(?=\s|$)',
+    re.IGNORECASE)
+# One regex per token to strip a reminder spec (eg '@remindme 2 days'). These are applied one after
+# the other: a single alternation would match overlapping specs differently
+_REMINDER_SPEC_RES = [re.compile(re.escape(tok) + r'\s+\S+(?:\s+\S+)?', re.IGNORECASE)
+                      for tok in REMINDER_INPUT_TOKENS]
+_REMINDER_TOK_PRIORITY = {tok: i for i, tok in enumerate(REMINDER_INPUT_TOKENS)}
+_REMINDER_SET_TOK_OPEN = f'[{DEFAULT_REMINDER_SET_TOK} '
+
 
 def normalize_reminder_token(text):
     """ Replace any supported reminder token with the canonical @reminder token """
-    for tok in REMINDER_INPUT_TOKENS:
-        if tok == DEFAULT_REMINDER_TOK:
-            continue
-        # Case-insensitive replacement, matching whole token
-        pattern = re.compile(re.escape(tok) + r'(?=\s|$)', re.IGNORECASE)
-        text = pattern.sub(DEFAULT_REMINDER_TOK, text)
-    return text
+    # Case-insensitive replacement, matching whole token
+    return _NON_DEFAULT_REMINDER_TOK_RE.sub(DEFAULT_REMINDER_TOK, text)
 
 
 def guess_reminder_date(todo_ln):
     """ Try to parse an absolute date from a user proivded one """
-    # Try each supported token
-    for tok in REMINDER_INPUT_TOKENS:
-        reminder = _extract_reminder(todo_ln, tok)
-        if reminder:
-            break
-    else:
+    if '@' not in todo_ln:
         return None
 
-    value, unit = reminder
+    # Find the first occurrence of each supported token in a single pass. If there's more than
+    # one, the token that comes first in REMINDER_INPUT_TOKENS wins
+    found = None
+    for match in _REMINDER_TOK_RE.finditer(todo_ln):
+        tok = match.group(0)
+        if found is None or _REMINDER_TOK_PRIORITY[tok] < _REMINDER_TOK_PRIORITY[found[0]]:
+            found = (tok, match.start())
+            if _REMINDER_TOK_PRIORITY[tok] == 0:
+                break
+    if found is None:
+        return None
+
+    value, unit = _extract_reminder(todo_ln, *found)
 
     if unit is None:
         value, unit = _extract_unit_value_from_single_value(value)
@@ -322,7 +308,22 @@ def mark_for_reminder_date(line, date):
     return f'{line.strip()} [{DEFAULT_REMINDER_SET_TOK} {date}]'
 
 
+# The date formats written by mark_for_reminder_date, parsed without going through strptime
+_REMINDER_DATE_RE = re.compile(
+    r'(\d{4})-(\d{1,2})-(\d{1,2})(?: (\d{1,2}):(\d{1,2})(?::(\d{1,2})(?:\.(\d{1,6}))?)?)?')
+
+
 def _try_parse_reminder_date(date_string):
+    match = _REMINDER_DATE_RE.fullmatch(date_string)
+    if match:
+        year, month, day, hour, minute, sec, frac = match.groups()
+        try:
+            return datetime(int(year), int(month), int(day),
+                            int(hour or 0), int(minute or 0), int(sec or 0),
+                            int(frac.ljust(6, '0')) if frac else 0)
+        except ValueError:
+            return None
+
     formats_to_try = [
         '%Y-%m-%d %H:%M:%S.%f',
         '%Y-%m-%d %H:%M:%S',
@@ -341,11 +342,11 @@ def _try_parse_reminder_date(date_string):
 
 def get_reminder_date_if_set(todo):
     """ Parse a log line. If the line has a @reminder token, will try to parse the date """
-    reminder_set_tok = f'[{DEFAULT_REMINDER_SET_TOK} '
-    if reminder_set_tok not in todo:
+    start = todo.find(_REMINDER_SET_TOK_OPEN)
+    if start == -1:
         return None
 
-    start = todo.find(reminder_set_tok) + len(reminder_set_tok)
+    start += len(_REMINDER_SET_TOK_OPEN)
     end = todo.find(']', start)
     reminder_date = _try_parse_reminder_date(todo[start:end])
 
@@ -356,55 +357,176 @@ def get_reminder_date_if_set(todo):
     return reminder_date
 
 
+@functools.lru_cache(maxsize=4096)
+def _cached_reminder_date(todo):
+    """ get_reminder_date_if_set, but only parse (and complain about) each line once """
+    return get_reminder_date_if_set(todo)
+
+
+def reminder_cache_stats():
+    """ {'hit': n, 'miss': n} for the cache of parsed reminder dates """
+    info = _cached_reminder_date.cache_info()
+    return {'hit': info.hits, 'miss': info.misses}
+
+
 def strip_reminder_tokens(todo):
     """ Remove reminder tokens from a todo line for display purposes.
     Strips @reminder and the [@remind_at ...] metadata. """
     # Remove the [@remind_at ...] metadata block
-    reminder_set_tok = f'[{DEFAULT_REMINDER_SET_TOK} '
-    if reminder_set_tok in todo:
-        start = todo.find(reminder_set_tok)
+    start = todo.find(_REMINDER_SET_TOK_OPEN)
+    if start != -1:
         end = todo.find(']', start)
         if end != -1:
             todo = todo[:start] + todo[end + 1:]
 
     # Remove @reminder and its time specification
-    for tok in REMINDER_INPUT_TOKENS:
-        pattern = re.compile(re.escape(tok) + r'\s+\S+(?:\s+\S+)?', re.IGNORECASE)
-        todo = pattern.sub('', todo)
+    if '@' in todo:
+        for pattern in _REMINDER_SPEC_RES:
+            todo = pattern.sub('', todo)
 
     return todo.strip()
 
 
 class ReminderScheduler:
-    """ Manages reminders in a todo file, sends notifications when reminders trigger """
-
-    def __init__(self, todo_filepath):
-        self._scheduler = BackgroundScheduler()
-        self._scheduler.start()
+    """ Manages reminders in a todo file, sends notifications when reminders trigger. Scheduled
+    jobs are keyed by a hash of the reminder's text (see _reminder_keys): a reload only touches
+    jobs for reminders that were added, removed or changed since the last one.
+
+    If a journal (see scheduler.JobJournal) is set, sent reminders are recorded in it, and reminders
+    that came due up to catchup_secs ago without being sent (eg because the service was down) are
+    sent right away.
+
+    Several instances may share a scheduler if each has a different name, which is used to tell
+    their scheduled jobs apart. """
+
+    def __init__(self, todo_filepath, scheduler=None, journal=None, catchup_secs=0, name=None):
+        # Only import apscheduler if reminders are used, the parser doesn't need it
+        # pylint: disable=import-outside-toplevel
+        from apscheduler.jobstores.base import JobLookupError
+        from apscheduler.triggers.date import DateTrigger
+        from scheduler import get_scheduler
+        self._job_lookup_error = JobLookupError
+        self._date_trigger = DateTrigger
+        self._scheduler = scheduler if scheduler is not None else get_scheduler()
+        self._journal = journal
+        # Without a journal there's no way to tell which past reminders were already sent
+        self._catchup = timedelta(seconds=catchup_secs if journal is not None else 0)
+        if self._journal is not None:
+            self._journal.prune(self._is_catchup_key)
         self._todo_filepath = todo_filepath
-        self.reload_reminders_from_file()
+        self._job_prefix = 'reminder:' if name is None else f'reminder:{name}:'
+        self._reload_profile_target = \
+            'job:reminders_reload' if name is None else f'job:reminders_reload:{name}'
+        # Reloads may be triggered from any thread (web, bot, git); don't let them interleave
+        self._reload_lock = threading.Lock()
+        # Reminder key -> (reminder date, ToDo text) for each scheduled reminder
+        self._scheduled = {}
+        # Document the current schedule was built from; if it didn't change, there's nothing to do
+        self._loaded_doc = None
+        # Nothing is scheduled until there's a sender: a missed reminder would be caught up right
+        # away, before the sender is registered, and get lost. See register_sender
         self._msg_sender = None
 
+    def scheduled_count(self):
+        """ Number of reminders waiting to be sent """
+        with self._reload_lock:
+            return len(self._scheduled)
+
     def register_sender(self, msg_sender):
-        """ Telegram bot - split from init to avoid init circular dep """
-        self._msg_sender = msg_sender
+        """ Object with a send_reminder_msg(txt) method (eg the Telegram bot) - split from init to
+        avoid init circular dep. Reminders are only scheduled from then on """
+        with self._reload_lock:
+            self._msg_sender = msg_sender
+        self.reload_reminders_from_file()
 
     def reload_reminders_from_file(self):
-        """ Reset and reload all reminders (useful if a file changes) """
-        self._scheduler.remove_all_jobs()
-        for todo in md_get_all_todos(self._todo_filepath):
-            reminder_date = get_reminder_date_if_set(todo)
-            if reminder_date is not None and reminder_date > datetime.now():
-                self._on_reminder_todo_added(reminder_date, todo)
+        """ Sync scheduled reminders with the ToDo file (useful if a file changes) """
+        with profiling.maybe_profile(self._reload_profile_target), self._reload_lock:
+            if self._msg_sender is None:
+                return
+            doc = md_load(self._todo_filepath)
+            if doc is self._loaded_doc:
+                return
+
+            now = datetime.now()
+            wanted = {}
+            for key, line_num in _reminder_keys(doc):
+                reminder_date = _cached_reminder_date(doc.lines[line_num])
+                if reminder_date is None:
+                    continue
+                if reminder_date <= now:
+                    if reminder_date <= now - self._catchup or \
+                            self._journal.is_done(_journal_key(key, reminder_date)):
+                        continue
+                    log.info("Reminder @ %s was missed, will send it now", reminder_date)
+                wanted[key] = (reminder_date, doc.todo_text(line_num))
+
+            for key, reminder in list(self._scheduled.items()):
+                if wanted.get(key) != reminder:
+                    self._unschedule(key)
+            for key, reminder in wanted.items():
+                if key not in self._scheduled:
+                    self._schedule(key, *reminder)
+            self._loaded_doc = doc
+
+    def _unschedule(self, key):
+        del self._scheduled[key]
+        try:
+            self._scheduler.remove_job(self._job_prefix + key)
+        except self._job_lookup_error:
+            # Already triggered
+            pass
+
+    def _is_catchup_key(self, key):
+        """ True if a journal key is for a reminder that may still be caught up """
+        reminder_date = datetime.fromisoformat(key.rsplit('@', 1)[1])
+        return reminder_date > datetime.now() - self._catchup
 
-    def _on_reminder_todo_added(self, reminder_date, todo_ln):
-        log.info("Will schedule reminder @ %s: %s", reminder_date, todo_ln)
+    def _schedule(self, key, reminder_date, todo_txt):
+        log.info("Will schedule reminder @ %s: %s", reminder_date, todo_txt)
 
         def send_reminder():
             log.info("Sending reminder %s", reminder_date)
-            self._msg_sender.send_reminder_msg(todo_ln)
-
+            sent = False
+            try:
+                self._msg_sender.send_reminder_msg(todo_txt)
+                sent = True
+            finally:
+                # Only forget the reminder once it's recorded as sent, or a reload could send it
+                # again. A reminder that failed to send isn't recorded: it's caught up once the
+                # file changes, if it's still within the catch-up window
+                with self._reload_lock:
+                    if sent and self._journal is not None:
+                        self._journal.mark_done(_journal_key(key, reminder_date))
+                    # A reload may have replaced it with another reminder for the same key
+                    if self._scheduled.get(key) == (reminder_date, todo_txt):
+                        del self._scheduled[key]
+
+        self._scheduled[key] = (reminder_date, todo_txt)
+        # A job scheduled in the past would be dropped as a misfire: missed reminders run now
         self._scheduler.add_job(
             send_reminder,
-            trigger=DateTrigger(reminder_date)
+            trigger=self._date_trigger(max(reminder_date, datetime.now())),
+            id=self._job_prefix + key,
+            replace_existing=True
         )
+
+
+def _reminder_keys(doc):
+    """ (key, line number) for each line of doc with a reminder. A key is a hash of the ToDo's text,
+    plus an occurrence count for duplicate texts, so it doesn't change when other lines are added
+    or removed. Only reminder lines are hashed: unlike ToDo ids, this doesn't need the ids of every
+    ToDo in the document """
+    counts = collections.Counter()
+    for line_num, line in enumerate(doc.lines):
+        # Section headers aren't ToDos, even if they look like they have a reminder
+        if _REMINDER_SET_TOK_OPEN not in line or line.startswith('## '):
+            continue
+        text = doc.todo_text(line_num)
+        digest = hashlib.blake2b(text.encode('utf-8'), digest_size=8).hexdigest()
+        counts[digest] += 1
+        yield f'{digest}.{counts[digest]}', line_num
+
+
+def _journal_key(key, reminder_date):
+    return f'{key}@{reminder_date.isoformat()}'
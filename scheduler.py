@@ -0,0 +1,142 @@
+""" Shared background scheduler for all components (git sync, reminders...), plus a small persistent
+journal to remember which jobs already ran across restarts """
+
+from datetime import datetime
+import json
+import logging
+import os
+import tempfile
+import threading
+
+log = logging.getLogger(__name__)
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+# Jobs that run late (eg the process was suspended, or all workers were busy) still run if they
+# are at most this late. Set with configure_scheduler
+_misfire_grace_secs = 300
+
+_stats_lock = threading.Lock()
+_stats = {
+    'submitted': 0,
+    'executed': 0,
+    'errors': 0,
+    'missed': 0,
+    'last_lag_secs': None,
+    'max_lag_secs': 0,
+}
+
+
+def configure_scheduler(misfire_grace_secs):
+    """ Set options for the shared scheduler. Must be called before it's first used """
+    global _misfire_grace_secs  # pylint: disable=global-statement
+    with _scheduler_lock:
+        if _scheduler is not None:
+            raise RuntimeError('Scheduler already started, configure it before first use')
+        _misfire_grace_secs = misfire_grace_secs
+
+
+def _on_job_event(event):
+    # pylint: disable=import-outside-toplevel
+    from apscheduler.events import EVENT_JOB_SUBMITTED, EVENT_JOB_EXECUTED, EVENT_JOB_ERROR
+    with _stats_lock:
+        if event.code == EVENT_JOB_SUBMITTED:
+            _stats['submitted'] += 1
+            # Queue lag: how long after its scheduled time a job was handed to a worker
+            due = min(event.scheduled_run_times)
+            lag = max(0, (datetime.now(due.tzinfo) - due).total_seconds())
+            _stats['last_lag_secs'] = lag
+            _stats['max_lag_secs'] = max(_stats['max_lag_secs'], lag)
+        elif event.code == EVENT_JOB_EXECUTED:
+            _stats['executed'] += 1
+        elif event.code == EVENT_JOB_ERROR:
+            _stats['errors'] += 1
+        else:
+            _stats['missed'] += 1
+            log.warning("Job %s missed its run time by more than %s seconds, skipped",
+                        event.job_id, _misfire_grace_secs)
+
+
+def get_scheduler():
+    """ Get the shared scheduler (started on first use) """
+    global _scheduler  # pylint: disable=global-statement
+    with _scheduler_lock:
+        if _scheduler is None:
+            # pylint: disable=import-outside-toplevel
+            from apscheduler.events import (EVENT_JOB_SUBMITTED, EVENT_JOB_EXECUTED,
+                                            EVENT_JOB_ERROR, EVENT_JOB_MISSED)
+            from apscheduler.schedulers.background import BackgroundScheduler
+            # Coalesce: if a job missed several runs (eg a periodic sync, while suspended), run it
+            # once
+            _scheduler = BackgroundScheduler(job_defaults={
+                'misfire_grace_time': _misfire_grace_secs,
+                'coalesce': True,
+            })
+            _scheduler.add_listener(
+                _on_job_event,
+                EVENT_JOB_SUBMITTED | EVENT_JOB_EXECUTED | EVENT_JOB_ERROR | EVENT_JOB_MISSED)
+            _scheduler.start()
+        return _scheduler
+
+
+def scheduler_stats():
+    """ Job counts and queue lag of the shared scheduler """
+    with _stats_lock:
+        stats = dict(_stats)
+    with _scheduler_lock:
+        stats['scheduled'] = 0 if _scheduler is None else len(_scheduler.get_jobs())
+    return stats
+
+
+class JobJournal:
+    """ Persistent record of jobs that already ran, keyed by a caller-chosen string, so that jobs
+    missed while the service was down can be caught up on restart without running twice. Stored
+    as a JSON file (key -> ISO date it ran), rewritten atomically on each change. Not meant for
+    many entries: callers should prune() the ones they no longer need """
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path, 'r', encoding="utf-8") as fp:
+                self._done = json.load(fp)
+        except FileNotFoundError:
+            self._done = {}
+        except ValueError:
+            log.error("Job journal %s is corrupt, starting a new one", path, exc_info=True)
+            self._done = {}
+
+    def is_done(self, key):
+        """ True if the job was marked as done """
+        with self._lock:
+            return key in self._done
+
+    def mark_done(self, key):
+        """ Record that the job ran """
+        with self._lock:
+            self._done[key] = datetime.now().isoformat()
+            self._save()
+
+    def prune(self, keep):
+        """ Forget all jobs for which keep(key) is False """
+        with self._lock:
+            stale = [key for key in self._done if not keep(key)]
+            if not stale:
+                return
+            for key in stale:
+                del self._done[key]
+            self._save()
+
+    def _save(self):
+        dir_path = os.path.dirname(os.path.abspath(self._path))
+        fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix=f'.{os.path.basename(self._path)}.')
+        try:
+            with os.fdopen(fd, 'w', encoding="utf-8") as fp:
+                json.dump(self._done, fp, indent=1, sort_keys=True)
+            os.replace(tmp_path, self._path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+""" Benchmark git backends: creates a scratch bare repo and a clone of it, then times a number of
+commit cycles (the same add, commit, pull and push GitIntegration does for each change) for each
+backend. Another clone pushes a commit every few cycles, so pulls have something to fetch.
+
+    python3 scripts/bench_git.py --cycles 20 --backends cli dulwich """
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable=wrong-import-position
+from git import COMMIT_MSG, GIT_BACKENDS
+
+
+def _git(cwd, *args):
+    subprocess.run(['git', *args], cwd=cwd, check=True, capture_output=True)
+
+
+def _clone(bare, path):
+    _git(os.path.dirname(path), 'clone', bare, path)
+    _git(path, 'config', 'user.email', 'bench@example.com')
+    _git(path, 'config', 'user.name', 'bench')
+    _git(path, 'config', 'pull.rebase', 'true')
+
+
+def _setup(root):
+    bare = os.path.join(root, 'remote.git')
+    _git(root, 'init', '--bare', '-b', 'main', bare)
+    seed = os.path.join(root, 'seed')
+    _clone(bare, seed)
+    with open(os.path.join(seed, 'todo.md'), 'w', encoding='utf-8') as fp:
+        fp.write('## Bench\n* first\n')
+    with open(os.path.join(seed, 'other.md'), 'w', encoding='utf-8') as fp:
+        fp.write('0\n')
+    _git(seed, 'add', '.')
+    _git(seed, 'commit', '-m', 'seed')
+    _git(seed, 'push', 'origin', 'main')
+    return bare, seed
+
+
+def bench_backend(name, cycles, upstream_every):
+    """ Return a list of seconds per commit cycle """
+    with tempfile.TemporaryDirectory() as root:
+        bare, upstream = _setup(root)
+        work = os.path.join(root, 'work')
+        _clone(bare, work)
+        backend = GIT_BACKENDS[name](work)
+        times = []
+        for i in range(cycles):
+            if upstream_every and i % upstream_every == 0:
+                _git(upstream, 'pull')
+                with open(os.path.join(upstream, 'other.md'), 'w', encoding='utf-8') as fp:
+                    fp.write(f'upstream {i}\n')
+                _git(upstream, 'commit', '-am', f'upstream {i}')
+                _git(upstream, 'push', 'origin', 'main')
+
+            with open(os.path.join(work, 'todo.md'), 'a', encoding='utf-8') as fp:
+                fp.write(f'* todo {i}\n')
+            start = time.perf_counter()
+            backend.add('todo.md')
+            backend.commit(COMMIT_MSG)
+            backend.pull()
+            backend.push()
+            times.append(time.perf_counter() - start)
+
+        # Sanity check: everything made it upstream
+        _git(upstream, 'pull')
+        with open(os.path.join(upstream, 'todo.md'), encoding='utf-8') as fp:
+            if f'* todo {cycles - 1}\n' not in fp.read():
+                raise RuntimeError(f'Backend {name} lost commits')
+        return times
+
+
+def main():
+    """ Run benchmark """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cycles', type=int, default=20)
+    parser.add_argument('--upstream-every', type=int, default=5,
+                        help='Push an unrelated upstream commit every N cycles (0 to disable)')
+    parser.add_argument('--backends', nargs='+', default=list(GIT_BACKENDS),
+                        choices=list(GIT_BACKENDS))
+    args = parser.parse_args()
+
+    for name in args.backends:
+        try:
+            times = bench_backend(name, args.cycles, args.upstream_every)
+        except ImportError as ex:
+            print(f'{name:8} skipped: {ex}')
+            continue
+        print(f'{name:8} {statistics.mean(times) * 1000:8.1f} ms/cycle mean, '
+              f'{statistics.median(times) * 1000:8.1f} ms median, {max(times) * 1000:8.1f} ms max')
+
+
+if __name__ == '__main__':
+    main()
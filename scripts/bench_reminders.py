@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+""" Benchmark the reminder parser on a bulk import of synthetic ToDos: reports the per-line cost of
+each step a ToDo goes through when it's added (normalize, guess a date, mark it) and when the
+file is loaded (find the reminder date) or displayed (strip reminder tokens).
+
+    python3 scripts/bench_reminders.py --todos 50000 """
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable=wrong-import-position
+from reminders import (get_reminder_date_if_set,
+                       guess_reminder_date,
+                       mark_for_reminder_date,
+                       normalize_reminder_token,
+                       strip_reminder_tokens)
+
+_WORDS = ['buy', 'milk', 'call', 'mom', 'fix', 'the', 'bike', 'review', 'PR', 'pay', 'rent', 'book',
+          'flights', 'water', 'plants', 'email', 'about', 'taxes', 'clean', 'garage']
+_REMINDERS = ['@remindme 5 minutes', '@r tomorrow', '@at 5pm', '@in 2 weeks', '@reminder weekend',
+              '@remindme in two days', '@r tonight', '@in veinte minutos', '@at 9am', '@r 3 hrs']
+
+
+def gen_todos(count, reminder_ratio, seed):
+    """ Random ToDos, some of them with a reminder spec """
+    rnd = random.Random(seed)
+    todos = []
+    for _ in range(count):
+        todo = ' '.join(rnd.choice(_WORDS) for _ in range(rnd.randint(2, 8)))
+        if rnd.random() < reminder_ratio:
+            todo += ' ' + rnd.choice(_REMINDERS)
+        todos.append(todo)
+    return todos
+
+
+def _bench(name, func, inputs):
+    start = time.perf_counter()
+    for arg in inputs:
+        try:
+            func(arg)
+        except ValueError:
+            pass
+    elapsed = time.perf_counter() - start
+    print(f'{name:28} {elapsed * 1e6 / len(inputs):8.2f} us/line  {elapsed:7.3f} s total')
+
+
+def _parse_new_todo(todo):
+    todo = normalize_reminder_token(todo)
+    date = guess_reminder_date(todo)
+    return todo if date is None else mark_for_reminder_date(todo, date)
+
+
+def main():
+    """ Run benchmark """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--todos', type=int, default=50000)
+    parser.add_argument('--reminder-ratio', type=float, default=0.3)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    todos = gen_todos(args.todos, args.reminder_ratio, args.seed)
+    normalized = [normalize_reminder_token(todo) for todo in todos]
+    marked = []
+    for todo in todos:
+        try:
+            marked.append(_parse_new_todo(todo))
+        except ValueError:
+            marked.append(todo)
+
+    print(f'{len(todos)} ToDos, {args.reminder_ratio:.0%} with reminders')
+    _bench('normalize_reminder_token', normalize_reminder_token, todos)
+    _bench('guess_reminder_date', guess_reminder_date, normalized)
+    _bench('add (normalize+guess+mark)', _parse_new_todo, todos)
+    _bench('get_reminder_date_if_set', get_reminder_date_if_set, marked)
+    _bench('strip_reminder_tokens', strip_reminder_tokens, marked)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,558 @@
+#!/usr/bin/env python3
+""" Benchmark suite: generates synthetic ToDo files of increasing size and times every md_helpers
+function, the reminder parser, ReminderScheduler reloads and the web API (through Flask's test
+client, without a server). Results are written as JSON, so runs on two commits can be compared:
+
+    python3 scripts/bench_suite.py --sizes 100,10000,1000000 --out before.json
+    git checkout my-branch
+    python3 scripts/bench_suite.py --sizes 100,10000,1000000 --out after.json --compare before.json
+
+Reminder and web benchmarks are skipped if apscheduler or flask aren't installed.
+
+--check-against REV also runs a differential check: random files (with blank lines, comments, a
+preamble, empty sections...) and random edits are run through both md_helpers.py as of REV and the
+current one, and every read and the resulting file must be identical. Parsed sections are checked
+against a copy of the original parser. Section lookups are only done with exact names, since
+matching names is meant to behave differently (case insensitive) since the first revisions.
+
+    python3 scripts/bench_suite.py --no-bench \
+        --check-against $(git rev-list --max-parents=0 HEAD) """
+
+import argparse
+from datetime import datetime, timedelta
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+_REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, _REPO_ROOT)
+
+# pylint: disable=wrong-import-position
+import md_helpers
+from change_events import ChangeNotifier
+from reminders import guess_reminder_date, mark_for_reminder_date, normalize_reminder_token
+
+_WORDS = ['buy', 'milk', 'call', 'mom', 'fix', 'the', 'bike', 'review', 'PR', 'pay', 'rent', 'book',
+          'flights', 'water', 'plants', 'email', 'about', 'taxes', 'clean', 'garage']
+_REMINDER_SPECS = ['@remindme 5 minutes', '@r tomorrow', '@at 5pm', '@in 2 weeks',
+                   '@reminder weekend', '@remindme in two days', '@r tonight', '@at 9am',
+                   '@r 3 hrs']
+
+
+def gen_todo_file(path, n_lines, n_sections, reminder_ratio, seed):
+    """ Write a ToDo file of about n_lines lines, split in n_sections sections. reminder_ratio of
+    the ToDos have a reminder set, at some point in the next month """
+    rnd = random.Random(seed)
+    n_sections = max(1, min(n_sections, n_lines // 3))
+    todos_per_section = max(1, n_lines // n_sections - 2)
+    now = datetime.now()
+    lines = []
+    for sect in range(n_sections):
+        lines.append(f'## Section {sect}\n')
+        for _ in range(todos_per_section):
+            todo = ' '.join(rnd.choice(_WORDS) for _ in range(rnd.randint(2, 8)))
+            if rnd.random() < reminder_ratio:
+                when = now + timedelta(minutes=rnd.randint(10, 30 * 24 * 60))
+                todo = mark_for_reminder_date(todo, when)
+            lines.append(f'* {todo}\n')
+        lines.append('\n')
+    with open(path, 'w', encoding='utf-8') as fp:
+        fp.write(''.join(lines))
+    return n_sections
+
+
+def _time(func, min_time, max_calls=100000):
+    """ Call func until min_time seconds were spent in it (at least once). The first call isn't
+    timed, so lazily built caches (eg the search index) don't skew the mean """
+    func()
+    calls = 0
+    total = 0
+    best = None
+    while calls == 0 or (total < min_time and calls < max_calls):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        calls += 1
+        total += elapsed
+        best = elapsed if best is None else min(best, elapsed)
+    return {'calls': calls, 'mean_us': total / calls * 1e6, 'min_us': best * 1e6}
+
+
+def _record(results, name, stats):
+    print(f'  {name:45} {stats["mean_us"]:12.1f} us  ({stats["calls"]} calls)', file=sys.stderr)
+    results[name] = stats
+
+
+def _age_file(path):
+    """ Set the file's mtime in the past. Files modified in the last couple of seconds are re-read
+    on every md_load (see md_helpers._RACY_WINDOW_NS), which would make every read look slow """
+    past = time.time_ns() - 10 * 10**9
+    os.utime(path, ns=(past, past))
+
+
+def _time_each(func, args_list):
+    """ Call func once per element of args_list (eg to mark done the ToDos a previous benchmark
+    added), and time each call """
+    times = []
+    for args in args_list:
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return {'calls': len(times),
+            'mean_us': sum(times) / len(times) * 1e6,
+            'min_us': min(times) * 1e6}
+
+
+def _added_ids(path, tags):
+    """ Ids of ToDos added with a unique tag each """
+    return [md_helpers.md_search(path, tag, 1)[0]['id'] for tag in tags]
+
+
+def _todo_text(todo_num):
+    return f'benchmark todo zq{todo_num}x {random.choice(_WORDS)}'
+
+
+def bench_md_helpers(path, n_sections, min_time, write_reps):
+    """ Time all md_helpers functions on the ToDo file at path """
+    _age_file(path)
+    results = {}
+    section = f'Section {n_sections // 2}'
+    doc = md_helpers.md_load(path)
+    mid_line = len(doc.lines) // 2
+    mid_id = doc.todo_id(mid_line)
+    rev = doc.revision
+
+    def touched_load():
+        # A new mtime makes the file look changed, so it's read again (but not parsed, the content
+        # is the same)
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+        md_helpers.md_load(path)
+
+    def lock_cycle():
+        with md_helpers.md_write_lock(path):
+            pass
+
+    reads = {
+        'MdTodoDoc (parse)': lambda: md_helpers.MdTodoDoc(list(doc.lines)),
+        'md_load (touched)': touched_load,
+        'md_load': lambda: md_helpers.md_load(path),
+        'md_changed_externally': lambda: md_helpers.md_changed_externally(path),
+        'md_create_if_not_exists': lambda: md_helpers.md_create_if_not_exists(path),
+        'md_write_lock': lock_cycle,
+        'md_parse_todo_ref': lambda: md_helpers.md_parse_todo_ref(mid_id),
+        'md_get_all': lambda: md_helpers.md_get_all(path),
+        'md_get_all_todos': lambda: md_helpers.md_get_all_todos(path),
+        'md_get_sections': lambda: md_helpers.md_get_sections(path),
+        'md_get_section_contents': lambda: md_helpers.md_get_section_contents(path, section),
+        'md_get_parsed_sections (parse_todo_file)': lambda: md_helpers.md_get_parsed_sections(path),
+        'md_get_sections_delta': lambda: md_helpers.md_get_sections_delta(path, rev),
+        'md_find_section': lambda: md_helpers.md_find_section(path, section.lower()),
+        'md_search': lambda: md_helpers.md_search(path, 'milk bike'),
+        'md_get_page': lambda: md_helpers.md_get_page(path, 0, 3800),
+        'md_get_history': lambda: md_helpers.md_get_history(path, 20),
+        'md_done_ops': lambda: md_helpers.md_done_ops(path, [mid_id, str(mid_line)]),
+    }
+    for name, func in reads.items():
+        _record(results, name, _time(func, min_time))
+    # Not a fair comparison with md_get_sections_delta above: a delta against an older revision
+    md_helpers.md_add_to_section(path, section, _todo_text(-1))
+    _age_file(path)
+    _record(results, 'md_get_sections_delta (1 change)',
+            _time(lambda: md_helpers.md_get_sections_delta(path, rev), min_time))
+
+    # Writes: each benchmark undoes the previous one, so the file keeps its size
+    tags = [f'zq{i}x' for i in range(write_reps)]
+    _record(results, 'md_add_to_section', _time_each(
+        md_helpers.md_add_to_section, [(path, section, _todo_text(i)) for i in range(write_reps)]))
+    ids = _added_ids(path, tags)
+    _record(results, 'md_move_todo', _time_each(
+        md_helpers.md_move_todo,
+        [(path, todo_id, direction) for todo_id in ids for direction in (-1, 1)]))
+    _record(results, 'md_mark_done',
+            _time_each(md_helpers.md_mark_done, [(path, todo_id) for todo_id in ids]))
+
+    batch = 10
+    batches = [[('add', section, _todo_text(i * batch + j)) for j in range(batch)]
+               for i in range(write_reps)]
+    _record(results, f'md_apply ({batch} adds)',
+            _time_each(md_helpers.md_apply, [(path, ops) for ops in batches]))
+    ids = _added_ids(path, [f'zq{i}x' for i in range(batch * write_reps)])
+    _record(results, f'md_apply ({batch} dones)', _time_each(
+        lambda ops: md_helpers.md_apply(path, ops),
+        [([('done', todo_id) for todo_id in ids[i:i + batch]],)
+         for i in range(0, len(ids), batch)]))
+    _record(results, 'md_gc_empty_sections',
+            _time_each(md_helpers.md_gc_empty_sections, [(path,)] * write_reps))
+    return results
+
+
+def bench_reminders(path, min_time, write_reps):
+    """ Time the reminder parser and ReminderScheduler reloads. Scheduled jobs go to a scheduler
+    that is never started """
+    _age_file(path)
+    doc = md_helpers.md_load(path)
+    sample = [doc.todo_text(i) for i in range(0, len(doc.lines), max(1, len(doc.lines) // 1000))
+              if doc.todo_id(i) is not None]
+    specs = [normalize_reminder_token(f'{text} {_REMINDER_SPECS[i % len(_REMINDER_SPECS)]}')
+             for i, text in enumerate(sample)]
+
+    def guess_all():
+        for spec in specs:
+            try:
+                guess_reminder_date(spec)
+            except ValueError:
+                pass
+
+    results = {}
+    if specs:
+        stats = _time(guess_all, min_time)
+        stats['calls'] *= len(specs)
+        stats['mean_us'] /= len(specs)
+        stats['min_us'] /= len(specs)
+        _record(results, 'guess_reminder_date', stats)
+
+    try:
+        # pylint: disable=import-outside-toplevel
+        from apscheduler.schedulers.background import BackgroundScheduler
+        from reminders import ReminderScheduler
+    except ImportError:
+        print('apscheduler is not installed, skipping ReminderScheduler benchmarks',
+              file=sys.stderr)
+        return results
+
+    start = time.perf_counter()
+    sched = ReminderScheduler(path, scheduler=BackgroundScheduler())
+    # Reminders are scheduled once there's a sender
+    sched.register_sender(types.SimpleNamespace(send_reminder_msg=lambda txt: None))
+    elapsed = time.perf_counter() - start
+    _record(results, 'ReminderScheduler (first load)',
+            {'calls': 1, 'mean_us': elapsed * 1e6, 'min_us': elapsed * 1e6})
+    _record(results, 'reload_reminders_from_file (unchanged)',
+            _time(sched.reload_reminders_from_file, min_time))
+
+    section = md_helpers.md_load(path).sections[0].name
+    times = []
+    for i in range(write_reps):
+        md_helpers.md_add_to_section(path, section, mark_for_reminder_date(
+            _todo_text(i), datetime.now() + timedelta(days=1)))
+        start = time.perf_counter()
+        sched.reload_reminders_from_file()
+        times.append(time.perf_counter() - start)
+    _record(results, 'reload_reminders_from_file (1 change)', {
+        'calls': len(times), 'mean_us': sum(times) / len(times) * 1e6, 'min_us': min(times) * 1e6})
+    ids = _added_ids(path, [f'zq{i}x' for i in range(write_reps)])
+    md_helpers.md_apply(path, [('done', todo_id) for todo_id in ids])
+    return results
+
+
+def bench_web(path, n_sections, min_time, write_reps):
+    """ Time the /api/* routes through Flask's test client """
+    _age_file(path)
+    try:
+        # pylint: disable=import-outside-toplevel
+        from web import create_app
+    except ImportError:
+        print('flask is not installed, skipping web benchmarks', file=sys.stderr)
+        return {}
+
+    doc = md_helpers.md_load(path)
+    todo_list = types.SimpleNamespace(
+        name='bench', todo_filepath=path, url_prefix='', changes=ChangeNotifier(doc.revision),
+        on_file_updated=lambda: None, git=None)
+    client = create_app([todo_list]).test_client()
+    first = client.get('/api/todos')
+    etag = first.headers['ETag']
+    rev = first.get_json()['rev']
+    section = f'Section {n_sections // 2}'
+
+    results = {}
+    reads = {
+        'GET /api/todos': lambda: client.get('/api/todos'),
+        'GET /api/todos (304)': lambda: client.get('/api/todos', headers={'If-None-Match': etag}),
+        'GET /api/todos?since': lambda: client.get(f'/api/todos?since={rev}'),
+        'GET /api/search': lambda: client.get('/api/search?q=milk+bike'),
+        'GET /api/history': lambda: client.get('/api/history?limit=20'),
+        'POST /api/cmd sections': lambda: client.post('/api/cmd', json={'cmd': '/sections'}),
+    }
+    for name, func in reads.items():
+        _record(results, name, _time(func, min_time))
+
+    _record(results, 'POST /api/add', _time_each(
+        lambda i: client.post('/api/add', json={'section': section, 'text': _todo_text(i)}),
+        [(i,) for i in range(write_reps)]))
+    ids = _added_ids(path, [f'zq{i}x' for i in range(write_reps)])
+    _record(results, 'POST /api/move', _time_each(
+        lambda todo_id: client.post('/api/move', json={'id': todo_id, 'direction': -1}),
+        [(i,) for i in ids]))
+    _record(results, 'POST /api/done',
+            _time_each(lambda todo_id: client.post(f'/api/done/{todo_id}'), [(i,) for i in ids]))
+    return results
+
+
+def run_benchmarks(args):
+    """ Run all benchmarks for each size, returns {size: {benchmark: stats}} """
+    md_helpers.md_set_durability(args.durability)
+    results = {}
+    tmp_dir = tempfile.mkdtemp(prefix='gittodo-bench-')
+    try:
+        for size in args.sizes:
+            path = os.path.join(tmp_dir, f'todo-{size}.md')
+            start = time.perf_counter()
+            n_sections = gen_todo_file(path, size, args.sections, args.reminder_ratio, args.seed)
+            print(f'{size} lines, {n_sections} sections '
+                  f'(generated in {time.perf_counter() - start:.1f} s)', file=sys.stderr)
+            size_results = {}
+            size_results.update(bench_md_helpers(path, n_sections, args.min_time, args.write_reps))
+            size_results.update(bench_reminders(path, args.min_time, args.write_reps))
+            size_results.update(bench_web(path, n_sections, args.min_time, args.write_reps))
+            results[str(size)] = size_results
+    finally:
+        shutil.rmtree(tmp_dir)
+    return results
+
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=_REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new, threshold):
+    """ Print the change of each benchmark in new vs old. Returns the list of regressions: the
+    benchmarks that got slower by more than threshold (a ratio, eg 1.25). Compares the fastest
+    call of each benchmark, which is less noisy than the mean for very fast functions """
+    regressions = []
+    print(f'{"size":>8} {"benchmark":45} {"old min us":>12} {"new min us":>12} {"ratio":>7}',
+          file=sys.stderr)
+    for size, new_results in new['results'].items():
+        old_results = old['results'].get(size, {})
+        for name, stats in new_results.items():
+            if name not in old_results:
+                continue
+            old_us, new_us = old_results[name]['min_us'], stats['min_us']
+            ratio = new_us / old_us if old_us > 0 else float('inf')
+            mark = ''
+            if ratio > threshold:
+                mark = ' SLOWER'
+                regressions.append((size, name, ratio))
+            print(f'{size:>8} {name:45} {old_us:12.1f} {new_us:12.1f} {ratio:7.2f}{mark}',
+                  file=sys.stderr)
+    return regressions
+
+
+# Differential check
+
+
+def _reference_parse_todo_file(path):
+    """ The original parser for the web UI (parse_todo_file in main.py) """
+    with open(path, 'r', encoding='utf-8') as f:
+        lines = f.readlines()
+
+    sections = []
+    current_section = None
+
+    for i, line in enumerate(lines):
+        if line.startswith('## '):
+            if current_section:
+                sections.append(current_section)
+            current_section = {
+                'name': line[3:].strip(),
+                'todos': []
+            }
+        elif current_section and line.strip() and not line.startswith('#'):
+            todo_text = line.strip()
+            if todo_text.startswith('* '):
+                todo_text = todo_text[2:]
+            current_section['todos'].append({
+                'line_num': i,
+                'text': todo_text
+            })
+
+    if current_section:
+        sections.append(current_section)
+
+    return sections
+
+
+def _load_md_helpers_at(rev):
+    """ Import md_helpers.py as of git revision rev, as a separate module """
+    src = subprocess.run(['git', 'show', f'{rev}:md_helpers.py'], cwd=_REPO_ROOT,
+                         capture_output=True, text=True, check=True).stdout
+    module = types.ModuleType(f'md_helpers_{rev}')
+    module.__file__ = f'md_helpers.py@{rev}'
+    exec(compile(src, module.__file__, 'exec'), module.__dict__)  # pylint: disable=exec-used
+    return module
+
+
+# Section names for the differential check: none is a prefix of another, or a case variant
+_DIFF_SECTIONS = ['Home', 'Work', 'Misc', 'Errands']
+
+
+def _random_doc(rnd):
+    lines = []
+    if rnd.random() < 0.3:
+        lines.append('# Title\n')
+    if rnd.random() < 0.3:
+        lines.append('preamble\n')
+    for _ in range(rnd.randint(0, 5)):
+        lines.append(f'## {rnd.choice(_DIFF_SECTIONS)}\n')
+        for _ in range(rnd.randint(0, 5)):
+            kind = rnd.random()
+            if kind < 0.1:
+                lines.append('\n')
+            elif kind < 0.15:
+                lines.append('#comment\n')
+            else:
+                lines.append(f'* item {rnd.randint(0, 99)}\n')
+        if rnd.random() < 0.5:
+            lines.append('\n')
+    return ''.join(lines)
+
+
+def _call(func, *args):
+    """ Result of func, or the type of exception it raised """
+    try:
+        return func(*args)
+    except (LookupError, ValueError) as ex:
+        return type(ex).__name__
+
+
+def differential_check(rev, n_files, n_edits, seed):
+    """ Check md_helpers against md_helpers as of rev. Returns a list of mismatch descriptions """
+    old = _load_md_helpers_at(rev)
+    mismatches = []
+    tmp_dir = tempfile.mkdtemp(prefix='gittodo-diff-')
+    try:
+        old_path = os.path.join(tmp_dir, 'old.md')
+        new_path = os.path.join(tmp_dir, 'new.md')
+        for file_num in range(n_files):
+            rnd = random.Random(seed + file_num)
+            content = _random_doc(rnd)
+            for path in (old_path, new_path):
+                with open(path, 'w', encoding='utf-8') as fp:
+                    fp.write(content)
+
+            for edit in range(n_edits + 1):
+                where = f'file {file_num} (seed {seed + file_num}), after {edit} edits'
+                with open(new_path, 'r', encoding='utf-8') as fp:
+                    content = fp.read()
+                for name in ('md_get_all', 'md_get_all_todos', 'md_get_sections'):
+                    if _call(getattr(old, name), old_path) != \
+                            _call(getattr(md_helpers, name), new_path):
+                        mismatches.append(f'{where}: {name} differs')
+                parsed = [{'name': sect['name'],
+                           'todos': [{'line_num': todo['line_num'], 'text': todo['text']}
+                                     for todo in sect['todos']]}
+                          for sect in md_helpers.md_get_parsed_sections(new_path)]
+                if parsed != _reference_parse_todo_file(new_path):
+                    mismatches.append(
+                        f'{where}: md_get_parsed_sections differs from parse_todo_file')
+                for sect in _DIFF_SECTIONS:
+                    # With duplicated sections, the new version lists the first one only
+                    if content.count(f'## {sect}\n') > 1:
+                        continue
+                    if _call(old.md_get_section_contents, old_path, sect) != \
+                            _call(md_helpers.md_get_section_contents, new_path, sect):
+                        mismatches.append(f'{where}: md_get_section_contents({sect}) differs')
+                if edit == n_edits:
+                    break
+
+                n_lines = content.count('\n')
+                kind = rnd.random()
+                if kind < 0.4:
+                    sect, text = rnd.choice(_DIFF_SECTIONS), f'new {rnd.randint(0, 9)}'
+                    op = (f'md_add_to_section {sect} {text}', 'md_add_to_section', (sect, text))
+                elif kind < 0.7:
+                    # Negative line numbers are rejected now, but used to count from the end
+                    line = rnd.randint(0, n_lines)
+                    op = (f'md_mark_done {line}', 'md_mark_done', (line,))
+                elif kind < 0.9:
+                    line, direction = rnd.randint(-1, n_lines), rnd.choice([-1, 1])
+                    op = (f'md_move_todo {line} {direction}', 'md_move_todo', (line, direction))
+                else:
+                    op = ('md_gc_empty_sections', 'md_gc_empty_sections', ())
+                desc, name, args = op
+                old_result = _call(getattr(old, name), old_path, *args)
+                new_result = _call(getattr(md_helpers, name), new_path, *args)
+                if old_result != new_result:
+                    mismatches.append(f'{where}: {desc} returned {new_result!r}, '
+                                      f'{rev} returned {old_result!r}')
+                with open(old_path, 'r', encoding='utf-8') as old_fp, \
+                        open(new_path, 'r', encoding='utf-8') as new_fp:
+                    if old_fp.read() != new_fp.read():
+                        mismatches.append(f'{where}: file differs after {desc}')
+                        break
+    finally:
+        shutil.rmtree(tmp_dir)
+    return mismatches
+
+
+def main():
+    """ Run benchmarks and/or the differential check """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='100,1000,10000,100000',
+                        type=lambda sizes: [int(size) for size in sizes.split(',')],
+                        help='Comma separated list of ToDo file sizes, in lines '
+                             '(default: %(default)s)')
+    parser.add_argument('--sections', type=int, default=20)
+    parser.add_argument('--reminder-ratio', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='Seconds to spend timing each read')
+    parser.add_argument('--write-reps', type=int, default=10, help='Times to run each write')
+    parser.add_argument('--durability', default='file', choices=md_helpers.DURABILITY_LEVELS)
+    parser.add_argument('--out', help='Write results as JSON to this file (default: stdout)')
+    parser.add_argument('--compare', help='Compare with the results in this file')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='With --compare, exit with an error if anything got this much slower')
+    parser.add_argument('--check-against', metavar='REV',
+                        help='Run the differential check against REV')
+    parser.add_argument('--check-files', type=int, default=2000)
+    parser.add_argument('--no-bench', action='store_true', help="Don't run benchmarks")
+    args = parser.parse_args()
+
+    failed = False
+    if args.check_against is not None:
+        mismatches = differential_check(args.check_against, args.check_files, 15, args.seed)
+        for mismatch in mismatches[:20]:
+            print(mismatch, file=sys.stderr)
+        print(f'Differential check against {args.check_against}: {args.check_files} files, '
+              f'{len(mismatches)} mismatches', file=sys.stderr)
+        failed = bool(mismatches)
+
+    if not args.no_bench:
+        report = {
+            'revision': _git_revision(),
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'args': {key: val for key, val in vars(args).items() if key not in ('out', 'compare')},
+            'results': run_benchmarks(args),
+        }
+        if args.out is None:
+            json.dump(report, sys.stdout, indent=1)
+            print()
+        else:
+            with open(args.out, 'w', encoding='utf-8') as fp:
+                json.dump(report, fp, indent=1)
+        if args.compare is not None:
+            with open(args.compare, 'r', encoding='utf-8') as fp:
+                regressions = compare(json.load(fp), report, args.threshold)
+            failed = failed or bool(regressions)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+""" Load test for the web API: hammers /api/todos (reads) and /api/add (writes) of a running GitToDo
+service from a pool of concurrent clients, then reports requests/sec and latency percentiles for
+each endpoint.
+
+Adds will change the ToDo file (and trigger git commits), so run this against a service using a
+scratch ToDo file in a scratch repo:
+    python3 scripts/load_test.py --url http://localhost:4300 --duration 30 --write-ratio 0.1
+
+ToDos are added to a new section, load-$timestamp, which is cleaned up at the end (unless --keep
+is set). """
+
+import argparse
+import random
+import threading
+import time
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+
+# Scripts run from this directory, so the other scripts can be imported
+from stress_api import api_request
+
+
+def _percentile(sorted_vals, pct):
+    if not sorted_vals:
+        return float('nan')
+    return sorted_vals[min(len(sorted_vals) - 1, int(len(sorted_vals) * pct / 100))]
+
+
+def _client(base_url, section, deadline, write_ratio, seed, results, lock):
+    rnd = random.Random(seed)
+    local = {'/api/todos': [], '/api/add': []}
+    errors = 0
+    i = 0
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            if rnd.random() < write_ratio:
+                endpoint = '/api/add'
+                todo = {'section': section, 'text': f'{section} {seed} {i}'}
+                ok = api_request(base_url, endpoint, todo)['success']
+            else:
+                endpoint = '/api/todos'
+                ok = 'sections' in api_request(base_url, endpoint)
+        except (urllib.error.URLError, OSError, ValueError):
+            ok = False
+        elapsed = time.perf_counter() - start
+        if ok:
+            local[endpoint].append(elapsed)
+        else:
+            errors += 1
+        i += 1
+
+    with lock:
+        for endpoint, lats in local.items():
+            results[endpoint].extend(lats)
+        results['errors'] += errors
+
+
+def main():
+    """ Run load test """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:4300')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=20, help='Seconds to run for')
+    parser.add_argument('--write-ratio', type=float, default=0.1,
+                        help='Fraction of requests that are adds')
+    parser.add_argument('--keep', action='store_true', help="Don't clean up the load test section")
+    args = parser.parse_args()
+
+    section = f'load-{int(time.time())}'
+    base_url = args.url.rstrip('/')
+    results = {'/api/todos': [], '/api/add': [], 'errors': 0}
+    lock = threading.Lock()
+
+    start = time.monotonic()
+    deadline = start + args.duration
+    with ThreadPoolExecutor(args.clients) as pool:
+        for seed in range(args.clients):
+            pool.submit(_client, base_url, section, deadline, args.write_ratio, seed, results, lock)
+    elapsed = time.monotonic() - start
+
+    print(f'{args.clients} clients for {elapsed:.1f}s, {results["errors"]} errors')
+    for endpoint in ('/api/todos', '/api/add'):
+        lats = sorted(results[endpoint])
+        print(f'{endpoint:12} {len(lats):7} reqs {len(lats) / elapsed:8.1f} req/s  '
+              f'p50 {_percentile(lats, 50) * 1000:7.1f} ms  '
+              f'p99 {_percentile(lats, 99) * 1000:7.1f} ms')
+
+    if not args.keep:
+        for sect in api_request(base_url, '/api/todos')['sections']:
+            if sect['name'] == section:
+                ids = ' '.join(todo['id'] for todo in sect['todos'])
+                api_request(base_url, '/api/cmd', {'cmd': f'/done {ids}'})
+
+
+if __name__ == '__main__':
+    main()
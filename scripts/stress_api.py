@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+""" Stress test for concurrent writes: fires hundreds of concurrent /api/add and /api/done calls
+to a running GitToDo service, then checks no ToDo was lost or duplicated.
+
+Every request will trigger a git commit (or schedule one), so run this against a service using a
+scratch ToDo file in a scratch repo:
+    python3 scripts/stress_api.py --url http://localhost:4300
+
+All ToDos are added to a new section, stress-$timestamp. Only lines in that section are marked
+done, and it's cleaned up at the end (unless --keep is set). """
+
+import argparse
+import json
+import random
+import sys
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def api_request(base_url, path, body=None):
+    """ Call an API endpoint of the service: GET, or POST body as JSON if set. Returns the decoded
+    JSON response. Also used by load_test.py """
+    data = None if body is None else json.dumps(body).encode('utf-8')
+    req = urllib.request.Request(
+        base_url + path,
+        data=data,
+        method='GET' if body is None else 'POST',
+        headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(req, timeout=60) as resp:
+        return json.loads(resp.read().decode('utf-8'))
+
+
+def _get_section(base_url, name):
+    for sect in api_request(base_url, '/api/todos')['sections']:
+        if sect['name'] == name:
+            return sect
+    return None
+
+
+def _add(base_url, section, text):
+    return api_request(base_url, '/api/add', {'section': section, 'text': text})['success']
+
+
+def _done(base_url, line_num):
+    return api_request(base_url, f'/api/done/{line_num}', {})['success']
+
+
+def main():
+    """ Run stress test, exit with an error if ToDos were lost """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:4300')
+    parser.add_argument('--seed-todos', type=int, default=300,
+                        help='ToDos to add before mixing in dones')
+    parser.add_argument('--adds', type=int, default=200)
+    parser.add_argument('--dones', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=32)
+    parser.add_argument('--keep', action='store_true', help="Don't clean up the stress section")
+    args = parser.parse_args()
+    if args.dones >= args.seed_todos:
+        sys.exit('--dones must be smaller than --seed-todos')
+
+    section = f'stress-{int(time.time())}'
+    base_url = args.url.rstrip('/')
+
+    # Phase 1: concurrent adds only, all of them should make it to the file
+    seed_txts = [f'{section} seed {i}' for i in range(args.seed_todos)]
+    start = time.time()
+    with ThreadPoolExecutor(args.workers) as pool:
+        ok = list(pool.map(lambda txt: _add(base_url, section, txt), seed_txts))
+    print(f'Seeded {sum(ok)}/{len(ok)} ToDos in {time.time() - start:.2f}s')
+
+    sect = _get_section(base_url, section)
+    found = [] if sect is None else [todo['text'] for todo in sect['todos']]
+    missing = set(seed_txts) - set(found)
+    if missing or len(found) != len(seed_txts):
+        sys.exit(f'FAIL: expected {len(seed_txts)} ToDos, found {len(found)}. '
+                 f'Missing: {sorted(missing)[:10]}')
+
+    # Phase 2: concurrent adds and dones. The section only grows at its top and never shrinks below
+    # seed_todos - dones lines, so the first lines after the header are always ToDos of this section
+    # (though not necessarily the same ones a request saw when it was sent)
+    header_line = sect['todos'][0]['line_num'] - 1
+    add_txts = [f'{section} add {i}' for i in range(args.adds)]
+    jobs = [('add', txt) for txt in add_txts]
+    jobs += [('done', header_line + random.randint(1, args.seed_todos - args.dones))
+             for _ in range(args.dones)]
+    random.shuffle(jobs)
+
+    def run_job(job):
+        if job[0] == 'add':
+            return job[0], _add(base_url, section, job[1])
+        return job[0], _done(base_url, job[1])
+
+    start = time.time()
+    with ThreadPoolExecutor(args.workers) as pool:
+        results = list(pool.map(run_job, jobs))
+    elapsed = time.time() - start
+    adds_ok = sum(1 for op, ok in results if op == 'add' and ok)
+    dones_ok = sum(1 for op, ok in results if op == 'done' and ok)
+    print(f'Ran {len(jobs)} mixed requests in {elapsed:.2f}s ({len(jobs) / elapsed:.1f} req/s): '
+          f'{adds_ok} adds and {dones_ok} dones succeeded')
+
+    found = [todo['text'] for todo in _get_section(base_url, section)['todos']]
+    expected_count = args.seed_todos + adds_ok - dones_ok
+    unknown = set(found) - set(seed_txts) - set(add_txts)
+    dupes = len(found) - len(set(found))
+    failed = len(found) != expected_count or unknown or dupes
+    print(f'Expected {expected_count} ToDos, found {len(found)} '
+          f'({dupes} duplicated, {len(unknown)} unknown)')
+
+    if not args.keep:
+        sect = _get_section(base_url, section)
+        nums = ' '.join(str(todo['line_num']) for todo in sect['todos'])
+        api_request(base_url, '/api/cmd', {'cmd': f'/done {nums}'})
+
+    if failed:
+        sys.exit('FAIL: ToDos were lost or corrupted')
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
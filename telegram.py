@@ -1,50 +1,87 @@
 """ ToDo list Telegram bot: integrates a file-backed ToDo list with a Telegram set of commands """
 
 import logging
-from reminders import guess_reminder_date, mark_for_reminder_date, get_reminder_date_if_set, strip_reminder_tokens, normalize_reminder_token
+import subprocess
+from done_archive import format_done
+import metrics
+import profiling
+from notifier import TelegramNotifier
+from reminders import (guess_reminder_date, mark_for_reminder_date, get_reminder_date_if_set,
+                       normalize_reminder_token)
 from pytelegrambot import TelegramLongpollBot
 from md_helpers import (md_create_if_not_exists,
-                        md_get_all,
+                        md_get_page,
                         md_get_sections,
-                        md_get_section_contents,
                         md_add_to_section,
-                        md_mark_done)
+                        md_apply,
+                        md_done_ops,
+                        md_get_history,
+                        md_search)
 
 log = logging.getLogger(__name__)
 
+# Telegram rejects messages longer than 4096 chars; leave room for the page footer
+_LS_PAGE_CHARS = 3800
+# Search results sent in a single message
+_SEARCH_MAX_RESULTS = 30
+# ToDos listed by /history with no count
+_HISTORY_DEFAULT_LEN = 10
+_NO_GIT_MSG = "Git sync runs in another process (the reminders mode), it can't be forced from here"
+
+_COMMAND_SECONDS = metrics.histogram(
+    'gittodo_telegram_command_seconds', 'Time to handle a Telegram command', ('command',))
+
+
+def _instrumented(name, handler):
+    """ Wrap a command handler to record how long it takes, and to profile it if requested (the
+    profiling target is 'telegram:<command>', see profiling.py) """
+    def instrumented_handler(bot, msg):
+        with _COMMAND_SECONDS.time(name), profiling.maybe_profile(f'telegram:{name}'):
+            return handler(bot, msg)
+    return instrumented_handler
+
 
 class TelBot(TelegramLongpollBot):
-    """ Listen to a set of commands on Telegram, and apply them to a list of ToDos backed
-    by a Markdown file """
+    """ Listen to a set of commands on Telegram, and apply them to the ToDo list (backed by a
+    Markdown file) of the chat that sent them """
 
     def __init__(self, tok,
                  short_poll_interval_secs,
                  long_poll_interval_secs,
-                 accepted_chat_ids,
-                 todo_filepath,
-                 on_todo_file_updated,
-                 force_pull_cb,
-                 force_push_cb):
-        self._on_todo_file_updated = on_todo_file_updated
-        self._force_pull_cb = force_pull_cb
-        self._force_push_cb = force_push_cb
-        self._accepted_chat_ids = accepted_chat_ids
-        self._todo_filepath = todo_filepath
-        md_create_if_not_exists(self._todo_filepath)
+                 todo_lists,
+                 reminder_digest_secs=5):
+        """ todo_lists are the lists to serve (see main.TodoList); each chat may only use the list
+        that has it in its chat_ids """
+        self._lists_by_chat = {}
+        for todo_list in todo_lists:
+            for chat_id in todo_list.chat_ids:
+                self._lists_by_chat[chat_id] = todo_list
+            md_create_if_not_exists(todo_list.todo_filepath)
+        # Notifications (reminders, git failures) are sent from a queue, so scheduler threads never
+        # block on Telegram, and bursts don't get throttled
+        self._notifier = TelegramNotifier(self.send_message, reminder_digest_secs)
+        # Chat id -> (section or None, next page) of the last /ls, for /ls more
+        self._ls_next_page = {}
 
         cmds = [
             ('ls',
-             "Use: /ls [section] - List all ToDos [in section]",
+             "Use: /ls [section] - List all ToDos [in section]. /ls more for the next page",
              self._ls),
             ('sections',
              'List sections',
              self._sects),
+            ('search',
+             'Find ToDos containing all words. Use: /search <words>',
+             self._search),
             ('add',
              'Add ToDo. Use: /add <section> <ToDo>',
              self._add),
             ('done',
-             'Mark complete. Use: /done <number>',
+             'Mark complete. Use: /done <number|id>',
              self._mark_done),
+            ('history',
+             'Recently completed ToDos. Use: /history [count]',
+             self._history),
             ('pull',
              'Force git pull',
              self._force_pull),
@@ -52,18 +89,23 @@ class TelBot(TelegramLongpollBot):
              'Force commit and push, in case external changes to files where not pushed',
              self._force_push),
         ]
+        cmds = [(name, help_txt, _instrumented(name, handler)) for name, help_txt, handler in cmds]
         super().__init__(
             tok,
-            self._accepted_chat_ids,
+            list(self._lists_by_chat),
             short_poll_interval_secs,
             long_poll_interval_secs,
             cmds=cmds,
             terminate_on_unauthorized_access=True,
             try_parse_msg_as_cmd=True)
 
-    def _notify_todo_file_updated(self):
+    def _todo_file(self, msg):
+        """ ToDo file of the list the sender of msg uses """
+        return self._lists_by_chat[msg['from']['id']].todo_filepath
+
+    def _notify_todo_file_updated(self, msg):
         try:
-            self._on_todo_file_updated()
+            self._lists_by_chat[msg['from']['id']].on_file_updated()
         except BaseException:  # pylint: disable=broad-exception-caught
             # Never leak an exception up, an error here is not this class'
             # responsibility
@@ -77,27 +119,69 @@ class TelBot(TelegramLongpollBot):
 
     def on_bot_received_message(self, msg):
         """ Called by super() """
-        log.info('Telegram bot received a message: %s', msg)
+        log.debug('Telegram bot received a message: %s', msg)
 
-    def on_failed_git_op(self, msg):
-        """ Notify bot of a failed git op, to notify a user """
-        for cid in self._accepted_chat_ids:
-            self.send_message(
-                cid, f'Git op fail, manual fix will be needed {msg}')
+    def on_failed_git_op(self, msg, chat_ids):
+        """ Notify bot of a failed git op, to notify the users of the list """
+        self._notifier.on_failed_git_op(msg, chat_ids)
 
     def _ls(self, _bot, msg):
-        if len(msg['cmd_args']) > 0:
-            todo_list = md_get_section_contents(
-                self._todo_filepath, msg['cmd_args'][0])
+        chat_id = msg['from']['id']
+        args = msg['cmd_args']
+        if len(args) > 0 and args[0].lower() == 'more':
+            if chat_id not in self._ls_next_page:
+                self.send_message(chat_id, "Nothing more to list")
+                return
+            section, page = self._ls_next_page.pop(chat_id)
+        else:
+            section = args[0] if len(args) > 0 else None
+            page = 0
+
+        todo_list, page, n_pages = md_get_page(self._todo_file(msg), page, _LS_PAGE_CHARS, section)
+        if page + 1 < n_pages:
+            self._ls_next_page[chat_id] = (section, page + 1)
+            todo_list += f'\n[Page {page + 1}/{n_pages}, /ls more for the next one]'
         else:
-            todo_list = md_get_all(self._todo_filepath)
-        self.send_message(msg['from']['id'], todo_list)
+            self._ls_next_page.pop(chat_id, None)
+        self.send_message(chat_id, todo_list)
 
     def _sects(self, _bot, msg):
         self.send_message(
             msg['from']['id'],
             md_get_sections(
-                self._todo_filepath))
+                self._todo_file(msg)))
+
+    def _search(self, _bot, msg):
+        chat_id = msg['from']['id']
+        query = ' '.join(msg.get('cmd_args', []))
+        if not query.strip():
+            self.send_message(chat_id, "Use: /search <words>")
+            return
+        results = md_search(self._todo_file(msg), query, _SEARCH_MAX_RESULTS + 1)
+        if not results:
+            self.send_message(chat_id, f"No ToDos match '{query}'")
+            return
+        found = '\n'.join(f"{todo['id']} - {todo['text']}"
+                          for todo in results[:_SEARCH_MAX_RESULTS])
+        if len(results) > _SEARCH_MAX_RESULTS:
+            found += (f'\n[Showing the first {_SEARCH_MAX_RESULTS} matches, '
+                      'add words to narrow it down]')
+        self.send_message(chat_id, found)
+
+    def _history(self, _bot, msg):
+        chat_id = msg['from']['id']
+        args = msg.get('cmd_args', [])
+        try:
+            limit = int(args[0]) if args else _HISTORY_DEFAULT_LEN
+        except ValueError:
+            self.send_message(chat_id, "Use: /history [count]")
+            return
+        total, done = md_get_history(self._todo_file(msg), max(1, min(limit, _SEARCH_MAX_RESULTS)))
+        if not done:
+            self.send_message(chat_id, "Nothing was completed yet")
+            return
+        report = '\n'.join(format_done(rec) for rec in done)
+        self.send_message(chat_id, f'{report}\n[{len(done)} most recent of {total} completed]')
 
     def _add(self, _bot, msg):
         section = msg['cmd_args'][0]
@@ -120,27 +204,29 @@ class TelBot(TelegramLongpollBot):
             confirm_msg = f"OK. Set reminder for {maybe_reminder}"
             todo = mark_for_reminder_date(todo, maybe_reminder)
 
-        md_add_to_section(self._todo_filepath, section, todo)
+        md_add_to_section(self._todo_file(msg), section, todo)
         self.send_message(msg['from']['id'], confirm_msg)
-        self._notify_todo_file_updated()
+        self._notify_todo_file_updated(msg)
 
     def _mark_done(self, _bot, msg):
+        if len(msg.get('cmd_args', [])) == 0:
+            self.send_message(msg['from']['id'], "Use: /done <number|id> [...]")
+            return
+
+        # ToDos are deleted bottom-up, so that line numbers of the rest remain valid
         try:
-            todo_nums = [int(n) for n in msg['cmd_args']]
-            todo_nums.sort(reverse=True)
-        except (KeyError, ValueError):
-            self.send_message(
-                msg['from']['id'],
-                "Can't find ToDo[s] {msg['cmd_args']}")
+            ops = md_done_ops(self._todo_file(msg), msg['cmd_args'])
+        except ValueError as ex:
+            self.send_message(msg['from']['id'], str(ex))
             return
+        log.info("Mark ToDo(s) %s done", [ref for _, ref in ops])
+        changed, deleted_lines = md_apply(self._todo_file(msg), ops)
+        if changed:
+            self._notify_todo_file_updated(msg)
 
-        # Reverse-sorting maintains todo line number while deleting
         action_report = []
-        for num in todo_nums:
-            log.info("Mark ToDo #%s done", num)
-            try:
-                deleted_line = md_mark_done(self._todo_filepath, num)
-            except IndexError:
+        for (_, num), deleted_line in zip(ops, deleted_lines):
+            if isinstance(deleted_line, LookupError):
                 action_report.append(f"ToDo {num} doesn't exist")
                 continue
 
@@ -148,11 +234,6 @@ class TelBot(TelegramLongpollBot):
                 action_report.append(f"ToDo #{num} can't be deleted")
                 continue
 
-            try:
-                self._notify_todo_file_updated()
-            except BaseException:  # pylint: disable=broad-exception-caught
-                log.error("ToDo file updated listener failed", exc_info=True)
-
             reminder_date = get_reminder_date_if_set(deleted_line)
             if reminder_date is None:
                 action_report.append(f"ToDo #{num} deleted")
@@ -171,21 +252,42 @@ class TelBot(TelegramLongpollBot):
         else:
             self.send_message(msg['from']['id'], "\n".join(action_report))
 
+    def _git(self, msg):
+        """ Git sync of the sender's list, or None (after telling the sender) if it runs in another
+        process, see main.MODES """
+        git = self._lists_by_chat[msg['from']['id']].git
+        if git is None:
+            self.send_message(msg['from']['id'], _NO_GIT_MSG)
+        return git
+
     def _force_pull(self, _bot, msg):
         log.info("User requested force push in command %s", msg)
-        self._force_pull_cb()
+        git = self._git(msg)
+        if git is None:
+            return
+        git.pull()
         self.send_message(msg['from']['id'], "Pull complete")
 
     def _force_push(self, _bot, msg):
         log.info("User requested force push in command %s", msg)
-        self._force_push_cb()
-        self.send_message(msg['from']['id'], "Push complete")
-
-    def send_reminder_msg(self, txt):
-        """ Notify all registered users of a reminder triggering """
-        clean_txt = strip_reminder_tokens(txt)
-        for cid in self._accepted_chat_ids:
-            self.send_message(cid, f'Reminder: {clean_txt}')
+        git = self._git(msg)
+        if git is None:
+            return
+        try:
+            pushed = git.commit()
+        except (subprocess.CalledProcessError, RuntimeError):
+            # The error itself was already sent to the list's chats, see on_failed_git_op
+            self.send_message(msg['from']['id'], "Push failed")
+            return
+        self.send_message(msg['from']['id'], "Push complete" if pushed else "Nothing to push")
+
+    def outbox_stats(self):
+        """ Stats of the queue for outbound notifications """
+        return self._notifier.outbox_stats()
+
+    def send_reminder_msg(self, txt, chat_ids):
+        """ Notify the users of a list of a reminder triggering """
+        self._notifier.send_reminder_msg(txt, chat_ids)
 
     def on_bot_received_non_cmd_message(self, msg):
         log.warning('Received unexpected message "%s"', msg)
@@ -0,0 +1,6 @@
+""" The service's modules live at the top of the repo, make them importable from the tests """
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
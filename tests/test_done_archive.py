@@ -0,0 +1,48 @@
+""" Location of the done archive """
+
+import os
+
+import pytest
+
+import md_helpers
+from md_helpers import md_get_history, md_mark_done, md_set_archive_path
+
+
+def test_archive_is_moved_out_of_the_checkout(tmp_path):
+    md_helpers.md_set_durability('none')
+    repo = tmp_path / 'repo'
+    repo.mkdir()
+    todo_file = repo / 'todo.md'
+    todo_file.write_text('## A\n* one\n* two\n', encoding='utf-8')
+    # An archive made before its location was configured
+    md_mark_done(str(todo_file), 1)
+    assert sorted(os.listdir(repo)) == ['todo.done.idx', 'todo.done.jsonl', 'todo.md']
+
+    state_log = tmp_path / 'state' / 'done.jsonl'
+    md_set_archive_path(str(todo_file), str(state_log))
+    assert sorted(os.listdir(repo)) == ['todo.md']
+    assert sorted(os.listdir(state_log.parent)) == ['done.idx', 'done.jsonl']
+
+    md_mark_done(str(todo_file), 1)
+    total, done = md_get_history(str(todo_file), 10)
+    assert total == 2
+    assert [rec['text'] for rec in done] == ['two', 'one']
+    assert sorted(os.listdir(repo)) == ['todo.md']
+
+
+def test_history_command_rejects_bad_count(tmp_path):
+    pytest.importorskip('flask')
+    # pylint: disable=import-outside-toplevel
+    from types import SimpleNamespace
+    from web import process_command
+    md_helpers.md_set_durability('none')
+    todo_file = tmp_path / 'todo.md'
+    todo_file.write_text('## A\n* one\n', encoding='utf-8')
+    md_mark_done(str(todo_file), 1)
+    todo_list = SimpleNamespace(name='test', todo_filepath=str(todo_file))
+
+    assert process_command(todo_list, '/history many') == \
+        (False, 'Error: Usage /history [count]')
+    success, result = process_command(todo_list, '/history 5')
+    assert success
+    assert 'one' in result
@@ -0,0 +1,29 @@
+""" FileWatcher """
+
+import threading
+import time
+
+import pytest
+
+from file_watcher import FileWatcher, _inotify_libc
+
+
+@pytest.mark.skipif(_inotify_libc() is None, reason='needs inotify')
+def test_busy_neighbour_files_dont_delay_notifications(tmp_path):
+    todo_file = tmp_path / 'todo.md'
+    neighbour = tmp_path / 'todo.md.done.jsonl'
+    todo_file.write_text('## A\n', encoding='utf-8')
+    changed = threading.Event()
+    watcher = FileWatcher(str(todo_file), changed.set, debounce_secs=0.3, poll_interval_secs=0.5)
+    watcher.start()
+    try:
+        todo_file.write_text('## A\n* one\n', encoding='utf-8')
+        # A file in the same directory changes more often than the debounce period
+        deadline = time.monotonic() + 2
+        while not changed.is_set() and time.monotonic() < deadline:
+            with neighbour.open('a', encoding='utf-8') as fp:
+                fp.write('{}\n')
+            time.sleep(0.05)
+        assert changed.is_set()
+    finally:
+        watcher.stop()
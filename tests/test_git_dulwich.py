@@ -0,0 +1,77 @@
+""" GitDulwichBackend against a real upstream repo """
+
+import os
+import subprocess
+
+import pytest
+
+pytest.importorskip('dulwich')
+pytest.importorskip('merge3')
+
+from git import GitDulwichBackend  # pylint: disable=wrong-import-position
+
+_GIT_ENV = {**os.environ,
+            'GIT_AUTHOR_NAME': 'test', 'GIT_AUTHOR_EMAIL': 'test@example.com',
+            'GIT_COMMITTER_NAME': 'test', 'GIT_COMMITTER_EMAIL': 'test@example.com'}
+
+
+def _git(cwd, *args):
+    return subprocess.run(['git', *args], cwd=cwd, env=_GIT_ENV, check=True,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout.decode('utf-8')
+
+
+def _write(path, content):
+    with open(path, 'w', encoding='utf-8') as fp:
+        fp.write(content)
+
+
+def _read(path):
+    with open(path, encoding='utf-8') as fp:
+        return fp.read()
+
+
+@pytest.fixture(name='diverged', params=['origin', 'upstream'])
+def diverged_fixture(tmp_path, request):
+    """ A clone with a local commit, whose upstream got another commit that adds a file and edits
+    the ToDo file. The clone's remote is named after the fixture's param. Returns the clone's
+    path """
+    upstream = tmp_path / 'upstream.git'
+    _git(tmp_path, 'init', '-q', '--bare', '-b', 'main', str(upstream))
+    local = tmp_path / 'local'
+    _git(tmp_path, 'clone', '-q', '-o', request.param, str(upstream), str(local))
+    _git(local, 'checkout', '-q', '-b', 'main')
+    _write(local / 'todo.md', '## A\n* one\n')
+    _git(local, 'add', 'todo.md')
+    _git(local, 'commit', '-q', '-m', 'init')
+    _git(local, 'push', '-q', '-u', request.param, 'main')
+
+    other = tmp_path / 'other'
+    _git(tmp_path, 'clone', '-q', str(upstream), str(other))
+    _write(other / 'todo.md', '## A\n* one\n* from upstream\n')
+    _write(other / 'other.txt', 'added upstream\n')
+    _git(other, 'add', 'todo.md', 'other.txt')
+    _git(other, 'commit', '-q', '-m', 'upstream')
+    _git(other, 'push', '-q')
+
+    _write(local / 'todo.md', '## A\n* local\n* one\n')
+    _git(local, 'commit', '-q', '-a', '-m', 'local')
+    return local
+
+
+def test_pull_diverged_keeps_upstream_changes(diverged):
+    GitDulwichBackend(diverged).pull()
+
+    assert _git(diverged, 'status', '--porcelain') == ''
+    assert _read(diverged / 'other.txt') == 'added upstream\n'
+    assert _read(diverged / 'todo.md') == '## A\n* local\n* one\n* from upstream\n'
+    assert _git(diverged, 'log', '--format=%s').split('\n')[:3] == ['local', 'upstream', 'init']
+
+
+def test_pull_diverged_with_uncommitted_changes_fails(diverged):
+    _write(diverged / 'todo.md', '## A\n* local\n* one\n* not committed\n')
+
+    with pytest.raises(RuntimeError, match='uncommitted changes'):
+        GitDulwichBackend(diverged).pull()
+
+    assert _read(diverged / 'todo.md') == '## A\n* local\n* one\n* not committed\n'
+    assert _git(diverged, 'log', '-1', '--format=%s').strip() == 'local'
@@ -0,0 +1,37 @@
+""" Which components each mode starts, when modes run side by side """
+
+import itertools
+
+from main import MODES, TodoList
+
+# Modes that can run as separate processes on the same lists
+_SIDE_BY_SIDE = ('web', 'bot', 'reminders')
+
+
+def test_only_one_side_by_side_mode_syncs_git():
+    assert [mode for mode in _SIDE_BY_SIDE if 'git' in MODES[mode]] == ['reminders']
+
+
+def test_side_by_side_modes_dont_poll_telegram_twice():
+    for mode_a, mode_b in itertools.combinations(_SIDE_BY_SIDE, 2):
+        assert not ('bot' in MODES[mode_a] and 'bot' in MODES[mode_b])
+
+
+def test_all_starts_every_component():
+    assert set(MODES['all']) == set(itertools.chain(*(MODES[mode] for mode in _SIDE_BY_SIDE)))
+
+
+def test_web_mode_doesnt_sync_git(tmp_path):
+    todo_list = TodoList({'name': 'default',
+                          'todo_filepath': str(tmp_path / 'todo.md'),
+                          'url_prefix': '',
+                          'accepted_chat_ids': [],
+                          'done_archive': str(tmp_path / 'done.jsonl')})
+    todo_list.start(MODES['web'])
+    try:
+        assert todo_list.git is None
+        assert todo_list.reminders is None
+        # Still watches the file, to tell web clients about changes from other processes
+        assert todo_list.watcher is not None
+    finally:
+        todo_list.watcher.stop()
@@ -0,0 +1,119 @@
+""" Reminder scheduling """
+
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+import md_helpers
+from md_helpers import md_load
+from reminders import ReminderScheduler, mark_for_reminder_date
+from scheduler import JobJournal
+
+# ReminderScheduler imports apscheduler when created
+pytest.importorskip('apscheduler')
+
+
+class _FakeScheduler:
+    def __init__(self):
+        self.jobs = {}
+
+    def add_job(self, func, trigger, id, replace_existing):  # pylint: disable=redefined-builtin
+        assert replace_existing
+        self.jobs[id] = (func, trigger)
+
+    def remove_job(self, job_id):
+        del self.jobs[job_id]
+
+
+class _Sender:
+    def __init__(self, fail=False):
+        self.sent = []
+        self._fail = fail
+
+    def send_reminder_msg(self, txt):
+        if self._fail:
+            raise RuntimeError('send failed')
+        self.sent.append(txt)
+
+
+def _remind(text, days):
+    when = (datetime.now() + timedelta(days=days)).replace(second=0, microsecond=0)
+    return mark_for_reminder_date(text, when)
+
+
+@pytest.fixture(name='todo_file')
+def todo_file_fixture(tmp_path):
+    md_helpers.md_set_durability('none')
+    return tmp_path / 'todo.md'
+
+
+def test_reload_doesnt_build_todo_ids(todo_file):
+    todo_file.write_text(f'## A\n* {_remind("call", 1)}\n* plain\n', encoding='utf-8')
+    scheduler = _FakeScheduler()
+    reminders = ReminderScheduler(str(todo_file), scheduler=scheduler)
+    reminders.register_sender(_Sender())
+    assert reminders.scheduled_count() == 1
+    assert not md_load(str(todo_file)).has_ids()
+
+
+def test_reload_keeps_jobs_of_unchanged_reminders(todo_file):
+    call = _remind('call', 1)
+    todo_file.write_text(f'## A\n* {call}\n* {call}\n', encoding='utf-8')
+    scheduler = _FakeScheduler()
+    reminders = ReminderScheduler(str(todo_file), scheduler=scheduler)
+    reminders.register_sender(_Sender())
+    jobs = dict(scheduler.jobs)
+    assert len(jobs) == 2
+
+    # Lines added above and between reminders don't change their keys
+    todo_file.write_text(f'## B\n* new\n## A\n* {call}\n* other\n* {call}\n', encoding='utf-8')
+    reminders.reload_reminders_from_file()
+    assert scheduler.jobs == jobs
+
+    todo_file.write_text(f'## A\n* {call}\n', encoding='utf-8')
+    reminders.reload_reminders_from_file()
+    assert len(scheduler.jobs) == 1
+
+
+def _missed_reminder(todo_file, tmp_path):
+    todo_file.write_text(f'## A\n* {_remind("call", -1)}\n', encoding='utf-8')
+    scheduler = _FakeScheduler()
+    reminders = ReminderScheduler(str(todo_file), scheduler=scheduler,
+                                  journal=JobJournal(str(tmp_path / 'journal.json')),
+                                  catchup_secs=2 * 24 * 60 * 60)
+    return scheduler, reminders
+
+
+def test_missed_reminders_wait_for_a_sender(todo_file, tmp_path):
+    scheduler, reminders = _missed_reminder(todo_file, tmp_path)
+    # Would run right away, with nobody to send it
+    assert not scheduler.jobs
+
+    sender = _Sender()
+    reminders.register_sender(sender)
+    (send_reminder, _), = scheduler.jobs.values()
+    send_reminder()
+    assert len(sender.sent) == 1
+    assert reminders.scheduled_count() == 0
+
+    # Recorded as sent: not caught up again
+    scheduler.jobs.clear()
+    todo_file.write_text(todo_file.read_text(encoding='utf-8') + '* other\n', encoding='utf-8')
+    reminders.reload_reminders_from_file()
+    assert not scheduler.jobs
+
+
+def test_failed_send_is_not_recorded(todo_file, tmp_path):
+    scheduler, reminders = _missed_reminder(todo_file, tmp_path)
+    reminders.register_sender(_Sender(fail=True))
+    (send_reminder, _), = scheduler.jobs.values()
+    with pytest.raises(RuntimeError):
+        send_reminder()
+    assert reminders.scheduled_count() == 0
+
+    reminders.register_sender(_Sender())
+    scheduler.jobs.clear()
+    todo_file.write_text(todo_file.read_text(encoding='utf-8') + '* other\n', encoding='utf-8')
+    reminders.reload_reminders_from_file()
+    assert len(scheduler.jobs) == 1
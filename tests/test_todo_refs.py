@@ -0,0 +1,64 @@
+""" Referencing ToDos by line number or id """
+
+import pytest
+
+import md_helpers
+from md_helpers import md_load, md_mark_done, md_parse_todo_ref
+
+_TODOS = '## A\n* one\n* two\n'
+
+
+@pytest.fixture(name='todo_file')
+def todo_file_fixture(tmp_path):
+    path = tmp_path / 'todo.md'
+    path.write_text(_TODOS, encoding='utf-8')
+    md_helpers.md_set_durability('none')
+    return str(path)
+
+
+def test_parse_todo_ref():
+    assert md_parse_todo_ref('12') == 12
+    assert md_parse_todo_ref(' 0 ') == 0
+    assert md_parse_todo_ref('AbCdEf') == 'abcdef'
+    with pytest.raises(ValueError):
+        md_parse_todo_ref('-1')
+
+
+def test_negative_line_number_is_rejected(todo_file):
+    with pytest.raises(IndexError):
+        md_mark_done(todo_file, -1)
+    with open(todo_file, encoding='utf-8') as fp:
+        assert fp.read() == _TODOS
+
+
+def test_done_by_id(todo_file):
+    todo_id = md_load(todo_file).todo_id(2)
+    md_mark_done(todo_file, md_parse_todo_ref(todo_id.upper()))
+    with open(todo_file, encoding='utf-8') as fp:
+        assert fp.read() == '## A\n* one\n'
+
+
+def test_ids_follow_edits(todo_file):
+    doc = md_load(todo_file).copy()
+    todo_id = doc.todo_id(2)
+    assert doc.resolve_todo(todo_id) == 2
+    doc.add_todo('A', '* zero')
+    assert doc.resolve_todo(todo_id) == 3
+    doc.delete_line(3)
+    with pytest.raises(KeyError):
+        doc.resolve_todo(todo_id)
+
+
+def test_api_done_rejects_negative_line_number(todo_file):
+    pytest.importorskip('flask')
+    # pylint: disable=import-outside-toplevel
+    from types import SimpleNamespace
+    from web import create_app
+    todo_list = SimpleNamespace(name='test', todo_filepath=todo_file, url_prefix='',
+                                on_file_updated=lambda: None)
+    client = create_app([todo_list]).test_client()
+
+    assert client.post('/api/done/-1').get_json()['success'] is False
+    with open(todo_file, encoding='utf-8') as fp:
+        assert fp.read() == _TODOS
+    assert client.post('/api/done/2').get_json()['success'] is True
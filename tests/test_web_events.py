@@ -0,0 +1,45 @@
+""" /api/events streams """
+
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('flask')
+
+# pylint: disable=wrong-import-position
+from change_events import ChangeNotifier
+import web
+
+
+@pytest.fixture(name='client')
+def client_fixture(tmp_path, monkeypatch):
+    monkeypatch.setattr(web, '_SSE_MAX_STREAM_SECS', 0.2)
+    monkeypatch.setattr(web, '_SSE_HEARTBEAT_SECS', 0.05)
+    todo_file = tmp_path / 'todo.md'
+    todo_file.write_text('## A\n* one\n', encoding='utf-8')
+    todo_list = SimpleNamespace(name='test', todo_filepath=str(todo_file), url_prefix='',
+                                changes=ChangeNotifier(), on_file_updated=lambda: None)
+    return web.create_app([todo_list], max_event_streams=1).test_client()
+
+
+def test_streams_over_the_limit_are_refused(client):
+    first = client.get('/api/events', buffered=False)
+    assert first.status_code == 200
+    refused = client.get('/api/events')
+    assert refused.status_code == 503
+    assert 'Retry-After' in refused.headers
+
+    # Closing a stream frees its slot
+    first.close()
+    second = client.get('/api/events', buffered=False)
+    assert second.status_code == 200
+    second.close()
+
+
+def test_streams_end_and_tell_clients_to_reconnect(client):
+    with client.get('/api/events') as response:
+        body = response.get_data(as_text=True)
+    assert body.startswith('retry: ')
+    assert 'event: change' in body
+    with client.get('/api/events') as response:
+        assert response.status_code == 200
@@ -0,0 +1,467 @@
+""" Web UI and HTTP API for the ToDo list """
+
+import json
+from datetime import datetime, timezone
+import hmac
+import logging
+import threading
+import time
+
+from flask import Blueprint, Flask, Response, g, jsonify, request, send_file, send_from_directory
+
+from done_archive import format_done
+import metrics
+import profiling
+from reminders import guess_reminder_date, mark_for_reminder_date, normalize_reminder_token
+from md_helpers import (md_load,
+                        md_get_all,
+                        md_get_sections,
+                        md_get_section_contents,
+                        md_get_sections_delta,
+                        md_get_history,
+                        md_add_to_section,
+                        md_apply,
+                        md_done_ops,
+                        md_parse_todo_ref,
+                        md_mark_done,
+                        md_move_todo,
+                        md_search)
+
+log = logging.getLogger(__name__)
+
+_VERBS = ('ls', 'sections', 'search', 'add', 'done', 'history', 'pull', 'push')
+_COMMAND_SECONDS = metrics.histogram(
+    'gittodo_command_seconds', 'Time to run a command from the web UI or /cmd', ('list', 'verb'))
+_STREAMS_REJECTED = metrics.counter(
+    'gittodo_event_streams_rejected_total', 'SSE streams refused because too many were open')
+
+
+def process_command(todo_list, cmd_input):
+    """ Process a command and return (success, result) tuple """
+    cmd_input = cmd_input.strip()
+    if not cmd_input:
+        return (False, 'Error: No command provided')
+
+    if cmd_input.startswith('/'):
+        cmd_input = cmd_input[1:]
+    parts = cmd_input.split()
+    if not parts:
+        return (False, 'Error: Empty command')
+
+    cmd = parts[0].lower()
+    args = parts[1:]
+
+    start = time.perf_counter()
+    try:
+        if cmd == 'ls':
+            if args:
+                result = md_get_section_contents(todo_list.todo_filepath, args[0])
+            else:
+                result = md_get_all(todo_list.todo_filepath)
+        elif cmd == 'sections':
+            result = md_get_sections(todo_list.todo_filepath)
+        elif cmd == 'search':
+            if not args:
+                return (False, 'Error: Usage /search <words>')
+            results = md_search(todo_list.todo_filepath, ' '.join(args))
+            result = '\n'.join(f"{todo['id']} - {todo['text']}" for todo in results) or 'No matches'
+        elif cmd == 'add':
+            if len(args) < 2:
+                return (False, 'Error: Usage /add <section> <todo>')
+            section = args[0]
+            todo = normalize_reminder_token(' '.join(args[1:]))
+            result = 'OK'
+            try:
+                maybe_reminder = guess_reminder_date(todo)
+            except ValueError as ex:
+                maybe_reminder = None
+                result = f"ToDo added. Detected a reminder, but can't parse it: {ex}"
+            if maybe_reminder is not None:
+                result = f"OK. Set reminder for {maybe_reminder}"
+                todo = mark_for_reminder_date(todo, maybe_reminder)
+            md_add_to_section(todo_list.todo_filepath, section, todo)
+            todo_list.on_file_updated()
+        elif cmd == 'done':
+            if not args:
+                return (False, 'Error: Usage /done <number|id>')
+            ops = md_done_ops(todo_list.todo_filepath, args)
+            changed, deleted_lines = md_apply(todo_list.todo_filepath, ops)
+            action_report = []
+            for (_, num), deleted_line in zip(ops, deleted_lines):
+                if isinstance(deleted_line, LookupError):
+                    action_report.append(f"ToDo {num} doesn't exist")
+                elif deleted_line is None:
+                    action_report.append(f"ToDo #{num} can't be deleted")
+                else:
+                    action_report.append(f"ToDo #{num} deleted")
+            if changed:
+                todo_list.on_file_updated()
+            result = '\n'.join(action_report) if action_report else 'Nothing changed?'
+        elif cmd == 'history':
+            try:
+                limit = int(args[0]) if args else 10
+            except ValueError:
+                return (False, 'Error: Usage /history [count]')
+            _, done = md_get_history(todo_list.todo_filepath, max(1, limit))
+            result = '\n'.join(format_done(rec) for rec in done) or 'Nothing was completed yet'
+        elif cmd in ('pull', 'push') and todo_list.git is None:
+            return (False, "Error: Git sync runs in another process (the reminders mode), it can't "
+                           "be forced from here")
+        elif cmd == 'pull':
+            todo_list.git.pull()
+            result = 'Pull complete'
+        elif cmd == 'push':
+            result = 'Push complete' if todo_list.git.commit() else 'Nothing to push'
+        else:
+            return (False, f'Error: Unknown command: {cmd}')
+
+        return (True, result)
+    except Exception as ex:
+        log.error('Error processing command', exc_info=True)
+        return (False, f'Error: {ex}')
+    finally:
+        # Unknown commands are grouped, so users can't create arbitrary series
+        _COMMAND_SECONDS.observe(time.perf_counter() - start, todo_list.name,
+                                 cmd if cmd in _VERBS else 'unknown')
+
+
+# Revisions restart with the process, so clients get them as '<epoch>-<revision>' tokens: a token
+# from another process (eg one that ran before a restart) is never taken for one of this process
+_REV_EPOCH = f'{time.time_ns():x}'
+
+
+def _rev_token(rev):
+    return f'{_REV_EPOCH}-{rev}'
+
+
+def _parse_rev_token(token):
+    """ Revision in a token made by _rev_token, or None if it's malformed or from another
+    process """
+    epoch, _, rev = (token or '').partition('-')
+    if epoch != _REV_EPOCH or not rev.isdigit():
+        return None
+    return int(rev)
+
+
+def _conditional(response, doc):
+    """ Tag a response with the revision and mtime of the document it was built from. If the
+    client already has this revision, the response becomes an empty 304 """
+    response.set_etag(_rev_token(doc.revision))
+    response.last_modified = datetime.fromtimestamp(doc.file_sig[1] / 1e9, timezone.utc)
+    # Clients may keep a copy, but must check it's current before using it
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+_CMD_HELP = '''Commands:
+  /ls [section]          - List all ToDos (optionally in a section)
+  /sections              - List all sections
+  /search <words>        - Find ToDos containing all words
+  /add <section> <todo>  - Add a ToDo to a section
+  /done <number|id>      - Mark a ToDo as complete
+  /history [count]       - List recently completed ToDos
+  /pull                  - Force git pull
+  /push                  - Force git commit and push
+
+Usage: POST to /cmd with 'cmd' parameter
+Example: curl -X POST -d "cmd=/ls" http://localhost:5000/cmd
+'''
+
+# Send a comment this often to SSE clients, so proxies don't drop idle connections and clients
+# that went away are noticed
+_SSE_HEARTBEAT_SECS = 20
+# Streams end after this long, and clients reconnect after _SSE_RETRY_MS: a stream only holds a
+# server thread for a while, and clients that went away are dropped even if writes don't fail
+_SSE_MAX_STREAM_SECS = 300
+_SSE_RETRY_MS = 2000
+
+
+def _sse_change_event(rev):
+    token = _rev_token(rev)
+    return f'id: {token}\nevent: change\ndata: {json.dumps({"rev": token})}\n\n'
+
+
+class _StreamSlots:
+    """ Counts open SSE streams (of all lists), so that they can't take every server thread """
+
+    def __init__(self, max_streams):
+        self._max = max_streams
+        self._lock = threading.Lock()
+        self._open = 0
+
+    def acquire(self):
+        """ Take a slot for a new stream. Returns False if max_streams are already open """
+        with self._lock:
+            if self._max is not None and self._open >= self._max:
+                return False
+            self._open += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self._open -= 1
+
+
+def create_app(todo_lists, metrics_cb=None, admin_token=None, max_event_streams=None):
+    """ Build the Flask app serving each list (see main.TodoList) under its url_prefix. If
+    metrics_cb is set, /metrics serves what it returns (Prometheus' text format). If profiling is
+    enabled, requests are profiled as configured in profiling.py; with an admin_token, admins can
+    also profile any request and download profiles, see _add_profiling. At most max_event_streams
+    /api/events streams are open at a time (unlimited if None); more get a 503 """
+    app = Flask(__name__, static_folder='www', static_url_path='/static')
+    stream_slots = _StreamSlots(max_event_streams)
+    for todo_list in todo_lists:
+        app.register_blueprint(_list_blueprint(todo_list, stream_slots),
+                               url_prefix=todo_list.url_prefix or None)
+
+    if metrics_cb is not None:
+        @app.route('/metrics')
+        def metrics_page():
+            """ Metrics for Prometheus """
+            return Response(metrics_cb(), mimetype='text/plain; version=0.0.4')
+
+    if profiling.is_enabled():
+        _add_profiling(app, admin_token)
+
+    return app
+
+
+def _has_token(header, admin_token):
+    value = request.headers.get(header)
+    return value is not None and \
+        hmac.compare_digest(value.encode('utf-8'), admin_token.encode('utf-8'))
+
+
+def _add_profiling(app, admin_token):
+    """ Profile requests whose target ('web:<path>') is configured or armed in profiling.py. If
+    admin_token is set, requests with an X-GitToDo-Profile: <admin_token> header are always
+    profiled, and requests with X-GitToDo-Admin: <admin_token> can use the /admin/profiles routes.
+    Profiled responses name their profile in an X-GitToDo-Profile-Name header """
+
+    @app.before_request
+    def start_profile():
+        force = admin_token is not None and _has_token('X-GitToDo-Profile', admin_token)
+        g.profile = profiling.start(f'web:{request.path}', force)
+
+    @app.after_request
+    def stop_profile(response):
+        session = g.pop('profile', None)
+        if session is not None:
+            name = session.stop()
+            if name is not None:
+                response.headers['X-GitToDo-Profile-Name'] = name
+        return response
+
+    @app.teardown_request
+    def stop_failed_profile(_exc):
+        # after_request is skipped if the request raised
+        session = g.pop('profile', None)
+        if session is not None:
+            session.stop()
+
+    if admin_token is None:
+        return
+
+    @app.route('/admin/profiles')
+    def list_profiles():
+        """ Stored profiles (most recent first) and armed targets """
+        if not _has_token('X-GitToDo-Admin', admin_token):
+            return {'error': 'Forbidden'}, 403
+        return {'profiles': profiling.get_store().list(), 'armed': profiling.armed()}
+
+    @app.route('/admin/profiles/<name>')
+    def download_profile(name):
+        """ Download a profile, in pstats format """
+        if not _has_token('X-GitToDo-Admin', admin_token):
+            return {'error': 'Forbidden'}, 403
+        path = profiling.get_store().path(name)
+        if path is None:
+            return {'error': f'No profile {name}'}, 404
+        return send_file(path, mimetype='application/octet-stream', as_attachment=True,
+                         download_name=name)
+
+    @app.route('/admin/profiles/arm', methods=['POST'])
+    def arm_profile():
+        """ Profile the next runs of a target: {"target": "job:commit*", "count": 1}. Targets are
+        'web:<path>', 'telegram:<command>' or 'job:<job>[:<list>]' (commit, pull, remote_sync,
+        reminders_reload) and may use wildcards """
+        if not _has_token('X-GitToDo-Admin', admin_token):
+            return {'error': 'Forbidden'}, 403
+        data = request.get_json(silent=True) or {}
+        target = data.get('target')
+        count = data.get('count', 1)
+        if not isinstance(target, str) or not target or not isinstance(count, int) or count < 1:
+            return {'error': 'Expected {"target": <pattern>, "count": <n >= 1>}'}, 400
+        profiling.arm(target, count)
+        return {'armed': profiling.armed()}
+
+
+def _list_blueprint(todo_list, stream_slots):
+    """ Pages and API of a list. URLs in the pages are relative, so they work under any prefix """
+    bp = Blueprint(f'list_{todo_list.name}', __name__)
+
+    @bp.route('/raw')
+    def raw_page():
+        """ Serve the todo file as plain text """
+        doc = md_load(todo_list.todo_filepath)
+        return _conditional(Response(doc.text, mimetype='text/plain'), doc)
+
+    @bp.route('/cmd', methods=['GET', 'POST'])
+    def cmd_page():
+        """ Process commands like the Telegram bot """
+        if request.method == 'GET':
+            return Response(_CMD_HELP, mimetype='text/plain')
+
+        cmd_input = request.form.get('cmd', '')
+        success, result = process_command(todo_list, cmd_input)
+        status = 200 if success else 400
+        return Response(result, mimetype='text/plain'), status
+
+    @bp.route('/telegram_test')
+    def telegram_test_page():
+        """ HTML page to test Telegram commands """
+        return send_from_directory('www', 'telegram_test.html')
+
+    @bp.route('/api/cmd', methods=['POST'])
+    def api_cmd():
+        """ API endpoint to process commands and return JSON """
+        try:
+            data = request.get_json()
+            cmd_input = data.get('cmd', '')
+            success, result = process_command(todo_list, cmd_input)
+            return {'success': success, 'result': result}
+        except Exception as ex:
+            return {'success': False, 'result': str(ex)}
+
+    @bp.route('/')
+    def todos_page():
+        """ Interactive todo list page """
+        return send_from_directory('www', 'index.html')
+
+    @bp.route('/api/todos')
+    def api_todos():
+        """ API endpoint to get all todos as JSON, with the revision token they belong to. With
+        ?since=<rev>, only sections that changed since that revision are sent, as a 'delta' (see
+        md_get_sections_delta). Tokens from another process get all sections """
+        since = _parse_rev_token(request.args.get('since'))
+        if since is not None:
+            rev, delta = md_get_sections_delta(todo_list.todo_filepath, since)
+            if rev == since:
+                return Response(status=304)
+            if delta is not None:
+                return {'rev': _rev_token(rev), 'since': _rev_token(since), 'delta': delta}
+
+        doc = md_load(todo_list.todo_filepath)
+        todos = {'rev': _rev_token(doc.revision), 'sections': doc.parsed_sections()}
+        return _conditional(jsonify(todos), doc)
+
+    @bp.route('/api/events')
+    def api_events():
+        """ Server-sent events stream: emits a 'change' event, tagged with the new revision token
+        (as sent by /api/todos), whenever the ToDo file changes. Clients can then fetch
+        /api/todos?since=<their revision token>. Streams end after _SSE_MAX_STREAM_SECS, and
+        EventSource reconnects by itself; if too many streams are open, returns a 503 """
+        if not stream_slots.acquire():
+            _STREAMS_REJECTED.inc()
+            return Response('Too many open event streams', status=503,
+                            headers={'Retry-After': str(_SSE_HEARTBEAT_SECS)})
+
+        def stream():
+            # Start by telling the client which revision is current, so it knows if its copy is
+            # stale (eg if it's reconnecting after missing some changes)
+            rev = todo_list.changes.revision
+            yield f'retry: {_SSE_RETRY_MS}\n' + _sse_change_event(rev)
+            deadline = time.monotonic() + _SSE_MAX_STREAM_SECS
+            while True:
+                timeout = min(_SSE_HEARTBEAT_SECS, deadline - time.monotonic())
+                if timeout <= 0:
+                    return
+                new_rev = todo_list.changes.wait(rev, timeout)
+                if new_rev is None:
+                    yield ': heartbeat\n\n'
+                    continue
+                rev = new_rev
+                yield _sse_change_event(rev)
+
+        response = Response(stream(), mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        # Called once the server is done with the response, even if the stream never started
+        response.call_on_close(stream_slots.release)
+        return response
+
+    @bp.route('/api/search')
+    def api_search():
+        """ API endpoint to find ToDos containing all words in ?q=, at most ?limit= of them """
+        query = request.args.get('q', '')
+        limit = min(max(request.args.get('limit', 50, type=int), 1), 1000)
+        doc = md_load(todo_list.todo_filepath)
+        return {'rev': _rev_token(doc.revision), 'results': doc.search(query, limit)}
+
+    @bp.route('/api/history')
+    def api_history():
+        """ API endpoint to get recently completed ToDos, most recent first: ?limit= of them,
+        after skipping the ?skip= most recent """
+        limit = min(max(request.args.get('limit', 50, type=int), 1), 1000)
+        skip = max(request.args.get('skip', 0, type=int), 0)
+        total, done = md_get_history(todo_list.todo_filepath, limit, skip)
+        return {'total': total, 'skip': skip, 'items': done}
+
+    @bp.route('/api/done/<todo_ref>', methods=['POST'])
+    def api_done(todo_ref):
+        """ API endpoint to mark a todo as done, by id or line number """
+        try:
+            result = md_mark_done(todo_list.todo_filepath, md_parse_todo_ref(todo_ref))
+            if result is None:
+                return {'success': False, 'error': 'Cannot delete this line'}
+            todo_list.on_file_updated()
+            return {'success': True}
+        except Exception as ex:
+            return {'success': False, 'error': str(ex)}
+
+    @bp.route('/api/move', methods=['POST'])
+    def api_move():
+        """ API endpoint to move a todo (by 'id' or 'line') up or down """
+        try:
+            data = request.get_json()
+            todo_ref = md_parse_todo_ref(data['id'] if 'id' in data else data['line'])
+            direction = data['direction']
+            result = md_move_todo(todo_list.todo_filepath, todo_ref, direction)
+            if not result:
+                return {'success': False, 'error': 'Cannot move this todo'}
+            todo_list.on_file_updated()
+            return {'success': True}
+        except Exception as ex:
+            return {'success': False, 'error': str(ex)}
+
+    @bp.route('/api/add', methods=['POST'])
+    def api_add():
+        """ API endpoint to add a new todo """
+        try:
+            data = request.get_json()
+            section = data['section']
+            text = normalize_reminder_token(data['text'])
+            try:
+                maybe_reminder = guess_reminder_date(text)
+                if maybe_reminder is not None:
+                    text = mark_for_reminder_date(text, maybe_reminder)
+            except ValueError:
+                pass  # Ignore reminder parsing errors for API
+            md_add_to_section(todo_list.todo_filepath, section, text)
+            todo_list.on_file_updated()
+            return {'success': True}
+        except Exception as ex:
+            return {'success': False, 'error': str(ex)}
+
+    return bp
+
+
+def run_web(app, cfg):
+    """ Run the web UI (blocks), with the server selected by cfg.web_server """
+    server = cfg.get('web_server', 'dev')
+    if server == 'waitress':
+        # Optional dependency, only needed if this server is selected
+        from waitress import serve  # pylint: disable=import-outside-toplevel
+        # Each /api/events client holds on to a thread, see web_max_event_streams
+        serve(app, host='0.0.0.0', port=4300, threads=cfg.get('web_threads', 16))
+    else:
+        app.run(host='0.0.0.0', port=4300, debug=False, use_reloader=False, threaded=True)